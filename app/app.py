@@ -10,51 +10,53 @@ import json
 from datetime import datetime, timedelta, date
 from typing import Dict, List, Optional
 from functools import wraps
-import hashlib
+import atexit
+import click
+import hmac
+import mimetypes
 import random
 import string
+import time
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, flash, send_file, stream_with_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 
 from config import config, Config
+import media
+import streaming
+import caching
+import compression
+import static_assets
+import presence
+import expiry
+import archive
+import backup
+import shards
+import sync
+import facets
+import mailer
+import payments
+from writer import DatabaseWriter, JobConnection, WriterBusy
+from offload import Offloader, OffloadTimeout
+from scheduler import LeaderLock, Scheduler
+from geo import grid_cell
+from projections import ProjectionError, PROFILE_PROJECTION, REQUEST_PROJECTION
+from pools import configure_process_pool, get_process_pool
 
-# Initialisation Flask
-def create_app(config_name=None):
-    app = Flask(__name__)
-    
-    # Configuration
-    config_name = config_name or os.environ.get('FLASK_CONFIG') or 'default'
-    app.config.from_object(config[config_name])
-    
-    # Extensions
-    CORS(app, origins=app.config['CORS_ORIGINS'])
-    socketio = SocketIO(
-        app,
-        async_mode=app.config['SOCKETIO_ASYNC_MODE'],
-        cors_allowed_origins=app.config['SOCKETIO_CORS_ALLOWED_ORIGINS']
-    )
-    
-    # Initialisation base de données
-    init_db(app.config['DATABASE_PATH'])
-    
-    return app, socketio
-
-app, socketio = create_app()
-
-# Utilitaires
-def get_db():
-    """Obtient une connexion à la base de données"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    conn.row_factory = sqlite3.Row
-    return conn
+# Base de données
+def init_db(db_path, facet_cell_size=Config.FACET_CELL_SIZE, mail_digest_window=None):
+    """Initialise la base de données
 
-def init_db(db_path):
-    """Initialise la base de données"""
+    Appelée par create_app avant que l'application globale n'existe : les
+    réglages nécessaires sont passés en paramètres (définie avant create_app,
+    qui s'exécute à l'import du module). mail_digest_window
+    (secondes) active la copie des notifications dans la file des emails.
+    """
     with sqlite3.connect(db_path) as conn:
+        # WAL : les lectures continuent pendant les écritures
+        conn.execute('PRAGMA journal_mode=WAL')
         conn.executescript('''
             -- Table des utilisateurs
             CREATE TABLE IF NOT EXISTS users (
@@ -71,6 +73,7 @@ def init_db(db_path):
                 skills TEXT,
                 availability TEXT,
                 time_credits INTEGER DEFAULT 100,
+                credits_flagged BOOLEAN DEFAULT FALSE, -- crédits remboursés non retirés
                 level TEXT DEFAULT 'new_user',
                 points INTEGER DEFAULT 0,
                 rating REAL DEFAULT 5.0,
@@ -79,6 +82,7 @@ def init_db(db_path):
                 is_verified BOOLEAN DEFAULT FALSE,
                 is_active BOOLEAN DEFAULT TRUE,
                 last_login TIMESTAMP,
+                last_seen TIMESTAMP,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
@@ -98,7 +102,7 @@ def init_db(db_path):
                 latitude REAL,
                 longitude REAL,
                 deadline TIMESTAMP,
-                status TEXT DEFAULT 'active', -- 'active', 'completed', 'cancelled'
+                status TEXT DEFAULT 'active', -- 'active', 'completed', 'cancelled', 'expired'
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
@@ -193,10 +197,261 @@ def init_db(db_path):
             CREATE INDEX IF NOT EXISTS idx_users_location ON users(latitude, longitude);
             CREATE INDEX IF NOT EXISTS idx_requests_location ON requests(latitude, longitude);
             CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status);
+            CREATE INDEX IF NOT EXISTS idx_requests_status_deadline ON requests(status, deadline);
             CREATE INDEX IF NOT EXISTS idx_exchanges_status ON exchanges(status);
             CREATE INDEX IF NOT EXISTS idx_messages_exchange ON messages(exchange_id);
             CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, is_read);
         ''')
+        
+        # Colonnes ajoutées après la création initiale du schéma
+        ensure_columns(conn, 'users', {'last_seen': 'TIMESTAMP', 'credits_flagged': 'BOOLEAN DEFAULT FALSE'})
+        
+        # Dates limites antérieures à leur normalisation
+        conn.executescript(expiry.NORMALIZE_DEADLINES_SQL)
+        
+        # Compteurs de versions pour les ETags
+        conn.executescript(caching.schema_sql())
+        
+        # Journal des changements pour la synchronisation différentielle
+        sync.install(conn)
+        
+        # Compteurs de facettes du flux des demandes
+        facets.install(conn, facet_cell_size)
+        
+        # Boîte de réception des webhooks de paiement et paiements reçus
+        conn.executescript(payments.PAYMENTS_SCHEMA)
+        ensure_columns(conn, 'webhook_inbox', {'next_attempt_at': 'TIMESTAMP'})
+        ensure_columns(conn, 'payments', {
+            'credits_revoked': 'INTEGER NOT NULL DEFAULT 0',
+            'credits_owed': 'INTEGER NOT NULL DEFAULT 0'
+        })
+        
+        # File d'envoi des emails (et copie des notifications si activée)
+        conn.executescript(mailer.schema_sql(mail_digest_window))
+
+def ensure_columns(conn, table, columns):
+    """Ajoute les colonnes manquantes d'une table existante (migration automatique)"""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+# Initialisation Flask
+def create_app(config_name=None):
+    # /static est servi par serve_static depuis le build de public_html
+    app = Flask(__name__, static_folder=None)
+    
+    # Configuration
+    config_name = config_name or os.environ.get('FLASK_CONFIG') or 'default'
+    app.config.from_object(config[config_name])
+    
+    # Extensions
+    CORS(app, origins=app.config['CORS_ORIGINS'])
+    compression.init_app(app)
+    socketio = SocketIO(
+        app,
+        async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+        cors_allowed_origins=app.config['SOCKETIO_CORS_ALLOWED_ORIGINS']
+    )
+    
+    # Initialisation base de données
+    init_db(
+        app.config['DATABASE_PATH'],
+        facet_cell_size=app.config['FACET_CELL_SIZE'],
+        mail_digest_window=app.config['MAIL_DIGEST_WINDOW'] if app.config['MAIL_ENABLED'] else None
+    )
+    
+    return app, socketio
+
+app, socketio = create_app()
+
+# Présence en ligne, alimentée par les événements WebSocket
+presence_registry = presence.create_registry(
+    app.config['PRESENCE_STORAGE_URL'],
+    app.config['PRESENCE_TTL']
+)
+
+# Miniatures, compression des sauvegardes : pool de processus à la taille configurée
+configure_process_pool(app.config['MEDIA_WORKERS'])
+
+# Utilitaires
+def get_db():
+    """Obtient une connexion à la base de données
+
+    La connexion peut passer d'un thread du pool d'exécution à un autre
+    (jamais simultanément) : d'où check_same_thread=False.
+    """
+    conn = sqlite3.connect(
+        app.config['DATABASE_PATH'],
+        timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _archive_path(shard=None):
+    """Base d'archive de la base principale ou d'un shard"""
+    if shard is None:
+        return app.config['ARCHIVE_DATABASE_PATH']
+    return shard_router.archive_path(shard)
+
+def _connect_writer(shard=None):
+    """Connexion de l'écrivain unique, utilisée depuis son propre thread
+
+    L'archive y est attachée dès l'ouverture : les lots d'archivage passent par
+    l'écrivain, dont les transactions interdisent ATTACH.
+    """
+    if shard is None:
+        conn = sqlite3.connect(
+            app.config['DATABASE_PATH'],
+            timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+    else:
+        conn = shard_router.connect(shard)
+    archive.attach(conn, _archive_path(shard))
+    conn.commit()
+    return conn
+
+# Appels SQLite exécutés hors de la boucle eventlet (threads natifs)
+db_offload = Offloader(
+    max_workers=app.config['DB_OFFLOAD_WORKERS'],
+    timeout=app.config['READ_TIMEOUT'],
+    mode=app.config['DB_OFFLOAD_MODE']
+)
+
+# Partitionnement géographique (SHARDING_ENABLED) ; None en base unique
+shard_router = shards.ShardRouter(
+    app.config['DATABASE_PATH'],
+    app.config['SHARD_DIR'],
+    app.config['SHARD_GRID_SIZE'],
+    busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+    refresh=app.config['SHARD_MAP_REFRESH'],
+    schema_sql=caching.schema_sql(shards.SHARDED_TABLES) + sync.schema_sql(shards.SHARDED_TABLES)
+    + expiry.NORMALIZE_DEADLINES_SQL,
+    # Triggers de facettes recréés seulement si leur définition a changé
+    setup=lambda conn: facets.install(conn, app.config['FACET_CELL_SIZE'])
+) if app.config['SHARDING_ENABLED'] else None
+
+# Connexions SMTP réutilisées par le job d'envoi des emails
+# (MAIL_TEST_MODE : serveur local de capture, sans TLS ni authentification)
+_test_mail = app.config['MAIL_TEST_MODE']
+mail_pool = mailer.SMTPPool(
+    'localhost' if _test_mail else app.config['MAIL_SERVER'],
+    app.config['MAIL_SINK_PORT'] if _test_mail else app.config['MAIL_PORT'],
+    use_tls=app.config['MAIL_USE_TLS'] and not _test_mail,
+    username=None if _test_mail else app.config['MAIL_USERNAME'],
+    password=None if _test_mail else app.config['MAIL_PASSWORD'],
+    timeout=app.config['MAIL_TIMEOUT'],
+    size=app.config['MAIL_POOL_SIZE'],
+    max_messages=app.config['MAIL_MAX_PER_CONNECTION'],
+    idle_timeout=app.config['MAIL_IDLE_TIMEOUT']
+)
+
+def _make_writer(connect):
+    # Un lot d'écriture n'est jamais interrompu : pas de délai maximal
+    return DatabaseWriter(
+        connect,
+        max_queue=app.config['WRITE_QUEUE_SIZE'],
+        max_per_key=app.config['WRITE_QUEUE_PER_CLIENT'],
+        max_batch=app.config['WRITE_BATCH_SIZE'],
+        offload=lambda fn, *args: db_offload.call(fn, *args, timeout=0)
+    )
+
+# Écrivain unique (WRITE_MODE = 'queue') de la base principale, puis un par shard
+db_writer = _make_writer(_connect_writer)
+shard_writers = {}
+
+def _writer_for(shard):
+    if shard is None:
+        return db_writer
+    writer = shard_writers.get(shard)
+    if writer is None:
+        writer = shard_writers.setdefault(shard, _make_writer(lambda: _connect_writer(shard)))
+    return writer
+
+def shard_for_id(record_id):
+    """Shard d'une demande, d'un échange ou d'un message (None en base unique)
+
+    Lève shards.ShardError pour un identifiant qui n'appartient à aucune région.
+    """
+    if shard_router is None:
+        return None
+    return db_offload.call(shard_router.shard_for_id, record_id)
+
+def run_read(fn, timeout=None, history=False, shard=None):
+    """Exécute fn(conn) sur une connexion de lecture, hors de la boucle eventlet
+
+    fn doit lire tous ses résultats : la connexion est fermée au retour. Au-delà
+    de timeout secondes (READ_TIMEOUT par défaut), la requête SQLite est
+    interrompue et OffloadTimeout est levée. history ajoute la base d'archive ;
+    shard désigne un shard plutôt que la base principale.
+    """
+    if shard is not None:
+        connect = (lambda: get_history_db(shard)) if history else (lambda: shard_router.connect(shard))
+    else:
+        connect = get_history_db if history else get_db
+    return db_offload.run_query(connect, fn, timeout)
+
+def run_write(fn, key=None, shard=None):
+    """Exécute fn(conn) dans une transaction d'écriture et retourne son résultat
+
+    En mode 'queue', fn est confiée à l'écrivain unique de la base (key
+    identifie le client pour l'équité) ; en mode 'direct', elle s'exécute sur
+    une connexion propre. Dans les deux modes, fn reçoit une JobConnection qui
+    refuse commit() : la transaction est validée à son retour. shard désigne
+    un shard plutôt que la base principale.
+    """
+    if app.config['WRITE_MODE'] == 'queue':
+        return _writer_for(shard).write(fn, key, timeout=app.config['WRITE_TIMEOUT'])
+
+    def write(conn):
+        with conn:
+            return fn(JobConnection(conn))
+
+    connect = get_db if shard is None else (lambda: shard_router.connect(shard))
+    return db_offload.run_query(connect, write, timeout=0)
+
+def data_version(tables):
+    """Versions des tables pour les ETags, tous shards confondus"""
+    if shard_router is not None:
+        return db_offload.call(shard_router.data_version, tables)
+    return run_read(lambda conn: caching.data_version(conn, tables))
+
+def fan_out_read(sql, params, order_by, reverse=False, limit=None, history=False, drop=()):
+    """Lecture sur tous les shards, fusionnée selon order_by, en un seul appel du pool"""
+    connect = get_history_db if history else shard_router.connect
+    return db_offload.call(lambda: [
+        row
+        for chunk in shard_router.fan_out(sql, params, order_by, reverse, limit, connect=connect, drop=drop)
+        for row in chunk
+    ])
+
+def database_targets(include_directory=False):
+    """Bases traitées par les tâches de maintenance ; None désigne la base principale"""
+    if shard_router is None:
+        return [None]
+    return ([None] if include_directory else []) + db_offload.call(shard_router.shards)
+
+def db_error_response(e):
+    """Réponse d'erreur d'un accès base : 503 si la base est saturée ou trop lente, 500 sinon"""
+    if isinstance(e, (WriterBusy, OffloadTimeout)) or (
+        isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'interrupted' in str(e))
+    ):
+        response = jsonify({'error': 'Database busy, please retry'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    return jsonify({'error': str(e)}), 500
+
+def get_history_db(shard=None):
+    """Connexion de lecture de l'historique : base principale (ou shard) + archive si elle existe"""
+    conn = get_db() if shard is None else shard_router.connect(shard)
+    archive_path = _archive_path(shard)
+    if os.path.exists(archive_path):
+        archive.attach(conn, archive_path, ensure_schema=False)
+    return conn
 
 def login_required(f):
     """Décorateur pour vérifier la connexion utilisateur"""
@@ -207,6 +462,44 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    """Décorateur pour les endpoints d'administration (en-tête X-Admin-Token)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config.get('ADMIN_TOKEN')
+        provided = request.headers.get('X-Admin-Token', '')
+        if not token or not hmac.compare_digest(provided, token):
+            return jsonify({'error': 'Admin authentication required'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+def versioned(*tables):
+    """Décorateur ETag : répond 304 sans exécuter la vue si les tables n'ont pas changé
+
+    L'ETag combine les compteurs de version des tables et la query string.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            try:
+                version = data_version(tables)
+            except Exception as e:
+                return db_error_response(e)
+            etag = caching.make_etag(request.path, version, request.query_string)
+
+            # Les variantes compressées portent un suffixe d'encodage
+            response = compression.not_modified(etag)
+            if response is not None:
+                return response
+
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return decorated_function
+    return decorator
+
 def generate_token(length=32):
     """Génère un token aléatoire"""
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
@@ -225,23 +518,30 @@ def index():
             'requests': '/requests',
             'exchanges': '/exchanges',
             'messages': '/messages',
-            'notifications': '/notifications'
+            'notifications': '/notifications',
+            'uploads': '/uploads',
+            'media': '/media'
         }
     })
 
 @app.route('/health')
 def health():
-    """Endpoint de santé pour les vérifications"""
+    """Endpoint de santé pour les vérifications
+
+    Pas d'ETag : le corps porte l'heure de la vérification, une 304 ferait
+    passer une ancienne réponse pour l'état courant.
+    """
     try:
         # Test de connexion à la base de données
-        with get_db() as conn:
-            conn.execute('SELECT 1').fetchone()
+        run_read(lambda conn: conn.execute('SELECT 1').fetchone())
         
-        return jsonify({
+        response = jsonify({
             'status': 'healthy',
             'timestamp': datetime.utcnow().isoformat(),
             'database': 'connected'
         })
+        response.headers['Cache-Control'] = 'no-store'
+        return response
     except Exception as e:
         return jsonify({
             'status': 'unhealthy',
@@ -249,6 +549,48 @@ def health():
             'timestamp': datetime.utcnow().isoformat()
         }), 500
 
+# Assets statiques (build de public_html)
+def _send_asset(relpath):
+    """Envoie un asset du build, en variante précompressée si le client l'accepte"""
+    path, encoding = static_assets.resolve_variant(
+        app.config['PUBLIC_HTML_DIST'], relpath, request.accept_encodings
+    )
+    if not path:
+        return jsonify({'error': 'Not found'}), 404
+
+    # Type MIME du fichier d'origine, pas de la variante .gz/.br
+    mimetype = mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+
+    if static_assets.is_fingerprinted(relpath):
+        response.headers['Cache-Control'] = f"public, max-age={app.config['STATIC_MAX_AGE']}, immutable"
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    """CSS et JavaScript"""
+    return _send_asset(f'static/{filename}')
+
+@app.route('/manifest.<fingerprint>.json')
+def serve_manifest(fingerprint):
+    """Manifeste PWA"""
+    return _send_asset(f'manifest.{fingerprint}.json')
+
+@app.route('/sw.js')
+def serve_service_worker():
+    """Service worker généré par le build"""
+    return _send_asset('sw.js')
+
+@app.route('/asset-manifest.json')
+def serve_asset_manifest():
+    """Correspondance noms d'origine -> noms empreintes"""
+    return _send_asset('asset-manifest.json')
+
 # Routes d'authentification
 @app.route('/auth/register', methods=['POST'])
 def register():
@@ -261,46 +603,52 @@ def register():
         if not data.get(field):
             return jsonify({'error': f'{field} is required'}), 400
     
+    # Hachage hors de la transaction d'écriture (coûteux en CPU)
+    password_hash = generate_password_hash(data['password'])
+    
+    def create_user(conn):
+        # Vérifier si l'utilisateur existe déjà
+        existing = conn.execute(
+            'SELECT id FROM users WHERE username = ? OR email = ?',
+            (data['username'], data['email'])
+        ).fetchone()
+        
+        if existing:
+            return None
+        
+        # Créer l'utilisateur
+        cursor = conn.execute('''
+            INSERT INTO users (username, email, password_hash, full_name, phone, address, bio, skills)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data['username'],
+            data['email'],
+            password_hash,
+            data['full_name'],
+            data.get('phone', ''),
+            data.get('address', ''),
+            data.get('bio', ''),
+            data.get('skills', '')
+        ))
+        return cursor.lastrowid
+    
     try:
-        with get_db() as conn:
-            # Vérifier si l'utilisateur existe déjà
-            existing = conn.execute(
-                'SELECT id FROM users WHERE username = ? OR email = ?',
-                (data['username'], data['email'])
-            ).fetchone()
-            
-            if existing:
-                return jsonify({'error': 'User already exists'}), 409
-            
-            # Créer l'utilisateur
-            password_hash = generate_password_hash(data['password'])
-            cursor = conn.execute('''
-                INSERT INTO users (username, email, password_hash, full_name, phone, address, bio, skills)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                data['username'],
-                data['email'],
-                password_hash,
-                data['full_name'],
-                data.get('phone', ''),
-                data.get('address', ''),
-                data.get('bio', ''),
-                data.get('skills', '')
-            ))
-            
-            user_id = cursor.lastrowid
-            
-            # Créer une session
-            session['user_id'] = user_id
-            session['username'] = data['username']
-            
-            return jsonify({
-                'message': 'User created successfully',
-                'user_id': user_id
-            }), 201
+        user_id = run_write(create_user, key=request.remote_addr)
             
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return db_error_response(e)
+    
+    if user_id is None:
+        return jsonify({'error': 'User already exists'}), 409
+    
+    # Créer une session
+    session['user_id'] = user_id
+    session['username'] = data['username']
+    
+    return jsonify({
+        'message': 'User created successfully',
+        'user_id': user_id
+    }), 201
 
 @app.route('/auth/login', methods=['POST'])
 def login():
@@ -311,41 +659,36 @@ def login():
         return jsonify({'error': 'Email and password required'}), 400
     
     try:
-        with get_db() as conn:
-            user = conn.execute(
-                'SELECT * FROM users WHERE email = ? AND is_active = TRUE',
-                (data['email'],)
-            ).fetchone()
-            
-            if not user or not check_password_hash(user['password_hash'], data['password']):
-                return jsonify({'error': 'Invalid credentials'}), 401
-            
-            # Mise à jour de la dernière connexion
-            conn.execute(
-                'UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?',
-                (user['id'],)
-            )
-            
-            # Créer une session
-            session['user_id'] = user['id']
-            session['username'] = user['username']
-            
-            return jsonify({
-                'message': 'Login successful',
-                'user': {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'full_name': user['full_name'],
-                    'email': user['email'],
-                    'time_credits': user['time_credits'],
-                    'points': user['points'],
-                    'level': user['level'],
-                    'rating': user['rating']
-                }
-            })
-            
+        user = run_read(lambda conn: conn.execute(
+            'SELECT * FROM users WHERE email = ? AND is_active = TRUE',
+            (data['email'],)
+        ).fetchone())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return db_error_response(e)
+    
+    if not user or not check_password_hash(user['password_hash'], data['password']):
+        return jsonify({'error': 'Invalid credentials'}), 401
+    
+    # Dernière connexion : écrite en lot par flush_presence()
+    presence_registry.record_login(user['id'])
+    
+    # Créer une session
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    
+    return jsonify({
+        'message': 'Login successful',
+        'user': {
+            'id': user['id'],
+            'username': user['username'],
+            'full_name': user['full_name'],
+            'email': user['email'],
+            'time_credits': user['time_credits'],
+            'points': user['points'],
+            'level': user['level'],
+            'rating': user['rating']
+        }
+    })
 
 @app.route('/auth/logout', methods=['POST'])
 @login_required
@@ -358,23 +701,30 @@ def logout():
 @app.route('/users/profile', methods=['GET'])
 @login_required
 def get_profile():
-    """Obtenir le profil de l'utilisateur connecté"""
+    """Obtenir le profil de l'utilisateur connecté
+
+    Paramètres : fields=champ1,champ2 ou view=compact
+    """
     try:
-        with get_db() as conn:
-            user = conn.execute(
-                'SELECT * FROM users WHERE id = ?',
-                (session['user_id'],)
-            ).fetchone()
-            
-            if not user:
-                return jsonify({'error': 'User not found'}), 404
-            
-            return jsonify({
-                'user': dict(user)
-            })
-            
+        fields = PROFILE_PROJECTION.resolve(request.args.get('fields'), request.args.get('view'))
+    except ProjectionError as e:
+        return jsonify({'error': str(e)}), 400
+
+    user_id = session['user_id']
+    try:
+        user = run_read(lambda conn: conn.execute(
+            f'SELECT {PROFILE_PROJECTION.select_clause(fields)} FROM users WHERE id = ?',
+            (user_id,)
+        ).fetchone())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return db_error_response(e)
+    
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    return jsonify({
+        'user': dict(user)
+    })
 
 @app.route('/users/profile', methods=['PUT'])
 @login_required
@@ -382,52 +732,270 @@ def update_profile():
     """Mettre à jour le profil utilisateur"""
     data = request.get_json()
     
+    # Champs modifiables
+    updatable_fields = ['full_name', 'phone', 'address', 'bio', 'skills', 'availability']
+    updates = []
+    values = []
+    
+    for field in updatable_fields:
+        if field in data:
+            updates.append(f'{field} = ?')
+            values.append(data[field])
+    
     try:
-        with get_db() as conn:
-            # Champs modifiables
-            updatable_fields = ['full_name', 'phone', 'address', 'bio', 'skills', 'availability']
-            updates = []
-            values = []
-            
-            for field in updatable_fields:
-                if field in data:
-                    updates.append(f'{field} = ?')
-                    values.append(data[field])
-            
-            if updates:
-                values.append(session['user_id'])
-                conn.execute(f'''
-                    UPDATE users 
-                    SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                ''', values)
-            
-            return jsonify({'message': 'Profile updated successfully'})
+        if updates:
+            values.append(session['user_id'])
+            run_write(lambda conn: conn.execute(f'''
+                UPDATE users 
+                SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP 
+                WHERE id = ?
+            ''', values), key=session['user_id'])
+        
+        return jsonify({'message': 'Profile updated successfully'})
             
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return db_error_response(e)
+
+# Routes médias
+def _media_urls(content_hash, extension):
+    """URLs publiques d'une image et de ses miniatures"""
+    return {
+        'url': url_for('serve_original', name=f'{content_hash}.{extension}'),
+        'thumbnails': {
+            str(size): url_for('serve_thumbnail', name=f'{content_hash}_{size}.webp')
+            for size in app.config['THUMBNAIL_SIZES']
+        }
+    }
+
+def _log_thumbnail_failure(future, content_hash):
+    if not future.cancelled() and future.exception() is not None:
+        app.logger.error(f'Miniatures de {content_hash} : {future.exception()!r}')
+
+def _store_uploaded_image():
+    """Enregistre l'image du champ 'file' et planifie ses miniatures
+
+    Werkzeug bascule les fichiers multipart volumineux sur disque : la copie
+    par blocs ci-dessous ne garde donc jamais le fichier entier en mémoire.
+    Copie et SHA-256 s'exécutent dans un thread du pool, hors de la boucle
+    eventlet, comme les miniatures dans le pool de processus.
+    """
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        raise media.UploadError('file is required')
+    if not Config.allowed_file(upload.filename):
+        raise media.UploadError('File type not allowed')
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    content_hash, extension, created = db_offload.call(
+        media.store_upload,
+        upload.stream,
+        upload_folder,
+        app.config['UPLOAD_CHUNK_SIZE'],
+        app.config['MAX_CONTENT_LENGTH'],
+        timeout=0
+    )
+
+    # Miniatures générées hors du chemin de la requête ; un échec n'est visible que dans les logs
+    future = get_process_pool().submit(
+        media.make_thumbnails,
+        upload_folder,
+        content_hash,
+        extension,
+        app.config['THUMBNAIL_SIZES'],
+        app.config['THUMBNAIL_QUALITY']
+    )
+    future.add_done_callback(lambda f: _log_thumbnail_failure(f, content_hash))
+
+    return content_hash, extension, created
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def upload_image():
+    """Envoyer une image (message, demande...)"""
+    try:
+        content_hash, extension, created = _store_uploaded_image()
+    except media.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'hash': content_hash,
+        'created': created,
+        **_media_urls(content_hash, extension)
+    }), 201 if created else 200
+
+@app.route('/users/profile/picture', methods=['POST'])
+@login_required
+def upload_profile_picture():
+    """Mettre à jour la photo de profil"""
+    try:
+        content_hash, extension, created = _store_uploaded_image()
+    except media.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+
+    urls = _media_urls(content_hash, extension)
+    # La session n'est pas accessible depuis le thread qui exécute l'écriture
+    values = (urls['url'], session['user_id'])
+
+    try:
+        run_write(lambda conn: conn.execute('''
+            UPDATE users
+            SET profile_picture = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', values), key=session['user_id'])
+
+        return jsonify({
+            'message': 'Profile picture updated successfully',
+            'hash': content_hash,
+            **urls
+        })
+
+    except Exception as e:
+        return db_error_response(e)
+
+def _send_immutable(path):
+    """Envoie un fichier adressé par contenu (Range et If-None-Match gérés)"""
+    response = send_file(path, conditional=True, max_age=app.config['MEDIA_MAX_AGE'])
+    response.headers['Cache-Control'] = f"public, max-age={app.config['MEDIA_MAX_AGE']}, immutable"
+    return response
+
+@app.route('/media/originals/<name>')
+def serve_original(name):
+    """Servir une image d'origine"""
+    match = media.ORIGINAL_NAME_RE.match(name)
+    if not match:
+        return jsonify({'error': 'Not found'}), 404
+
+    path = media.original_path(app.config['UPLOAD_FOLDER'], match.group(1), match.group(2))
+    if not os.path.exists(path):
+        return jsonify({'error': 'Not found'}), 404
+
+    return _send_immutable(path)
+
+@app.route('/media/thumbs/<name>')
+def serve_thumbnail(name):
+    """Servir une miniature WebP"""
+    match = media.THUMBNAIL_NAME_RE.match(name)
+    if not match or int(match.group(2)) not in app.config['THUMBNAIL_SIZES']:
+        return jsonify({'error': 'Not found'}), 404
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    content_hash = match.group(1)
+    path = media.thumbnail_path(upload_folder, content_hash, match.group(2))
+    if os.path.exists(path):
+        return _send_immutable(path)
+
+    # Miniature pas encore générée : servir l'original sans cache long
+    for extension in media.IMAGE_FORMATS.values():
+        original = media.original_path(upload_folder, content_hash, extension)
+        if os.path.exists(original):
+            return send_file(original, conditional=True, max_age=60)
+
+    return jsonify({'error': 'Not found'}), 404
 
 # Routes des demandes/offres
 @app.route('/requests', methods=['GET'])
+@versioned('requests', 'users')
 def get_requests():
-    """Obtenir les demandes/offres"""
+    """Obtenir les demandes/offres
+
+    Paramètres : limit (50 par défaut), stream=1 pour un envoi incrémental
+    autorisant jusqu'à STREAM_MAX_ROWS lignes, fields=champ1,champ2 ou
+    view=compact pour ne sélectionner que les colonnes utiles.
+    """
+    stream = request.args.get('stream') == '1'
+    max_rows = app.config['STREAM_MAX_ROWS'] if stream else 50
+    limit = max(1, min(request.args.get('limit', 50, type=int), max_rows))
+
     try:
-        with get_db() as conn:
-            requests = conn.execute('''
-                SELECT r.*, u.username, u.full_name, u.rating, u.profile_picture
-                FROM requests r
-                JOIN users u ON r.user_id = u.id
-                WHERE r.status = 'active'
-                ORDER BY r.created_at DESC
-                LIMIT 50
-            ''').fetchall()
-            
-            return jsonify({
-                'requests': [dict(req) for req in requests]
-            })
-            
+        fields = REQUEST_PROJECTION.resolve(request.args.get('fields'), request.args.get('view'))
+    except ProjectionError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # La jointure sur users n'est faite que si un champ utilisateur est demandé
+    join_users = 'JOIN users u ON r.user_id = u.id' if REQUEST_PROJECTION.uses_table(fields, 'u') else ''
+    # En mode partitionné, les colonnes de tri servent à fusionner les shards
+    sort_columns = ('sort_created_at', 'sort_id')
+    extra = ', r.created_at AS sort_created_at, r.id AS sort_id' if shard_router is not None else ''
+    sql = f'''
+        SELECT {REQUEST_PROJECTION.select_clause(fields)}{extra}
+        FROM requests r
+        {join_users}
+        WHERE r.status = 'active'
+        ORDER BY r.created_at DESC, r.id DESC
+        LIMIT ?
+    '''
+
+    if shard_router is not None:
+        if stream:
+            chunks = shard_router.fan_out(
+                sql, (limit,), sort_columns, reverse=True, limit=limit,
+                chunk_size=app.config['STREAM_CHUNK_SIZE'], run=db_offload.call, drop=sort_columns
+            )
+            return Response(
+                stream_with_context(streaming.json_array_chunks(chunks, 'requests')),
+                mimetype='application/json'
+            )
+        try:
+            requests = fan_out_read(sql, (limit,), sort_columns, reverse=True, limit=limit, drop=sort_columns)
+        except Exception as e:
+            return db_error_response(e)
+        return jsonify({'requests': requests, 'count': len(requests)})
+
+    if stream:
+        return Response(
+            stream_with_context(streaming.json_array_stream(
+                get_db, sql, (limit,), 'requests', app.config['STREAM_CHUNK_SIZE'], run=db_offload.call
+            )),
+            mimetype='application/json'
+        )
+
+    try:
+        requests = run_read(lambda conn: conn.execute(sql, (limit,)).fetchall())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return db_error_response(e)
+    
+    # Mêmes clés qu'en envoi incrémental (streaming.json_array_chunks)
+    return jsonify({
+        'requests': [dict(req) for req in requests],
+        'count': len(requests)
+    })
+
+@app.route('/requests/facets', methods=['GET'])
+@versioned('requests')
+def get_request_facets():
+    """Nombre de demandes actives par catégorie, type et mode d'échange
+
+    Sans paramètre : totaux ; avec lat et lon : cellule de FACET_CELL_SIZE
+    degrés contenant le point. Lit les compteurs, jamais les demandes.
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if (lat is None) != (lon is None):
+        return jsonify({'error': 'lat and lon must be given together'}), 400
+    if lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'Invalid coordinates'}), 400
+    cell = grid_cell(lat, lon, app.config['FACET_CELL_SIZE'])
+
+    try:
+        parts = [
+            run_read(lambda conn: facets.read_counts(conn, cell), shard=shard)
+            for shard in database_targets()
+        ]
+    except Exception as e:
+        return db_error_response(e)
+
+    return jsonify({'cell': cell, 'facets': facets.merge_counts(parts)})
+
+def reconcile_facets():
+    """Recalcule les compteurs de facettes et corrige une éventuelle dérive"""
+    cell_size = app.config['FACET_CELL_SIZE']
+    drift = sum(
+        run_write(lambda conn: facets.reconcile(conn, cell_size), shard=shard)
+        for shard in database_targets()
+    )
+    if drift:
+        app.logger.warning(f'Facettes : {drift} compteur(s) corrigé(s)')
+    return drift
 
 @app.route('/requests', methods=['POST'])
 @login_required
@@ -440,45 +1008,658 @@ def create_request():
         if not data.get(field):
             return jsonify({'error': f'{field} is required'}), 400
     
+    # Date limite stockée en UTC pour être comparée par l'index (status, deadline)
     try:
-        with get_db() as conn:
-            cursor = conn.execute('''
-                INSERT INTO requests (
-                    user_id, title, description, category, type, 
-                    time_required, price, exchange_type, location,
-                    latitude, longitude, deadline
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                session['user_id'],
-                data['title'],
-                data['description'],
-                data['category'],
-                data['type'],
-                data.get('time_required'),
-                data.get('price', 0),
-                data.get('exchange_type', 'time'),
-                data.get('location'),
-                data.get('latitude'),
-                data.get('longitude'),
-                data.get('deadline')
-            ))
-            
-            request_id = cursor.lastrowid
-            
-            return jsonify({
-                'message': 'Request created successfully',
-                'request_id': request_id
-            }), 201
+        deadline = expiry.normalize_deadline(data.get('deadline'))
+    except ValueError:
+        return jsonify({'error': 'deadline must be an ISO 8601 date'}), 400
+    
+    values = (
+        session['user_id'],
+        data['title'],
+        data['description'],
+        data['category'],
+        data['type'],
+        data.get('time_required'),
+        data.get('price', 0),
+        data.get('exchange_type', 'time'),
+        data.get('location'),
+        data.get('latitude'),
+        data.get('longitude'),
+        deadline
+    )
+    
+    def insert(conn):
+        # En mode partitionné, l'identifiant est pris dans l'espace de la région
+        request_id = shards.allocate_id(conn, 'requests', region_idx) if region_idx is not None else None
+        return conn.execute('''
+            INSERT INTO requests (
+                id, user_id, title, description, category, type, 
+                time_required, price, exchange_type, location,
+                latitude, longitude, deadline
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (request_id,) + values).lastrowid
+    
+    try:
+        region_idx = shard = None
+        if shard_router is not None:
+            region_idx, shard = db_offload.call(shard_router.locate, data.get('latitude'), data.get('longitude'))
+        
+        request_id = run_write(insert, key=session['user_id'], shard=shard)
+        
+        return jsonify({
+            'message': 'Request created successfully',
+            'request_id': request_id
+        }), 201
             
+    except Exception as e:
+        return db_error_response(e)
+
+# Historique (base principale et archive)
+@app.route('/exchanges', methods=['GET'])
+@login_required
+def get_exchanges():
+    """Historique des échanges de l'utilisateur, archives comprises
+
+    Paramètres : status, limit (50 par défaut, 200 max), before_id pour paginer
+    """
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    conditions = ['(e.requester_id = ? OR e.provider_id = ?)']
+    params = [session['user_id'], session['user_id']]
+
+    if request.args.get('status'):
+        conditions.append('e.status = ?')
+        params.append(request.args['status'])
+    if request.args.get('before_id', type=int):
+        conditions.append('e.id < ?')
+        params.append(request.args.get('before_id', type=int))
+
+    def source_sql(conn):
+        return f'''
+            SELECT * FROM {archive.union_source(conn, 'exchanges')} AS e
+            WHERE {' AND '.join(conditions)}
+            ORDER BY e.id DESC
+            LIMIT ?
+        '''
+
+    try:
+        if shard_router is not None:
+            exchanges = fan_out_read(source_sql, params + [limit], ('id',), reverse=True, limit=limit, history=True)
+        else:
+            exchanges = run_read(lambda conn: conn.execute(source_sql(conn), params + [limit]).fetchall(), history=True)
+    except Exception as e:
+        return db_error_response(e)
+
+    return jsonify({
+        'exchanges': [dict(ex) for ex in exchanges]
+    })
+
+@app.route('/exchanges/<int:exchange_id>/messages', methods=['GET'])
+@login_required
+def get_exchange_messages(exchange_id):
+    """Messages d'un échange, archives comprises
+
+    Paramètres : after_id pour paginer, limit (100 par défaut, 500 max)
+    """
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    after_id = request.args.get('after_id', 0, type=int)
+
+    user_id = session['user_id']
+
+    def fetch(conn):
+        exchange = conn.execute(f'''
+            SELECT requester_id, provider_id FROM {archive.union_source(conn, 'exchanges')} AS e
+            WHERE e.id = ?
+        ''', (exchange_id,)).fetchone()
+
+        if not exchange or user_id not in (exchange['requester_id'], exchange['provider_id']):
+            return None
+
+        return conn.execute(f'''
+            SELECT * FROM {archive.union_source(conn, 'messages')} AS m
+            WHERE m.exchange_id = ? AND m.id > ?
+            ORDER BY m.id
+            LIMIT ?
+        ''', (exchange_id, after_id, limit)).fetchall()
+
+    try:
+        messages = run_read(fetch, history=True, shard=shard_for_id(exchange_id))
+    except shards.ShardError:
+        messages = None
+    except Exception as e:
+        return db_error_response(e)
+
+    if messages is None:
+        return jsonify({'error': 'Exchange not found'}), 404
+
+    return jsonify({
+        'exchange_id': exchange_id,
+        'messages': [dict(msg) for msg in messages]
+    })
+
+# Exports NDJSON (requêtes scopées à l'utilisateur connecté, archives comprises)
+EXPORT_QUERIES = {
+    'requests': (
+        'SELECT * FROM {requests} AS r WHERE r.user_id = :user_id ORDER BY r.id'
+    ),
+    'exchanges': (
+        'SELECT * FROM {exchanges} AS e '
+        'WHERE e.requester_id = :user_id OR e.provider_id = :user_id ORDER BY e.id'
+    ),
+    'messages': (
+        'SELECT m.* FROM {messages} AS m JOIN {exchanges} AS e ON m.exchange_id = e.id '
+        'WHERE e.requester_id = :user_id OR e.provider_id = :user_id ORDER BY m.id'
+    )
+}
+
+@app.route('/export/<kind>.ndjson', methods=['GET'])
+@login_required
+def export_ndjson(kind):
+    """Export complet des demandes, échanges ou messages de l'utilisateur"""
+    template = EXPORT_QUERIES.get(kind)
+    if not template:
+        return jsonify({'error': 'Unknown export'}), 404
+
+    def source_sql(conn):
+        return template.format(**{
+            table: archive.union_source(conn, table)
+            for table in ('requests', 'exchanges', 'messages')
+        })
+
+    params = {'user_id': session['user_id']}
+    if shard_router is not None:
+        # Un échange et ses messages sont toujours dans le même shard
+        chunks = shard_router.fan_out(
+            source_sql, params, ('id',), chunk_size=app.config['STREAM_CHUNK_SIZE'],
+            connect=get_history_db, run=db_offload.call
+        )
+        body = streaming.ndjson_chunks(chunks)
+    else:
+        # Connexion ouverte et fermée par le générateur : rien ne fuit si le
+        # client coupe avant le début de l'envoi
+        body = streaming.ndjson_stream(
+            get_history_db, source_sql, params, app.config['STREAM_CHUNK_SIZE'], run=db_offload.call
+        )
+
+    response = Response(stream_with_context(body), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.ndjson'
+    return response
+
+# Synchronisation différentielle (application hors ligne)
+@app.route('/sync', methods=['GET'])
+@login_required
+def sync_changes():
+    """Lignes créées, modifiées ou supprimées depuis le jeton since
+
+    Paramètres : since (jeton de la réponse précédente, vide au premier appel),
+    limit (SYNC_BATCH_SIZE par défaut, SYNC_MAX_BATCH max). Réponse : changes
+    {table: [lignes]}, deleted {table: [ids]}, token, has_more. Appliquer
+    deleted avant changes, puis rappeler avec token tant que has_more est vrai.
+    reset=true : jeton trop ancien, vider le cache local et repartir sans since.
+    Les lignes archivées sont signalées comme supprimées.
+    """
+    try:
+        positions = sync.decode_token(request.args.get('since', ''))
+    except sync.SyncTokenError as e:
+        return jsonify({'error': str(e)}), 400
+
+    limit = max(1, min(
+        request.args.get('limit', app.config['SYNC_BATCH_SIZE'], type=int),
+        app.config['SYNC_MAX_BATCH']
+    ))
+    user_id = session['user_id']
+    result = {'changes': {}, 'deleted': {}, 'has_more': False}
+
+    try:
+        for shard in database_targets(include_directory=True):
+            name = shard or 'main'
+            remaining = limit - sum(len(rows) for rows in result['changes'].values()) \
+                - sum(len(ids) for ids in result['deleted'].values())
+            if remaining <= 0:
+                result['has_more'] = True
+                break
+
+            since = positions.get(name, 0)
+            batch = run_read(lambda conn: sync.read_changes(conn, since, user_id, remaining), shard=shard)
+            if batch['reset']:
+                return jsonify({'reset': True, 'token': ''})
+
+            for key in ('changes', 'deleted'):
+                for table, items in batch[key].items():
+                    result[key].setdefault(table, []).extend(items)
+            positions[name] = batch['seq']
+            result['has_more'] = result['has_more'] or batch['has_more']
+    except Exception as e:
+        return db_error_response(e)
+
+    result['token'] = sync.encode_token(positions)
+    result['reset'] = False
+    return jsonify(result)
+
+def prune_change_log():
+    """Purge les pierres tombales plus anciennes que SYNC_TOMBSTONE_DAYS"""
+    before = _days_ago(app.config['SYNC_TOMBSTONE_DAYS'])
+    return sum(
+        run_write(lambda conn: sync.prune(conn, before), shard=shard)
+        for shard in database_targets(include_directory=True)
+    )
+
+# Paiements (webhooks Stripe)
+@app.route('/webhooks/stripe', methods=['POST'])
+def stripe_webhook():
+    """Reçoit un événement Stripe : signature vérifiée, inscription, réponse immédiate
+
+    Le traitement est fait par process_payment_webhooks ; un événement déjà
+    reçu est acquitté sans être inscrit une seconde fois.
+    """
+    secret = app.config.get('STRIPE_WEBHOOK_SECRET')
+    if not secret:
+        return jsonify({'error': 'Webhooks not configured'}), 404
+
+    payload = request.get_data()
+    try:
+        payments.verify_signature(
+            payload, request.headers.get('Stripe-Signature'), secret,
+            tolerance=app.config['STRIPE_WEBHOOK_TOLERANCE']
+        )
+        event_id, event_type = payments.parse_event(payload)
+    except payments.SignatureError as e:
+        return jsonify({'error': str(e)}), 400
+    except ValueError:
+        return jsonify({'error': 'Invalid payload'}), 400
+
+    raw = payload.decode('utf-8')
+    try:
+        created = run_write(lambda conn: payments.record_event(conn, event_id, event_type, raw))
+    except Exception as e:
+        # 503 : Stripe renverra l'événement plus tard
+        return db_error_response(e)
+    return jsonify({'received': True, 'duplicate': not created})
+
+def process_payment_webhooks():
+    """Traite les événements reçus par lots, puis reporte les montants sur les échanges
+
+    Les lots s'enchaînent tant qu'ils sont pleins et sans erreur ; un événement
+    en erreur n'est repris qu'après son délai (next_attempt_at).
+    """
+    batch_size, max_attempts = app.config['WEBHOOK_BATCH_SIZE'], app.config['WEBHOOK_MAX_ATTEMPTS']
+    backoff = app.config['WEBHOOK_RETRY_BACKOFF']
+    counts = {}
+    while True:
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        batch = run_write(lambda conn: payments.process_batch(conn, batch_size, max_attempts, now, backoff))
+        for status, n in batch.items():
+            counts[status] = counts.get(status, 0) + n
+        if sum(batch.values()) < batch_size or batch.get('error'):
+            break
+        socketio.sleep(0)
+
+    # Seconde étape : les échanges peuvent être dans un shard
+    updated, missing = payments.sync_exchange_totals(
+        run_read, lambda fn, shard: run_write(fn, shard=shard), shard_for_id, batch_size
+    )
+    if missing:
+        app.logger.warning(f'Paiements pour des échanges inconnus : {missing}')
+    counts['exchanges'] = updated
+
+    before = _days_ago(app.config['WEBHOOK_RETENTION_DAYS'])
+    run_write(lambda conn: payments.purge(conn, before))
+    return counts
+
+# Présence
+def flush_presence():
+    """Écrit en un seul lot les dernières activités accumulées"""
+    presence_registry.heartbeat()
+    # drain() hors du job d'écriture : le job peut s'exécuter dans un thread natif
+    pending = presence_registry.drain()
+    try:
+        return run_write(lambda conn: presence_registry.write(conn, pending))
+    except Exception:
+        # Réécrites au prochain passage ; UPDATE idempotent si le lot a tout de même abouti
+        presence_registry.restore(pending)
+        raise
+
+# Expiration des demandes
+def expire_requests():
+    """Passe les demandes échues au statut 'expired' et prévient leurs auteurs"""
+    expired = []
+    for shard in database_targets():
+        expired.extend(expiry.expire_overdue_requests(
+            lambda fn: run_write(fn, shard=shard),
+            batch_size=app.config['EXPIRY_BATCH_SIZE'],
+            pause=lambda: socketio.sleep(0)
+        ))
+
+    for row in expired:
+        socketio.emit('notification', {
+            'type': 'request_expired',
+            'request_id': row['id'],
+            'title': row['title']
+        }, room=f"user_{row['user_id']}")
+    return len(expired)
+
+# Archivage des données froides
+def _days_ago(days):
+    return (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def _run_maintenance(fn, *args):
+    """Appel SQLite de maintenance dans le pool d'exécution, sans délai maximal
+
+    Sauvegardes et VACUUM utilisent leur propre connexion (API de sauvegarde et
+    VACUUM sont impossibles dans une transaction de l'écrivain) : hors de la
+    boucle eventlet, en concurrence ordinaire avec l'écrivain.
+    """
+    return db_offload.call(fn, *args, timeout=0)
+
+def archive_cold_data():
+    """Déplace les données froides vers l'archive puis rend une partie de l'espace libéré
+
+    En mode partitionné, chaque shard a sa propre base d'archive.
+    """
+    totals = {}
+    for shard in database_targets():
+        # Lots déplacés par le chemin d'écriture ordinaire (écrivain unique en mode file)
+        moved = archive.run_archival(
+            lambda fn: run_write(fn, shard=shard),
+            _archive_path(shard),
+            cutoff=_days_ago(app.config['ARCHIVE_AFTER_DAYS']),
+            messages_cutoff=_days_ago(app.config['ARCHIVE_MESSAGES_AFTER_DAYS']),
+            batch_size=app.config['ARCHIVE_BATCH_SIZE'],
+            pause=lambda: socketio.sleep(0)
+        )
+        if any(moved.values()):
+            conn = get_db() if shard is None else shard_router.connect(shard)
+            try:
+                _run_maintenance(archive.vacuum, conn, app.config['INCREMENTAL_VACUUM_PAGES'])
+            finally:
+                conn.close()
+        for table, count in moved.items():
+            totals[table] = totals.get(table, 0) + count
+    return totals
+
+def vacuum_database():
+    """VACUUM complet périodique de la base principale (et des shards)"""
+    for shard in database_targets(include_directory=True):
+        conn = get_db() if shard is None else shard_router.connect(shard)
+        try:
+            # Opération longue : exécutée dans un thread natif, sans délai maximal
+            db_offload.call(archive.vacuum, conn, timeout=0)
+        finally:
+            conn.close()
+
+# Emails
+def deliver_mail():
+    """Envoie les emails échus de la file (digests fusionnés) et purge les anciens
+
+    Les résultats sont enregistrés en une transaction à la fin du passage ; les
+    envois SMTP coopèrent avec eventlet (sockets patchées par le worker).
+    """
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    batch_size, app_name = app.config['MAIL_BATCH_SIZE'], app.config['APP_NAME']
+    messages = run_read(lambda conn: mailer.due_messages(conn, now, batch_size, app_name))
+    if messages:
+        sender = mailer.sender_address(app_name, app.config['MAIL_DEFAULT_SENDER'] or 'noreply@localhost')
+        sent, failed, server_error = mailer.deliver(messages, mail_pool, sender)
+        backoff, max_attempts = app.config['MAIL_RETRY_BACKOFF'], app.config['MAIL_MAX_ATTEMPTS']
+        run_write(lambda conn: mailer.record_results(conn, now, sent, failed, backoff, max_attempts))
+        for _, error, permanent in failed:
+            app.logger.warning(f"Email {'refusé' if permanent else 'reporté'} : {error}")
+        if server_error:
+            app.logger.warning(f'Serveur SMTP indisponible, envoi interrompu : {server_error}')
+    before = _days_ago(app.config['MAIL_RETENTION_DAYS'])
+    run_write(lambda conn: mailer.purge(conn, before))
+    return len(messages)
+
+# Sauvegardes
+def backup_dir(shard=None):
+    """Répertoire des sauvegardes de la base principale ou d'un shard"""
+    if shard is None:
+        return app.config['BACKUP_DIR']
+    return os.path.join(app.config['BACKUP_DIR'], 'shards', shard)
+
+def backup_database(full=False):
+    """Sauvegarde en ligne, compressée dans le pool de processus
+
+    En mode partitionné, chaque shard est sauvegardé dans son propre
+    répertoire ; leurs résultats sont regroupés sous 'shards'.
+    """
+    results = {}
+    for shard in database_targets(include_directory=True):
+        # Copie page à page, delta et rotation dans un thread du pool : la pause
+        # entre deux paquets de pages y est un sommeil natif
+        results[shard] = _run_maintenance(lambda: backup.run_backup(
+            app.config['DATABASE_PATH'] if shard is None else shard_router.shard_path(shard),
+            backup_dir(shard),
+            get_process_pool(),
+            incremental=app.config['BACKUP_INCREMENTAL'] and not full,
+            full_every=app.config['BACKUP_FULL_EVERY'],
+            retention=app.config['BACKUP_RETENTION'],
+            pages_per_step=app.config['BACKUP_PAGES_PER_STEP'],
+            pause=lambda: time.sleep(app.config['BACKUP_STEP_PAUSE'])
+        ))
+
+    result = results.pop(None)
+    if shard_router is not None:
+        result['shards'] = results
+    return result
+
+@app.route('/admin/backup', methods=['POST'])
+@admin_required
+def admin_backup():
+    """Lancer une sauvegarde puis vérifier qu'elle se restaure"""
+    try:
+        result = backup_database(full=request.args.get('full') == '1')
+        checked = [(None, result)] + list(result.get('shards', {}).items())
+        for shard, shard_result in checked:
+            _, shard_result['integrity_check'] = _run_maintenance(
+                backup.verify, backup_dir(shard), shard_result['name']
+            )
+        healthy = all(shard_result['integrity_check'] == 'ok' for _, shard_result in checked)
+        return jsonify(result), 201 if healthy else 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/admin/metrics', methods=['GET'])
+@admin_required
+def admin_metrics():
+    """Métriques d'accès à la base (pool d'exécution, écrivain unique) et d'envoi des emails"""
+    return jsonify({
+        'db_offload': db_offload.snapshot(),
+        'db_writer': dict(db_writer.stats, depth=db_writer.depth, mode=app.config['WRITE_MODE']),
+        'shard_writers': {
+            shard: dict(writer.stats, depth=writer.depth)
+            for shard, writer in shard_writers.items()
+        },
+        'mail': dict(mail_pool.stats, enabled=app.config['MAIL_ENABLED'], test_mode=app.config['MAIL_TEST_MODE'])
+    })
+
+@app.cli.command('backup')
+@click.option('--full', is_flag=True, help='Forcer une sauvegarde complète')
+def backup_command(full):
+    """Sauvegarde en ligne de la base"""
+    result = backup_database(full=full)
+    for shard, shard_result in [(None, result)] + list(result.get('shards', {}).items()):
+        prefix = f'[{shard}] ' if shard else ''
+        click.echo(f"{prefix}{shard_result['name']} ({shard_result['type']}, {shard_result['size']} octets)")
+        for name in shard_result['removed']:
+            click.echo(f'{prefix}Supprimée : {name}')
+
+@app.cli.command('backup-verify')
+@click.argument('name', required=False)
+@click.option('--shard', help='Sauvegardes d\'un shard plutôt que de la base principale')
+def backup_verify_command(name, shard):
+    """Restaure une sauvegarde en temporaire et vérifie son intégrité"""
+    try:
+        verified, integrity = backup.verify(backup_dir(shard), name)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{verified}: {integrity}')
+    if integrity != 'ok':
+        raise SystemExit(1)
+
+@app.cli.command('restore')
+@click.argument('target')
+@click.argument('name', required=False)
+@click.option('--shard', help='Sauvegardes d\'un shard plutôt que de la base principale')
+def restore_command(target, name, shard):
+    """Reconstruit la base dans TARGET (application arrêtée, puis remplacer le fichier)"""
+    try:
+        restored = backup.restore(backup_dir(shard), target, name)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{restored} restaurée dans {target}')
+
+@app.cli.command('mail-test')
+@click.argument('recipient')
+def mail_test_command(recipient):
+    """Met un email de test en file puis lance un passage d'envoi"""
+    run_write(lambda conn: mailer.enqueue(
+        conn, recipient, f"{app.config['APP_NAME']} : email de test", 'La configuration SMTP fonctionne.'
+    ))
+    click.echo(f'{deliver_mail()} email(s) traité(s)')
+    mail_pool.close()
+
+@app.cli.command('webhook-retry')
+def webhook_retry_command():
+    """Remet en attente les webhooks en échec puis lance un traitement"""
+    requeued = run_write(lambda conn: conn.execute(
+        "UPDATE webhook_inbox SET status = 'pending', attempts = 0, next_attempt_at = NULL WHERE status = 'failed'"
+    ).rowcount)
+    click.echo(f'{requeued} événement(s) remis en attente : {process_payment_webhooks()}')
+
+# Partitionnement : outils d'exploitation
+def _require_sharding():
+    if shard_router is None:
+        raise click.ClickException('SHARDING_ENABLED is not set')
+
+@app.cli.command('shard-list')
+def shard_list_command():
+    """Régions, shard de chacune et nombre de demandes"""
+    _require_sharding()
+    for region, (idx, shard) in sorted(shard_router.regions().items(), key=lambda item: item[1][0]):
+        low, high = shards.id_range(idx)
+        conn = shard_router.connect(shard)
+        try:
+            count = conn.execute(
+                'SELECT COUNT(*) FROM requests WHERE id > ? AND id <= ?', (low, high)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        click.echo(f'{region}\t{shard}\t{count}')
+
+@app.cli.command('shard-move')
+@click.argument('region')
+@click.argument('shard')
+@click.option('--settle', type=float, help='Attente avant la seconde passe (SHARD_MAP_REFRESH par défaut)')
+def shard_move_command(region, shard, settle):
+    """Déplace REGION vers le fichier SHARD (à lancer en période creuse)"""
+    _require_sharding()
+    delay = app.config['SHARD_MAP_REFRESH'] if settle is None else settle
+    try:
+        totals = shard_router.move_region(region, shard, settle=lambda: time.sleep(delay))
+    except shards.ShardError as e:
+        raise click.ClickException(str(e))
+    click.echo(', '.join(f'{table}: {count}' for table, count in totals.items()))
+    click.echo(f'Facettes : {reconcile_facets()} compteur(s) corrigé(s)')
+
+@app.cli.command('shard-migrate')
+def shard_migrate_command():
+    """Répartit dans les shards les données d'une base non partitionnée (application arrêtée)"""
+    _require_sharding()
+    try:
+        totals = shard_router.migrate(archive_path=app.config['ARCHIVE_DATABASE_PATH'])
+    except shards.ShardError as e:
+        raise click.ClickException(str(e))
+    click.echo(', '.join(f'{table}: {count}' for table, count in totals.items()))
+    click.echo(f'Facettes : {reconcile_facets()} compteur(s) corrigé(s)')
+
+# Tâches de fond
+scheduler = Scheduler(sleep=socketio.sleep, lock=LeaderLock(app.config['SCHEDULER_LOCK_PATH']))
+scheduler.every(app.config['PRESENCE_FLUSH_INTERVAL'], flush_presence)
+scheduler.every(app.config['EXPIRY_INTERVAL'], expire_requests, leader_only=True)
+scheduler.every(app.config['ARCHIVE_INTERVAL'], archive_cold_data, leader_only=True)
+scheduler.every(app.config['VACUUM_INTERVAL'], vacuum_database, leader_only=True)
+scheduler.every(app.config['SYNC_PRUNE_INTERVAL'], prune_change_log, leader_only=True)
+scheduler.every(app.config['FACET_RECONCILE_INTERVAL'], reconcile_facets, leader_only=True)
+if app.config['STRIPE_WEBHOOK_SECRET']:
+    scheduler.every(app.config['WEBHOOK_INTERVAL'], process_payment_webhooks, leader_only=True)
+if app.config['MAIL_ENABLED']:
+    scheduler.every(app.config['MAIL_INTERVAL'], deliver_mail, leader_only=True)
+if app.config['BACKUP_ENABLED']:
+    scheduler.every(app.config['BACKUP_INTERVAL'], backup_database, leader_only=True)
+
+_background_started = False
+
+def start_background_tasks():
+    """Démarre le planificateur du worker (une seule fois)"""
+    global _background_started
+    if _background_started or not app.config['SCHEDULER_ENABLED']:
+        return
+    _background_started = True
+    socketio.start_background_task(scheduler.run)
+
+@app.before_request
+def _ensure_background_tasks():
+    start_background_tasks()
+
+@app.route('/presence/exchanges/<int:exchange_id>', methods=['GET'])
+@login_required
+def get_exchange_presence(exchange_id):
+    """Participants d'un échange actuellement en ligne"""
+    try:
+        exchange = run_read(lambda conn: conn.execute(
+            'SELECT requester_id, provider_id FROM exchanges WHERE id = ?',
+            (exchange_id,)
+        ).fetchone(), shard=shard_for_id(exchange_id))
+    except shards.ShardError:
+        exchange = None
+    except Exception as e:
+        return db_error_response(e)
+
+    if not exchange or session['user_id'] not in (exchange['requester_id'], exchange['provider_id']):
+        return jsonify({'error': 'Exchange not found'}), 404
+
+    return jsonify({
+        'exchange_id': exchange_id,
+        'online': presence_registry.online_in_exchange(exchange_id)
+    })
+
+@app.route('/presence/area', methods=['GET'])
+@login_required
+def get_area_presence():
+    """Utilisateurs en ligne dans la cellule géographique d'un point"""
+    cell = grid_cell(
+        request.args.get('lat', type=float),
+        request.args.get('lon', type=float),
+        app.config['GEO_CELL_SIZE']
+    )
+    if not cell:
+        return jsonify({'error': 'lat and lon are required'}), 400
+
+    online = presence_registry.online_in_cell(cell)
+    return jsonify({
+        'cell': cell,
+        'count': len(online),
+        'online': online
+    })
+
 # WebSocket events
 @socketio.on('connect')
 def handle_connect():
     """Connexion WebSocket"""
     if 'user_id' in session:
         join_room(f"user_{session['user_id']}")
+        start_background_tasks()
+
+        # Lecture seule : la cellule sert aux requêtes « qui est en ligne ici »
+        user_id = session['user_id']
+        user = run_read(lambda conn: conn.execute(
+            'SELECT latitude, longitude FROM users WHERE id = ?',
+            (user_id,)
+        ).fetchone())
+        cell = grid_cell(user['latitude'], user['longitude'], app.config['GEO_CELL_SIZE']) if user else None
+        presence_registry.connect(session['user_id'], request.sid, cell)
+
         emit('connected', {'message': 'Connected successfully'})
     else:
         emit('error', {'message': 'Authentication required'})
@@ -488,6 +1669,7 @@ def handle_disconnect():
     """Déconnexion WebSocket"""
     if 'user_id' in session:
         leave_room(f"user_{session['user_id']}")
+        presence_registry.disconnect(session['user_id'], request.sid)
 
 @socketio.on('join_exchange')
 def handle_join_exchange(data):
@@ -499,6 +1681,7 @@ def handle_join_exchange(data):
     exchange_id = data.get('exchange_id')
     if exchange_id:
         join_room(f"exchange_{exchange_id}")
+        presence_registry.join_exchange(session['user_id'], int(exchange_id))
         emit('joined_exchange', {'exchange_id': exchange_id})
 
 @socketio.on('send_message')
@@ -508,38 +1691,52 @@ def handle_message(data):
         emit('error', {'message': 'Authentication required'})
         return
     
+    presence_registry.touch(session['user_id'])
+    
+    # La session n'est pas accessible depuis le thread qui exécute la requête
+    user_id = session['user_id']
+    
+    def insert(conn):
+        # En mode partitionné, le message prend la région de son échange
+        message_id = None
+        if shard_router is not None:
+            message_id = shards.allocate_id(conn, 'messages', shards.region_index(data['exchange_id']))
+        return conn.execute('''
+            INSERT INTO messages (id, exchange_id, sender_id, content, message_type)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (
+            message_id,
+            data['exchange_id'],
+            user_id,
+            data['content'],
+            data.get('message_type', 'text')
+        )).lastrowid
+    
     try:
-        with get_db() as conn:
-            # Insérer le message
-            cursor = conn.execute('''
-                INSERT INTO messages (exchange_id, sender_id, content, message_type)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                data['exchange_id'],
-                session['user_id'],
-                data['content'],
-                data.get('message_type', 'text')
-            ))
-            
-            message_id = cursor.lastrowid
-            
-            # Obtenir les infos du sender
-            sender = conn.execute(
-                'SELECT username, full_name FROM users WHERE id = ?',
-                (session['user_id'],)
-            ).fetchone()
-            
-            # Émettre le message à tous les participants
-            socketio.emit('new_message', {
-                'id': message_id,
-                'exchange_id': data['exchange_id'],
-                'sender_id': session['user_id'],
-                'sender_name': sender['full_name'],
-                'content': data['content'],
-                'message_type': data.get('message_type', 'text'),
-                'created_at': datetime.utcnow().isoformat()
-            }, room=f"exchange_{data['exchange_id']}")
+        # Insérer le message
+        message_id = run_write(insert, key=user_id, shard=shard_for_id(data['exchange_id']))
+        
+        # Obtenir les infos du sender
+        sender = run_read(lambda conn: conn.execute(
+            'SELECT username, full_name FROM users WHERE id = ?',
+            (user_id,)
+        ).fetchone())
+        
+        # Émettre le message à tous les participants
+        socketio.emit('new_message', {
+            'id': message_id,
+            'exchange_id': data['exchange_id'],
+            'sender_id': user_id,
+            'sender_name': sender['full_name'],
+            'content': data['content'],
+            'message_type': data.get('message_type', 'text'),
+            'created_at': datetime.utcnow().isoformat()
+        }, room=f"exchange_{data['exchange_id']}")
             
+    except shards.ShardError:
+        emit('error', {'message': 'Exchange not found'})
+    except (WriterBusy, OffloadTimeout):
+        emit('error', {'message': 'Database busy, please retry'})
     except Exception as e:
         emit('error', {'message': str(e)})
 
@@ -548,6 +1745,10 @@ def handle_message(data):
 def not_found(error):
     return jsonify({'error': 'Endpoint not found'}), 404
 
+@app.errorhandler(413)
+def payload_too_large(error):
+    return jsonify({'error': 'File too large'}), 413
+
 @app.errorhandler(500)
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
@@ -557,6 +1758,9 @@ def create_application():
     """Factory function pour créer l'application Flask"""
     return create_app()[0]
 
+# Dernières activités non encore écrites à l'arrêt du processus
+atexit.register(flush_presence)
+
 if __name__ == '__main__':
     # Mode développement local
     port = int(os.environ.get('PORT', 5000))
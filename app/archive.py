@@ -0,0 +1,190 @@
+"""
+Archivage des données froides dans une base SQLite séparée
+
+Les échanges terminés, les demandes closes et les vieux messages sont déplacés
+vers une base d'archive attachée (`archive`) : les B-trees et le cache de pages
+de la base principale ne contiennent plus que les données vivantes.
+
+Chaque lot est une transaction « INSERT OR IGNORE dans l'archive puis DELETE
+dans la base principale », confiée au chemin d'écriture ordinaire (l'écrivain
+unique en mode file d'attente) : un archivage interrompu reprend simplement au
+lot suivant. Les endpoints d'historique lisent les deux bases via union_source().
+
+Pour la synchronisation différentielle, une ligne archivée est supprimée des
+tables vivantes : les clients la reçoivent dans `deleted` (voir sync.py).
+"""
+
+ARCHIVE_SCHEMA = 'archive'
+
+# Index utiles aux lectures d'historique
+ARCHIVE_INDEXES = {
+    'requests': ['user_id'],
+    'exchanges': ['requester_id', 'provider_id', 'request_id'],
+    'messages': ['exchange_id']
+}
+
+
+def table_columns(conn, table, schema='main'):
+    """Colonnes d'une table, dans l'ordre de déclaration : [(nom, type)]"""
+    return [(row[1], row[2]) for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def is_attached(conn):
+    return any(row[1] == ARCHIVE_SCHEMA for row in conn.execute('PRAGMA database_list'))
+
+
+def attach(conn, archive_path, ensure_schema=True):
+    """Attache la base d'archive
+
+    ensure_schema crée ou complète ses tables : inutile pour une simple lecture
+    d'historique, l'archive étant toujours créée par le job d'archivage.
+    """
+    if not is_attached(conn):
+        conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (archive_path,))
+    if not ensure_schema:
+        return
+
+    for table, indexed in ARCHIVE_INDEXES.items():
+        columns = table_columns(conn, table)
+        definitions = ', '.join(
+            f'{name} INTEGER PRIMARY KEY' if name == 'id' else f'{name} {col_type}'
+            for name, col_type in columns
+        )
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.{table} ({definitions})')
+
+        # Colonnes ajoutées à la base principale depuis la création de l'archive
+        archived = {name for name, _ in table_columns(conn, table, ARCHIVE_SCHEMA)}
+        for name, col_type in columns:
+            if name not in archived:
+                conn.execute(f'ALTER TABLE {ARCHIVE_SCHEMA}.{table} ADD COLUMN {name} {col_type}')
+
+        for column in indexed:
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_{table}_{column} '
+                f'ON {table}({column})'
+            )
+
+
+def union_source(conn, table):
+    """Source SQL couvrant la table principale et son archive si elle est attachée
+
+    À utiliser dans un FROM : « SELECT ... FROM {source} AS t ».
+    """
+    if not is_attached(conn):
+        return f'main.{table}'
+    columns = ', '.join(name for name, _ in table_columns(conn, table))
+    return (
+        f'(SELECT {columns} FROM main.{table} '
+        f'UNION ALL SELECT {columns} FROM {ARCHIVE_SCHEMA}.{table})'
+    )
+
+
+def move_rows(conn, table, ids):
+    """Déplace des lignes vers l'archive (une transaction, rejouable)"""
+    if not ids:
+        return 0
+    columns = ', '.join(name for name, _ in table_columns(conn, table))
+    placeholders = ','.join('?' * len(ids))
+    conn.execute(
+        f'INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.{table} ({columns}) '
+        f'SELECT {columns} FROM main.{table} WHERE id IN ({placeholders})',
+        ids
+    )
+    conn.execute(f'DELETE FROM main.{table} WHERE id IN ({placeholders})', ids)
+    return len(ids)
+
+
+def _ids(conn, sql, params):
+    return [row[0] for row in conn.execute(sql, params)]
+
+
+def archive_exchanges(conn, cutoff, batch_size):
+    """Échanges terminés ou annulés avant cutoff, avec tous leurs messages"""
+    ids = _ids(conn, '''
+        SELECT id FROM main.exchanges
+        WHERE status IN ('completed', 'cancelled') AND updated_at < ?
+        ORDER BY id LIMIT ?
+    ''', (cutoff, batch_size))
+    if not ids:
+        return 0
+
+    placeholders = ','.join('?' * len(ids))
+    message_ids = _ids(conn, f'SELECT id FROM main.messages WHERE exchange_id IN ({placeholders})', ids)
+    move_rows(conn, 'messages', message_ids)
+    return move_rows(conn, 'exchanges', ids)
+
+
+def archive_requests(conn, cutoff, batch_size):
+    """Demandes closes avant cutoff et sans échange encore vivant"""
+    ids = _ids(conn, '''
+        SELECT r.id FROM main.requests r
+        WHERE r.status IN ('completed', 'cancelled', 'expired') AND r.updated_at < ?
+          AND NOT EXISTS (SELECT 1 FROM main.exchanges e WHERE e.request_id = r.id)
+        ORDER BY r.id LIMIT ?
+    ''', (cutoff, batch_size))
+    return move_rows(conn, 'requests', ids)
+
+
+def archive_messages(conn, cutoff, batch_size):
+    """Messages antérieurs à cutoff, même dans les échanges en cours"""
+    ids = _ids(conn, '''
+        SELECT id FROM main.messages WHERE created_at < ? ORDER BY id LIMIT ?
+    ''', (cutoff, batch_size))
+    return move_rows(conn, 'messages', ids)
+
+
+def run_archival(write, archive_path, cutoff, messages_cutoff, batch_size=500, max_batches=100,
+                 pause=None):
+    """Archive les données froides par lots ; retourne le nombre de lignes déplacées par table
+
+    write(fn) exécute fn(conn) dans une transaction d'écriture et retourne son
+    résultat, un lot par appel. ATTACH étant impossible dans une transaction,
+    la connexion d'écriture a déjà l'archive attachée (écrivain unique) ou
+    est neuve (mode direct, où le job l'attache avant tout DML).
+
+    Les échanges passent avant les demandes : une demande n'est archivée
+    qu'une fois tous ses échanges partis. pause s'exécute entre les lots,
+    dans l'appelant.
+    """
+    def job(step, step_cutoff):
+        def run(conn):
+            if not is_attached(conn):
+                attach(conn, archive_path)
+            return step(conn, step_cutoff, batch_size)
+        return run
+
+    steps = [
+        ('exchanges', archive_exchanges, cutoff),
+        ('requests', archive_requests, cutoff),
+        ('messages', archive_messages, messages_cutoff)
+    ]
+    totals = {}
+
+    for name, step, step_cutoff in steps:
+        totals[name] = 0
+        for _ in range(max_batches):
+            moved = write(job(step, step_cutoff))
+            totals[name] += moved
+            if moved < batch_size:
+                break
+            if pause:
+                pause()
+
+    return totals
+
+
+def vacuum(conn, pages=None):
+    """Rend l'espace libéré par l'archivage
+
+    Avec pages, effectue un vacuum incrémental borné. Sinon effectue un VACUUM
+    complet, en passant d'abord la base en auto_vacuum=INCREMENTAL (ce réglage
+    ne prend effet qu'après un VACUUM).
+    """
+    if pages is not None:
+        if conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] == 2:
+            conn.execute(f'PRAGMA main.incremental_vacuum({int(pages)})').fetchall()
+        return
+
+    conn.commit()
+    conn.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM main')
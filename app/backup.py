@@ -0,0 +1,259 @@
+"""
+Sauvegarde en ligne de la base SQLite
+
+Les sauvegardes utilisent l'API de backup de SQLite (sqlite3.Connection.backup)
+par paquets de pages : la copie est cohérente même pendant les écritures, et
+une pause entre deux paquets laisse passer les autres transactions.
+
+Deux types de fichiers, compressés en gzip dans un processus séparé :
+    timelocal-<date>.full.db.gz     image complète de la base
+    timelocal-<date>.inc.delta.gz   pages modifiées depuis la sauvegarde précédente
+
+Une sauvegarde complète et les incrémentales qui la suivent forment une chaîne ;
+la rotation conserve les N chaînes les plus récentes. La dernière image est
+gardée non compressée (last_snapshot.db) pour calculer la prochaine delta.
+Chaque delta porte l'empreinte SHA-256 de l'image à laquelle elle s'applique :
+une sauvegarde manquante ou altérée dans la chaîne fait échouer la restauration
+au lieu de produire une base incohérente.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import zlib
+from datetime import datetime
+
+DELTA_MAGIC = b'TLDELTA2'
+# Format sans empreinte de la base, encore accepté à la restauration
+LEGACY_DELTA_MAGIC = b'TLDELTA1'
+LAST_SNAPSHOT = 'last_snapshot.db'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class BackupError(Exception):
+    """Sauvegarde introuvable ou illisible"""
+
+
+def snapshot(db_path, dest_path, pages_per_step=256, pause=None):
+    """Copie cohérente de la base vers dest_path, paquet de pages par paquet"""
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(dest_path)
+
+    def progress(status, remaining, total):
+        if pause and remaining:
+            pause()
+
+    try:
+        src.backup(dst, pages=pages_per_step, progress=progress)
+    finally:
+        dst.close()
+        src.close()
+
+
+def page_size(path):
+    """Taille de page lue dans l'en-tête du fichier SQLite"""
+    with open(path, 'rb') as f:
+        header = f.read(100)
+    size = struct.unpack('>H', header[16:18])[0]
+    return 65536 if size == 1 else size
+
+
+def file_digest(path):
+    """Empreinte SHA-256 d'un fichier, lu par blocs"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def write_delta(base_path, new_path, delta_path):
+    """Écrit les pages de new_path qui diffèrent de base_path ; retourne leur nombre"""
+    size = page_size(new_path)
+    page_count = os.path.getsize(new_path) // size
+    changed = 0
+
+    with open(base_path, 'rb') as base, open(new_path, 'rb') as new, open(delta_path, 'wb') as out:
+        out.write(DELTA_MAGIC + struct.pack('>II', size, page_count) + file_digest(base_path))
+        for page_no in range(page_count):
+            page = new.read(size)
+            if base.read(size) != page:
+                out.write(struct.pack('>I', page_no) + page)
+                changed += 1
+
+    return changed
+
+
+def apply_delta(target_path, delta_file):
+    """Applique une delta (objet fichier déjà décompressé) à une image de base
+
+    Lève BackupError si l'image n'est pas celle dont la delta a été calculée
+    (sauvegarde intermédiaire manquante) ou si la delta est tronquée.
+    """
+    magic = delta_file.read(len(DELTA_MAGIC))
+    if magic not in (DELTA_MAGIC, LEGACY_DELTA_MAGIC):
+        raise BackupError('Invalid delta file')
+    header = delta_file.read(8)
+    if len(header) < 8:
+        raise BackupError('Truncated delta file')
+    size, page_count = struct.unpack('>II', header)
+    if magic == DELTA_MAGIC and delta_file.read(32) != file_digest(target_path):
+        raise BackupError('Delta does not apply to this base: a backup of the chain is missing or altered')
+
+    with open(target_path, 'r+b') as target:
+        while True:
+            raw = delta_file.read(4)
+            if not raw:
+                break
+            page = delta_file.read(size)
+            if len(raw) < 4 or len(page) < size:
+                raise BackupError('Truncated delta file')
+            target.seek(struct.unpack('>I', raw)[0] * size)
+            target.write(page)
+        target.truncate(page_count * size)
+
+
+def compress_file(src_path, dest_path):
+    """Compresse un fichier par blocs (exécutée dans le pool de processus)"""
+    tmp_path = dest_path + '.tmp'
+    with open(src_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    os.replace(tmp_path, dest_path)
+    return os.path.getsize(dest_path)
+
+
+def list_backups(backup_dir):
+    """Sauvegardes présentes, de la plus ancienne à la plus récente : [(nom, type)]"""
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in sorted(os.listdir(backup_dir)):
+        if name.endswith('.full.db.gz'):
+            backups.append((name, 'full'))
+        elif name.endswith('.inc.delta.gz'):
+            backups.append((name, 'inc'))
+    return backups
+
+
+def chains(backup_dir):
+    """Regroupe les sauvegardes en chaînes [complète, incrémentale, ...]"""
+    result = []
+    for name, kind in list_backups(backup_dir):
+        if kind == 'full':
+            result.append([name])
+        elif result:
+            result[-1].append(name)
+    return result
+
+
+def rotate(backup_dir, retention):
+    """Supprime les chaînes au-delà des retention plus récentes"""
+    removed = []
+    for chain in chains(backup_dir)[:-retention] if retention > 0 else []:
+        for name in chain:
+            os.unlink(os.path.join(backup_dir, name))
+            removed.append(name)
+    return removed
+
+
+def run_backup(db_path, backup_dir, executor, incremental=True, full_every=24,
+               retention=7, pages_per_step=256, pause=None):
+    """Effectue une sauvegarde et retourne sa description
+
+    executor reçoit la compression (pool de processus) ; une sauvegarde
+    complète est forcée sans image précédente ou après full_every incrémentales.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    tmp_snapshot = os.path.join(backup_dir, f'.snapshot-{stamp}.db')
+    last_snapshot = os.path.join(backup_dir, LAST_SNAPSHOT)
+
+    snapshot(db_path, tmp_snapshot, pages_per_step, pause)
+
+    current_chain = chains(backup_dir)[-1] if chains(backup_dir) else []
+    use_delta = (
+        incremental
+        and current_chain
+        and len(current_chain) <= full_every
+        and os.path.exists(last_snapshot)
+        and page_size(last_snapshot) == page_size(tmp_snapshot)
+    )
+
+    raw_delta = None
+    try:
+        if use_delta:
+            raw_delta = tmp_snapshot + '.delta'
+            changed = write_delta(last_snapshot, tmp_snapshot, raw_delta)
+            name = f'timelocal-{stamp}.inc.delta.gz'
+            source = raw_delta
+        else:
+            changed = None
+            name = f'timelocal-{stamp}.full.db.gz'
+            source = tmp_snapshot
+
+        compressed_size = executor.submit(compress_file, source, os.path.join(backup_dir, name)).result()
+        os.replace(tmp_snapshot, last_snapshot)
+    finally:
+        for path in (raw_delta, tmp_snapshot):
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+    return {
+        'name': name,
+        'type': 'inc' if use_delta else 'full',
+        'changed_pages': changed,
+        'size': compressed_size,
+        'removed': rotate(backup_dir, retention)
+    }
+
+
+def restore(backup_dir, target_path, name=None):
+    """Reconstruit la base à la date d'une sauvegarde (la plus récente par défaut)
+
+    Lève BackupError si une sauvegarde de la chaîne est introuvable ou illisible.
+    """
+    for chain in reversed(chains(backup_dir)):
+        if name is None or name in chain:
+            selected = chain if name is None else chain[:chain.index(name) + 1]
+            break
+    else:
+        raise BackupError(f'Backup not found: {name}')
+
+    current = selected[0]
+    try:
+        with gzip.open(os.path.join(backup_dir, current), 'rb') as src, open(target_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+        for current in selected[1:]:
+            with gzip.open(os.path.join(backup_dir, current), 'rb') as delta_file:
+                apply_delta(target_path, delta_file)
+    except BackupError as e:
+        raise BackupError(f'{current}: {e}') from e
+    except (OSError, EOFError, zlib.error) as e:
+        # gzip tronqué ou altéré (CRC), fichier disparu
+        raise BackupError(f'{current}: unreadable backup ({e})') from e
+
+    return selected[-1]
+
+
+def verify(backup_dir, name=None):
+    """Restaure une sauvegarde dans un fichier temporaire et lance PRAGMA integrity_check
+
+    Retourne (nom vérifié, résultat) ; le résultat vaut 'ok' si la base est saine.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=backup_dir)
+    os.close(fd)
+    try:
+        restored = restore(backup_dir, tmp_path, name)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            rows = conn.execute('PRAGMA integrity_check').fetchall()
+        finally:
+            conn.close()
+        return restored, '; '.join(row[0] for row in rows)
+    finally:
+        os.unlink(tmp_path)
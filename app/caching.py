@@ -0,0 +1,59 @@
+"""
+Versions de données pour les requêtes conditionnelles (ETag / 304)
+
+Chaque table suivie possède un compteur dans `table_versions`, incrémenté par
+des triggers à chaque écriture. Lire ces compteurs coûte une recherche par clé
+primaire : on sait si un flux a changé sans exécuter la requête qui le produit.
+"""
+
+import hashlib
+
+# Tables suivies -> trigger(s) qui incrémentent leur compteur
+VERSIONED_TABLES = {
+    'requests': ('INSERT', 'UPDATE', 'DELETE'),
+    # Seules les colonnes affichées dans le flux des demandes comptent
+    'users': ('UPDATE OF username, full_name, rating, profile_picture',)
+}
+
+
+def schema_sql(tables=None):
+    """Table des versions et triggers associés (tables : sous-ensemble de VERSIONED_TABLES)"""
+    statements = ['''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+    ''']
+
+    for table, events in VERSIONED_TABLES.items():
+        if tables is not None and table not in tables:
+            continue
+        statements.append(
+            f"INSERT OR IGNORE INTO table_versions (name, version) VALUES ('{table}', 0);"
+        )
+        for event in events:
+            trigger = f"trg_{table}_version_{event.split()[0].lower()}"
+            statements.append(f'''
+                CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                END;
+            ''')
+
+    return '\n'.join(statements)
+
+
+def data_version(conn, tables):
+    """Retourne les compteurs des tables demandées, dans l'ordre donné"""
+    placeholders = ','.join('?' * len(tables))
+    rows = dict(conn.execute(
+        f'SELECT name, version FROM table_versions WHERE name IN ({placeholders})',
+        tuple(tables)
+    ).fetchall())
+    return tuple(rows.get(table, 0) for table in tables)
+
+
+def make_etag(*parts):
+    """ETag opaque calculée à partir des versions et des paramètres de la requête"""
+    raw = '|'.join(p.decode('utf-8', 'replace') if isinstance(p, bytes) else str(p) for p in parts)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
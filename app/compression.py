@@ -0,0 +1,104 @@
+"""
+Compression négociée (gzip / brotli) des réponses JSON
+
+Brotli est optionnel : sans le module `brotli`, seul gzip est proposé.
+Les réponses envoyées en flux sont compressées morceau par morceau.
+"""
+
+import zlib
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    brotli = None
+
+
+def available_encodings():
+    """Encodages proposés, par ordre de préférence"""
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def not_modified(etag):
+    """Réponse 304 si If-None-Match désigne etag ou l'une de ses variantes compressées, None sinon
+
+    La 304 reprend l'ETag reconnue (suffixe d'encodage compris) et l'en-tête
+    Vary de la réponse 200 : un cache ne la confond pas avec une autre variante.
+    """
+    for tag in [etag] + [f'{etag}-{enc}' for enc in available_encodings()]:
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def _compressor(encoding, config):
+    if encoding == 'br':
+        return brotli.Compressor(quality=config['COMPRESS_BR_LEVEL'])
+    # wbits=31 : en-tête et somme de contrôle gzip
+    return zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+
+
+def compress(data, encoding, config):
+    """Compresse un corps complet"""
+    compressor = _compressor(encoding, config)
+    if encoding == 'br':
+        return compressor.process(data) + compressor.finish()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, config):
+    """Compresse un corps envoyé en flux sans l'accumuler"""
+    compressor = _compressor(encoding, config)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if encoding == 'br':
+            out = compressor.process(chunk)
+        else:
+            # Z_SYNC_FLUSH pour que le client reçoive chaque morceau sans attendre la fin
+            out = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    yield compressor.finish() if encoding == 'br' else compressor.flush()
+
+
+def init_app(app):
+    """Enregistre la compression des réponses sur l'application"""
+
+    @app.after_request
+    def compress_response(response):
+        config = app.config
+
+        if response.status_code < 200 or response.status_code >= 300 or response.status_code == 204:
+            return response
+        if response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+        if response.mimetype not in config['COMPRESS_MIMETYPES']:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(available_encodings())
+        if not encoding:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, config)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding, config))
+
+        response.headers['Content-Encoding'] = encoding
+
+        # Une ETag forte doit différer selon l'encodage du corps
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak=weak)
+
+        return response
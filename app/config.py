@@ -12,6 +12,40 @@ class Config:
     # Base de données
     DATABASE_PATH = os.environ.get('DATABASE_PATH') or 'timelocal.db'
     DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+    DATABASE_BUSY_TIMEOUT = float(os.environ.get('DATABASE_BUSY_TIMEOUT') or 5)  # secondes
+    
+    # Écritures : 'direct' (chaque requête écrit) ou 'queue' (écrivain unique par processus)
+    WRITE_MODE = os.environ.get('WRITE_MODE') or 'direct'
+    WRITE_QUEUE_SIZE = int(os.environ.get('WRITE_QUEUE_SIZE') or 1000)
+    WRITE_QUEUE_PER_CLIENT = int(os.environ.get('WRITE_QUEUE_PER_CLIENT') or 20)
+    WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE') or 50)  # jobs par transaction
+    WRITE_TIMEOUT = float(os.environ.get('WRITE_TIMEOUT') or 10)  # secondes
+    
+    # Appels SQLite hors de la boucle eventlet : 'auto', 'tpool', 'threads' ou 'inline'
+    # DB_OFFLOAD_WORKERS ne doit pas dépasser EVENTLET_THREADPOOL_SIZE (20 par défaut)
+    DB_OFFLOAD_MODE = os.environ.get('DB_OFFLOAD_MODE') or 'auto'
+    DB_OFFLOAD_WORKERS = int(os.environ.get('DB_OFFLOAD_WORKERS') or 10)
+    READ_TIMEOUT = float(os.environ.get('READ_TIMEOUT') or 5)  # secondes, attente comprise
+    
+    # Partitionnement géographique : demandes, échanges et messages par région,
+    # utilisateurs dans la base principale (annuaire)
+    SHARDING_ENABLED = os.environ.get('SHARDING_ENABLED', 'False').lower() == 'true'
+    SHARD_DIR = os.environ.get('SHARD_DIR') or 'shards'
+    SHARD_GRID_SIZE = float(os.environ.get('SHARD_GRID_SIZE') or 1.0)  # degrés (~110 km)
+    SHARD_MAP_REFRESH = int(os.environ.get('SHARD_MAP_REFRESH') or 30)  # secondes
+    
+    # Synchronisation différentielle (GET /sync)
+    SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE') or 500)  # entrées du journal par appel
+    SYNC_MAX_BATCH = int(os.environ.get('SYNC_MAX_BATCH') or 2000)
+    SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS') or 30)
+    SYNC_PRUNE_INTERVAL = int(os.environ.get('SYNC_PRUNE_INTERVAL') or 3600)  # secondes
+    
+    # Facettes du flux (GET /requests/facets) : compteurs tenus par triggers
+    FACET_CELL_SIZE = float(os.environ.get('FACET_CELL_SIZE') or 0.1)  # degrés (~11 km)
+    FACET_RECONCILE_INTERVAL = int(os.environ.get('FACET_RECONCILE_INTERVAL') or 6 * 3600)  # secondes
+    
+    # Administration (endpoints /admin/*, désactivés sans jeton)
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
     
     # Application
     APP_NAME = 'TimeLocal'
@@ -22,11 +56,31 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or 'uploads'
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE') or 64 * 1024)  # octets
+    THUMBNAIL_SIZES = [int(s) for s in (os.environ.get('THUMBNAIL_SIZES') or '128,512').split(',')]
+    THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY') or 80)
+    MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS') or 2)
+    MEDIA_MAX_AGE = 365 * 24 * 3600  # URLs adressées par contenu : cache immuable
+    
+    # Assets statiques construits par static_assets.py
+    PUBLIC_HTML_DIST = os.environ.get('PUBLIC_HTML_DIST') or \
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public_html', 'dist')
+    STATIC_MAX_AGE = 365 * 24 * 3600  # noms empreintes uniquement
+    
+    # Listes volumineuses (réponses JSON en flux)
+    STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE') or 200)  # lignes par fetchmany
+    STREAM_MAX_ROWS = int(os.environ.get('STREAM_MAX_ROWS') or 10000)
     
     # Stripe (Paiements)
     STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY')
     STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
     STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+    STRIPE_WEBHOOK_TOLERANCE = int(os.environ.get('STRIPE_WEBHOOK_TOLERANCE') or 300)  # secondes
+    WEBHOOK_INTERVAL = int(os.environ.get('WEBHOOK_INTERVAL') or 5)  # secondes
+    WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE') or 100)  # événements par transaction
+    WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS') or 5)
+    WEBHOOK_RETRY_BACKOFF = int(os.environ.get('WEBHOOK_RETRY_BACKOFF') or 60)  # secondes, doublé à chaque échec
+    WEBHOOK_RETENTION_DAYS = int(os.environ.get('WEBHOOK_RETENTION_DAYS') or 90)  # événements traités
     
     # Twilio (SMS)
     TWILIO_SID = os.environ.get('TWILIO_SID')
@@ -41,12 +95,29 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or MAIL_USERNAME
     
+    # Envoi des emails (file d'attente SQLite, notifications regroupées en digest)
+    MAIL_ENABLED = os.environ.get('MAIL_ENABLED', 'False').lower() == 'true'
+    # Mode test : serveur local localhost:MAIL_SINK_PORT, sans TLS ni authentification
+    MAIL_TEST_MODE = os.environ.get('MAIL_TEST_MODE', 'False').lower() == 'true'
+    MAIL_SINK_PORT = int(os.environ.get('MAIL_SINK_PORT') or 1025)
+    MAIL_DIGEST_WINDOW = int(os.environ.get('MAIL_DIGEST_WINDOW') or 900)  # secondes
+    MAIL_INTERVAL = int(os.environ.get('MAIL_INTERVAL') or 30)  # secondes
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 200)  # entrées de la file par passage
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS') or 6)
+    MAIL_RETRY_BACKOFF = int(os.environ.get('MAIL_RETRY_BACKOFF') or 60)  # secondes, doublé à chaque échec
+    MAIL_TIMEOUT = int(os.environ.get('MAIL_TIMEOUT') or 30)  # secondes
+    MAIL_POOL_SIZE = int(os.environ.get('MAIL_POOL_SIZE') or 2)
+    MAIL_MAX_PER_CONNECTION = int(os.environ.get('MAIL_MAX_PER_CONNECTION') or 100)
+    MAIL_IDLE_TIMEOUT = int(os.environ.get('MAIL_IDLE_TIMEOUT') or 60)  # secondes
+    MAIL_RETENTION_DAYS = int(os.environ.get('MAIL_RETENTION_DAYS') or 7)  # emails envoyés
+    
     # Google Maps (optionnel)
     GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY')
     
     # Géolocalisation
     DEFAULT_RADIUS = int(os.environ.get('DEFAULT_RADIUS') or 5)  # km
     MAX_RADIUS = int(os.environ.get('MAX_RADIUS') or 50)  # km
+    GEO_CELL_SIZE = float(os.environ.get('GEO_CELL_SIZE') or 0.05)  # degrés (~5 km)
     
     # Sessions
     SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', 'False').lower() == 'true'
@@ -61,6 +132,12 @@ class Config:
     CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'simple'
     CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT') or 300)
     
+    # Compression des réponses JSON
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)  # gzip 1-9
+    COMPRESS_BR_LEVEL = int(os.environ.get('COMPRESS_BR_LEVEL') or 4)  # brotli 0-11
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)  # octets
+    COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson'}
+    
     # Rate limiting
     RATELIMIT_STORAGE_URL = os.environ.get('REDIS_URL') or 'memory://'
     RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT') or '100 per hour'
@@ -73,6 +150,37 @@ class Config:
     SOCKETIO_ASYNC_MODE = 'eventlet'
     SOCKETIO_CORS_ALLOWED_ORIGINS = CORS_ORIGINS
     
+    # Présence en ligne (redis://... pour partager entre workers)
+    PRESENCE_STORAGE_URL = os.environ.get('PRESENCE_STORAGE_URL') or os.environ.get('REDIS_URL') or 'memory://'
+    PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL') or 90)  # secondes
+    PRESENCE_FLUSH_INTERVAL = int(os.environ.get('PRESENCE_FLUSH_INTERVAL') or 30)  # secondes
+    
+    # Tâches de fond (un seul worker leader pour les tâches globales)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'True').lower() == 'true'
+    SCHEDULER_LOCK_PATH = os.environ.get('SCHEDULER_LOCK_PATH') or f'{DATABASE_PATH}.scheduler.lock'
+    EXPIRY_INTERVAL = int(os.environ.get('EXPIRY_INTERVAL') or 60)  # secondes
+    EXPIRY_BATCH_SIZE = int(os.environ.get('EXPIRY_BATCH_SIZE') or 200)
+    
+    # Archivage des données froides
+    ARCHIVE_DATABASE_PATH = os.environ.get('ARCHIVE_DATABASE_PATH') or \
+        os.path.splitext(DATABASE_PATH)[0] + '_archive.db'
+    ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL') or 3600)  # secondes
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 90)
+    ARCHIVE_MESSAGES_AFTER_DAYS = int(os.environ.get('ARCHIVE_MESSAGES_AFTER_DAYS') or 365)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 500)
+    INCREMENTAL_VACUUM_PAGES = int(os.environ.get('INCREMENTAL_VACUUM_PAGES') or 1000)
+    VACUUM_INTERVAL = int(os.environ.get('VACUUM_INTERVAL') or 7 * 24 * 3600)  # secondes
+    
+    # Sauvegardes en ligne (API backup de SQLite)
+    BACKUP_ENABLED = os.environ.get('BACKUP_ENABLED', 'True').lower() == 'true'
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or 'backups'
+    BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL') or 3600)  # secondes
+    BACKUP_INCREMENTAL = os.environ.get('BACKUP_INCREMENTAL', 'True').lower() == 'true'
+    BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY') or 24)  # incrémentales entre deux complètes
+    BACKUP_RETENTION = int(os.environ.get('BACKUP_RETENTION') or 7)  # chaînes conservées
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP') or 256)
+    BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE') or 0.01)  # secondes
+    
     # Gamification
     POINTS_PER_HOUR = int(os.environ.get('POINTS_PER_HOUR') or 10)
     DAILY_MISSION_REFRESH_HOUR = int(os.environ.get('DAILY_MISSION_REFRESH_HOUR') or 9)
@@ -0,0 +1,94 @@
+"""
+Expiration des demandes dont la date limite est dépassée
+
+Les demandes actives échues passent au statut 'expired' par petits lots, via
+l'index (status, deadline) : chaque transaction reste courte et ne bloque pas
+longtemps les autres écritures.
+"""
+
+from datetime import datetime, timezone
+
+from notifications import insert_notifications
+
+# Format de stockage de requests.deadline (comparable comme chaîne)
+DEADLINE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Migration des dates limites enregistrées telles quelles avant normalisation
+# ('2024-05-01T18:00:00', '...Z', '...+02:00') : datetime() de SQLite les
+# ramène au format de stockage en UTC. Idempotente, exécutée au démarrage ;
+# seules les demandes actives comptent pour l'expiration (index status, deadline).
+NORMALIZE_DEADLINES_SQL = '''
+    UPDATE requests SET deadline = datetime(deadline)
+    WHERE status = 'active' AND deadline IS NOT NULL AND deadline != datetime(deadline);
+'''
+
+
+def normalize_deadline(value):
+    """Convertit une date ISO 8601 au format de stockage UTC, ou lève ValueError
+
+    Une date sans fuseau est considérée comme déjà exprimée en UTC.
+    """
+    if value in (None, ''):
+        return None
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(DEADLINE_FORMAT)
+
+
+def expire_batch(conn, now, batch_size):
+    """Expire au plus batch_size demandes échues et notifie leurs auteurs
+
+    S'exécute dans la transaction de l'appelant (sans commit). Retourne les
+    demandes expirées sous forme de dicts (id, user_id, title).
+    """
+    rows = conn.execute('''
+        SELECT id, user_id, title FROM requests
+        WHERE status = 'active' AND deadline < ?
+        ORDER BY deadline
+        LIMIT ?
+    ''', (now, batch_size)).fetchall()
+
+    if not rows:
+        return []
+
+    ids = [row['id'] for row in rows]
+    placeholders = ','.join('?' * len(ids))
+    conn.execute(f'''
+        UPDATE requests
+        SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+        WHERE status = 'active' AND id IN ({placeholders})
+    ''', ids)
+
+    insert_notifications(conn, [
+        {
+            'user_id': row['user_id'],
+            'title': 'Demande expirée',
+            'message': f"Votre demande « {row['title']} » a dépassé sa date limite.",
+            'type': 'request_expired',
+            'data': {'request_id': row['id']}
+        }
+        for row in rows
+    ])
+    return [dict(row) for row in rows]
+
+
+def expire_overdue_requests(run_write, batch_size=200, max_batches=50, pause=None):
+    """Expire toutes les demandes échues, une transaction par lot
+
+    run_write(fn) exécute fn(conn) dans une transaction d'écriture. pause(),
+    si fourni, est appelé entre deux lots pour laisser passer les autres
+    écritures. Retourne la liste des demandes expirées.
+    """
+    now = datetime.utcnow().strftime(DEADLINE_FORMAT)
+    expired = []
+
+    for _ in range(max_batches):
+        rows = run_write(lambda conn: expire_batch(conn, now, batch_size))
+        expired.extend(rows)
+        if len(rows) < batch_size:
+            break
+        if pause:
+            pause()
+
+    return expired
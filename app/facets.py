@@ -0,0 +1,212 @@
+"""
+Compteurs de facettes du flux des demandes (catégorie, type, mode d'échange)
+
+`facet_counts` contient, pour chaque facette et valeur, le nombre de demandes
+actives : globalement (cell = '*') et par cellule de la grille géographique.
+Des triggers tiennent ces compteurs à jour à chaque insertion, changement de
+statut ou de champ et suppression ; afficher les facettes coûte alors une
+lecture par valeur au lieu d'un GROUP BY sur toutes les demandes actives.
+
+reconcile() recalcule les compteurs et corrige les écarts (dérive éventuelle,
+changement de taille de cellule) ; elle est exécutée périodiquement.
+"""
+
+from geo import grid_cell_sql
+
+FACET_COLUMNS = ('category', 'type', 'exchange_type')
+
+GLOBAL_CELL = '*'
+
+FACET_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS facet_counts (
+        facet TEXT NOT NULL,
+        value TEXT NOT NULL,
+        cell TEXT NOT NULL, -- '*' pour le total, sinon cellule « ligne:colonne »
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (facet, value, cell)
+    ) WITHOUT ROWID;
+'''
+
+TRIGGERS = ('trg_requests_facets_insert', 'trg_requests_facets_update', 'trg_requests_facets_delete')
+
+def _adjust(ref, delta, cell_size, guard='1'):
+    """Instructions ajustant de delta les compteurs de la ligne ref (NEW ou OLD) si guard"""
+    cell = grid_cell_sql(f'{ref}.latitude', f'{ref}.longitude', cell_size)
+    statements = []
+    for column in FACET_COLUMNS:
+        value = f"COALESCE({ref}.{column}, '')"
+        if delta > 0:
+            # Total, puis cellule si la demande est localisée (cellule NULL sinon)
+            for target in (f"'{GLOBAL_CELL}'", cell):
+                statements.append(f'''
+                    INSERT INTO facet_counts (facet, value, cell, count)
+                    SELECT '{column}', {value}, {target}, 1
+                    WHERE ({guard}) AND {target} IS NOT NULL
+                    ON CONFLICT (facet, value, cell) DO UPDATE SET count = count + 1;
+                ''')
+        else:
+            statements.append(f'''
+                UPDATE facet_counts SET count = count - 1
+                WHERE ({guard}) AND facet = '{column}' AND value = {value}
+                AND cell IN ('{GLOBAL_CELL}', {cell});
+            ''')
+    return ''.join(statements)
+
+
+def _triggers(cell_size):
+    """Définitions {nom: CREATE TRIGGER} ; la taille de cellule y est figée"""
+    return {
+        'trg_requests_facets_insert': f'''
+            CREATE TRIGGER trg_requests_facets_insert AFTER INSERT ON requests
+            WHEN NEW.status = 'active'
+            BEGIN
+                {_adjust('NEW', 1, cell_size)}
+            END
+        ''',
+        # Sortie puis entrée : couvre changement de statut, de valeur et de position
+        'trg_requests_facets_update': f'''
+            CREATE TRIGGER trg_requests_facets_update
+            AFTER UPDATE OF status, category, type, exchange_type, latitude, longitude ON requests
+            WHEN OLD.status = 'active' OR NEW.status = 'active'
+            BEGIN
+                {_adjust('OLD', -1, cell_size, "OLD.status = 'active'")}
+                {_adjust('NEW', 1, cell_size, "NEW.status = 'active'")}
+            END
+        ''',
+        'trg_requests_facets_delete': f'''
+            CREATE TRIGGER trg_requests_facets_delete AFTER DELETE ON requests
+            WHEN OLD.status = 'active'
+            BEGIN
+                {_adjust('OLD', -1, cell_size)}
+            END
+        '''
+    }
+
+
+def schema_sql(cell_size):
+    """Table des compteurs et triggers sur requests, créés s'ils manquent
+
+    Ne remplace pas des triggers existants : install() recrée ceux dont la
+    définition a changé (taille de cellule, code).
+    """
+    statements = [FACET_SCHEMA]
+    statements.extend(
+        sql.replace('CREATE TRIGGER', 'CREATE TRIGGER IF NOT EXISTS', 1) + ';'
+        for sql in _triggers(cell_size).values()
+    )
+    return '\n'.join(statements)
+
+
+def _expected(conn, cell_size):
+    """Compteurs recalculés : {(facet, value, cell): count}"""
+    cell = grid_cell_sql('latitude', 'longitude', cell_size)
+    expected = {}
+    for column in FACET_COLUMNS:
+        rows = conn.execute(f'''
+            SELECT COALESCE({column}, '') AS value, {cell} AS cell, COUNT(*) AS n
+            FROM requests WHERE status = 'active'
+            GROUP BY 1, 2
+        ''').fetchall()
+        for value, cell_id, n in rows:
+            total = (column, value, GLOBAL_CELL)
+            expected[total] = expected.get(total, 0) + n
+            if cell_id is not None:
+                expected[(column, value, cell_id)] = n
+    return expected
+
+
+def reconcile(conn, cell_size):
+    """Recalcule les compteurs et corrige les écarts (sans commit)
+
+    Retourne le nombre de compteurs corrigés. Les compteurs tombés à zéro sont
+    supprimés pour que la table reste proportionnelle aux valeurs présentes.
+    """
+    expected = _expected(conn, cell_size)
+    current = {
+        (facet, value, cell): count
+        for facet, value, cell, count in conn.execute('SELECT facet, value, cell, count FROM facet_counts')
+    }
+
+    stale = [key for key in current if key not in expected]
+    changed = [(count,) + key for key, count in expected.items() if current.get(key) != count]
+    conn.executemany('DELETE FROM facet_counts WHERE facet = ? AND value = ? AND cell = ?', stale)
+    conn.executemany('''
+        INSERT INTO facet_counts (count, facet, value, cell) VALUES (?, ?, ?, ?)
+        ON CONFLICT (facet, value, cell) DO UPDATE SET count = excluded.count
+    ''', changed)
+    # Les compteurs à zéro ne sont pas des écarts
+    drift = len(changed) + sum(1 for key in stale if current[key] != 0)
+    return drift
+
+
+def _normalized(sql):
+    return ' '.join(sql.split())
+
+
+def install(conn, cell_size):
+    """Crée compteurs et triggers ; recrée les seuls triggers dont la définition a changé
+
+    Le tout en une transaction : une écriture concurrente voit les anciens
+    triggers ou les nouveaux, jamais une table sans trigger. À la création de
+    la table ou après un changement de définition, les compteurs sont
+    recalculés dans la même transaction. Valide d'abord une éventuelle
+    transaction en cours (comme executescript). Retourne les triggers (re)créés.
+    """
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        created = conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'facet_counts'"
+        ).fetchone() is None
+        conn.execute(FACET_SCHEMA)
+
+        placeholders = ','.join('?' * len(TRIGGERS))
+        current = dict(conn.execute(
+            f"SELECT name, sql FROM main.sqlite_master WHERE type = 'trigger' AND name IN ({placeholders})",
+            TRIGGERS
+        ).fetchall())
+        changed = []
+        for name, sql in _triggers(cell_size).items():
+            if name in current and _normalized(current[name]) == _normalized(sql):
+                continue
+            # Schéma explicite : une connexion de shard a l'annuaire attaché
+            conn.execute(f'DROP TRIGGER IF EXISTS main.{name}')
+            conn.execute(sql)
+            changed.append(name)
+
+        if created or changed:
+            reconcile(conn, cell_size)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return changed
+
+
+def read_counts(conn, cell=None):
+    """Compteurs {facette: {valeur: nombre}} pour une cellule ou le total"""
+    rows = conn.execute(
+        'SELECT facet, value, count FROM facet_counts WHERE cell = ? AND count > 0',
+        (cell or GLOBAL_CELL,)
+    ).fetchall()
+    counts = {column: {} for column in FACET_COLUMNS}
+    for facet, value, count in rows:
+        counts.setdefault(facet, {})[value] = count
+    return counts
+
+
+def merge_counts(parts):
+    """Additionne les compteurs de plusieurs bases et les trie par nombre décroissant"""
+    totals = {column: {} for column in FACET_COLUMNS}
+    for part in parts:
+        for facet, values in part.items():
+            target = totals.setdefault(facet, {})
+            for value, count in values.items():
+                target[value] = target.get(value, 0) + count
+    return {
+        facet: [
+            {'value': value, 'count': count}
+            for value, count in sorted(values.items(), key=lambda item: (-item[1], item[0]))
+        ]
+        for facet, values in totals.items()
+    }
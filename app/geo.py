@@ -0,0 +1,27 @@
+"""
+Découpage géographique en cellules de grille
+
+Une cellule est un carré de `size` degrés ; son identifiant « ligne:colonne »
+est stable et calculable aussi bien en Python qu'en SQL.
+"""
+
+
+def grid_cell(latitude, longitude, size):
+    """Identifiant de la cellule contenant le point, ou None sans coordonnées
+
+    Les coordonnées sont décalées pour rester positives : la troncature
+    entière donne alors le même résultat qu'en SQL (CAST(... AS INTEGER)).
+    """
+    if latitude is None or longitude is None:
+        return None
+    row = int((float(latitude) + 90) / size)
+    col = int((float(longitude) + 180) / size)
+    return f'{row}:{col}'
+
+
+def grid_cell_sql(latitude, longitude, size):
+    """Expression SQL équivalente à grid_cell() (NULL sans coordonnées)"""
+    return (
+        f"CAST(({latitude} + 90) / {float(size)!r} AS INTEGER) || ':' || "
+        f"CAST(({longitude} + 180) / {float(size)!r} AS INTEGER)"
+    )
@@ -0,0 +1,309 @@
+"""
+Envoi des emails : file d'attente SQLite, digests par utilisateur, SMTP réutilisé
+
+Les emails à envoyer sont d'abord inscrits dans `mail_queue`, dans la même
+transaction que l'écriture qui les motive : rien n'est perdu si le processus
+s'arrête avant l'envoi. Les notifications y sont copiées par un trigger ; celles
+d'un même utilisateur partagent l'échéance de la première en attente et partent
+ensemble, en un seul email (digest), à la fin de la fenêtre.
+
+Le job d'envoi réutilise ses connexions SMTP d'un message à l'autre et d'un
+passage à l'autre (SMTPPool). Un échec temporaire repousse l'envoi avec un
+délai doublé à chaque tentative ; un refus définitif (code 5xx sur le
+destinataire ou le contenu) marque l'email en échec. Une panne du serveur
+SMTP arrête le passage sans compter de tentative.
+"""
+
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
+
+MAIL_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS mail_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER, -- destinataire connu : regroupement en digest
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'single', -- 'single' ou 'digest'
+        status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'sent', 'failed'
+        attempts INTEGER NOT NULL DEFAULT 0,
+        send_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_mail_queue_due ON mail_queue(status, send_after);
+    CREATE INDEX IF NOT EXISTS idx_mail_queue_user ON mail_queue(user_id, status);
+'''
+
+# Délai maximal entre deux tentatives : backoff * 2 ** MAX_BACKOFF_EXPONENT
+MAX_BACKOFF_EXPONENT = 10
+
+
+def schema_sql(digest_window=None):
+    """File d'attente ; avec digest_window (secondes), copie des notifications
+
+    Le trigger est recréé à chaque démarrage : la fenêtre y est figée, et il
+    disparaît si l'envoi des notifications par email est désactivé.
+    """
+    statements = [MAIL_SCHEMA, 'DROP TRIGGER IF EXISTS trg_notifications_mail;']
+    if digest_window is not None:
+        statements.append(f'''
+            CREATE TRIGGER trg_notifications_mail AFTER INSERT ON notifications
+            BEGIN
+                INSERT INTO mail_queue (user_id, recipient, subject, body, kind, send_after)
+                SELECT u.id, u.email, NEW.title, NEW.message, 'digest', COALESCE(
+                    (
+                        SELECT MIN(q.send_after) FROM mail_queue q
+                        WHERE q.user_id = u.id AND q.status = 'pending'
+                        AND q.kind = 'digest' AND q.attempts = 0
+                    ),
+                    datetime('now', '+{int(digest_window)} seconds')
+                )
+                FROM users u
+                WHERE u.id = NEW.user_id AND u.is_active AND COALESCE(u.email, '') <> '';
+            END;
+        ''')
+    return '\n'.join(statements)
+
+
+def enqueue(conn, recipient, subject, body, user_id=None):
+    """Inscrit un email envoyé seul, dès le prochain passage (sans commit)"""
+    return conn.execute('''
+        INSERT INTO mail_queue (user_id, recipient, subject, body, kind)
+        VALUES (?, ?, ?, ?, 'single')
+    ''', (user_id, recipient, subject, body)).lastrowid
+
+
+def due_messages(conn, now, limit, app_name):
+    """Emails à envoyer : [(ids, destinataire, sujet, corps)]
+
+    Lit au plus limit entrées échues ; les entrées 'digest' d'un même
+    destinataire sont fusionnées en un seul email.
+    """
+    rows = conn.execute('''
+        SELECT id, user_id, recipient, subject, body, kind FROM mail_queue
+        WHERE status = 'pending' AND send_after <= ?
+        ORDER BY send_after, id
+        LIMIT ?
+    ''', (now, limit)).fetchall()
+
+    messages, digests = [], {}
+    for row in rows:
+        if row['kind'] == 'digest':
+            digests.setdefault(row['recipient'], []).append(row)
+        else:
+            messages.append(([row['id']], row['recipient'], row['subject'], row['body']))
+
+    for recipient, items in digests.items():
+        ids = [item['id'] for item in items]
+        if len(items) == 1:
+            messages.append((ids, recipient, items[0]['subject'], items[0]['body']))
+            continue
+        subject = f'{app_name} : {len(items)} nouvelles notifications'
+        body = '\n\n'.join(f"• {item['subject']}\n{item['body']}" for item in items)
+        messages.append((ids, recipient, subject, body))
+    return messages
+
+
+def record_results(conn, now, sent, failed, backoff, max_attempts):
+    """Applique le résultat d'un passage (sans commit)
+
+    sent : ids envoyés ; failed : [(ids, erreur, définitif)]. Un échec
+    temporaire repousse l'entrée de backoff * 2 ** tentatives secondes.
+    """
+    if sent:
+        conn.executemany(
+            "UPDATE mail_queue SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+            [(now, mail_id) for mail_id in sent]
+        )
+    for ids, error, permanent in failed:
+        conn.executemany(f'''
+            UPDATE mail_queue
+            SET attempts = attempts + 1,
+                last_error = ?,
+                status = CASE WHEN ? OR attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                send_after = datetime(?, '+' || (? * (1 << MIN(attempts, {MAX_BACKOFF_EXPONENT}))) || ' seconds')
+            WHERE id = ?
+        ''', [(error[:500], permanent, max_attempts, now, int(backoff), mail_id) for mail_id in ids])
+
+
+def purge(conn, before):
+    """Supprime les emails envoyés avant before (sans commit)"""
+    return conn.execute(
+        "DELETE FROM mail_queue WHERE status = 'sent' AND sent_at < ?", (before,)
+    ).rowcount
+
+
+def is_message_error(error):
+    """Échec propre au message (destinataire ou contenu refusé)
+
+    Les autres erreurs (connexion, EHLO, authentification, expéditeur refusé,
+    déconnexion) concernent le serveur : les messages suivants échoueraient
+    de la même façon.
+    """
+    return isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError))
+
+
+def is_permanent(error):
+    """Refus définitif du message : code 5xx sur le destinataire ou le contenu"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPDataError):
+        return 500 <= error.smtp_code < 600
+    return False
+
+
+class SMTPPool:
+    """Connexions SMTP authentifiées réutilisées d'un message à l'autre
+
+    Une connexion est refermée après max_messages envois (limite fréquente
+    des serveurs) ou idle_timeout secondes sans usage ; après un court repos,
+    un NOOP vérifie qu'elle est encore ouverte avant de la réutiliser.
+    """
+
+    def __init__(self, host, port, use_tls=True, username=None, password=None,
+                 timeout=30, size=2, max_messages=100, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self._idle = []  # [(connexion, envois, dernier usage)]
+        self._lock = threading.Lock()
+        self.stats = {'connections': 0, 'sent': 0, 'errors': 0}
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.ehlo()
+            if self.use_tls:
+                conn.starttls()
+                conn.ehlo()
+            if self.username:
+                conn.login(self.username, self.password or '')
+        except Exception:
+            self._close(conn)
+            raise
+        self.stats['connections'] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    @staticmethod
+    def _alive(conn):
+        try:
+            return conn.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _acquire(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, count, last_used = self._idle.pop()
+            if now - last_used > self.idle_timeout:
+                self._close(conn)
+            elif now - last_used < 1 or self._alive(conn):
+                return conn, count
+            else:
+                conn.close()
+        return self._connect(), 0
+
+    def _release(self, conn, count):
+        with self._lock:
+            if count < self.max_messages and len(self._idle) < self.size:
+                self._idle.append((conn, count, time.monotonic()))
+                return
+        self._close(conn)
+
+    def send(self, message):
+        """Envoie un EmailMessage ; une connexion fermée par le serveur est rouverte une fois"""
+        for attempt in (1, 2):
+            try:
+                conn, count = self._acquire()
+            except Exception:
+                self.stats['errors'] += 1
+                raise
+            try:
+                conn.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                conn.close()
+                if attempt == 2 or count == 0:
+                    self.stats['errors'] += 1
+                    raise
+                continue
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # Refus du message : la connexion reste utilisable après RSET
+                self.stats['errors'] += 1
+                try:
+                    conn.rset()
+                except Exception:
+                    conn.close()
+                else:
+                    self._release(conn, count)
+                raise
+            except Exception:
+                conn.close()
+                self.stats['errors'] += 1
+                raise
+            self.stats['sent'] += 1
+            self._release(conn, count + 1)
+            return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+
+def build_message(sender, recipient, subject, body):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = recipient
+    message['Subject'] = subject
+    message['Message-ID'] = make_msgid(domain=sender.rpartition('@')[2] or None)
+    message.set_content(body)
+    return message
+
+
+def sender_address(name, address):
+    return formataddr((name, address)) if name else address
+
+
+def deliver(messages, pool, sender):
+    """Envoie les emails ; retourne (ids envoyés, [(ids, erreur, définitif)], erreur serveur)
+
+    Un refus propre au message est compté comme une tentative et l'envoi
+    continue. Une erreur du serveur (injoignable, EHLO, authentification...)
+    arrête le passage sans consommer de tentative : le message en cours et
+    les suivants restent en attente du prochain passage.
+    """
+    sent, failed = [], []
+    for ids, recipient, subject, body in messages:
+        try:
+            pool.send(build_message(sender, recipient, subject, body))
+        except (smtplib.SMTPException, OSError) as e:
+            error = f'{type(e).__name__}: {e}'
+            if not is_message_error(e):
+                return sent, failed, error
+            failed.append((ids, error, is_permanent(e)))
+            continue
+        sent.extend(ids)
+    return sent, failed, None
@@ -0,0 +1,144 @@
+"""
+Stockage des images envoyées par les utilisateurs
+
+Les fichiers sont adressés par leur empreinte SHA-256 : un même contenu n'est
+stocké qu'une seule fois, et son URL ne change jamais (cache immuable possible).
+
+Arborescence dans UPLOAD_FOLDER :
+    tmp/                          fichiers en cours de réception
+    originals/ab/<hash>.<ext>     fichiers d'origine
+    thumbs/ab/<hash>_<taille>.webp  miniatures
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+from PIL import Image, ImageOps
+
+# Format détecté par Pillow -> extension de stockage
+IMAGE_FORMATS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+    'WEBP': 'webp'
+}
+
+ORIGINAL_NAME_RE = re.compile(r'^([0-9a-f]{64})\.(jpg|png|gif|webp)$')
+THUMBNAIL_NAME_RE = re.compile(r'^([0-9a-f]{64})_(\d+)\.webp$')
+
+
+class UploadError(ValueError):
+    """Fichier refusé (vide, trop gros ou qui n'est pas une image valide)"""
+
+
+def original_path(upload_folder, content_hash, extension):
+    """Chemin du fichier d'origine pour une empreinte donnée"""
+    return os.path.join(upload_folder, 'originals', content_hash[:2], f'{content_hash}.{extension}')
+
+
+def thumbnail_path(upload_folder, content_hash, size):
+    """Chemin de la miniature WebP pour une empreinte et une taille données"""
+    return os.path.join(upload_folder, 'thumbs', content_hash[:2], f'{content_hash}_{size}.webp')
+
+
+def detect_format(path):
+    """Retourne l'extension de stockage d'une image, ou lève UploadError
+
+    Seul l'en-tête est lu : le contenu n'est pas décodé ici.
+    """
+    try:
+        with Image.open(path) as img:
+            image_format = img.format
+    except Exception:
+        raise UploadError('File is not a valid image')
+
+    extension = IMAGE_FORMATS.get(image_format)
+    if not extension:
+        raise UploadError(f'Unsupported image format: {image_format}')
+    return extension
+
+
+def store_upload(stream, upload_folder, chunk_size=64 * 1024, max_size=None):
+    """Enregistre un flux par blocs et le range sous son empreinte
+
+    Le contenu n'est jamais chargé entièrement en mémoire : chaque bloc est
+    haché puis écrit dans un fichier temporaire, renommé atomiquement à la fin.
+    Retourne (empreinte, extension, créé) ; créé vaut False si le contenu
+    existait déjà.
+    """
+    tmp_dir = os.path.join(upload_folder, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadError('File too large')
+                digest.update(chunk)
+                out.write(chunk)
+
+        if size == 0:
+            raise UploadError('Empty file')
+
+        extension = detect_format(tmp_path)
+        content_hash = digest.hexdigest()
+        final_path = original_path(upload_folder, content_hash, extension)
+
+        if os.path.exists(final_path):
+            os.unlink(tmp_path)
+            return content_hash, extension, False
+
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+        return content_hash, extension, True
+
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def make_thumbnails(upload_folder, content_hash, extension, sizes, quality=80):
+    """Génère les miniatures WebP manquantes d'une image
+
+    Exécutée dans le pool de processus : ne dépend que de ses arguments.
+    Retourne la liste des tailles générées.
+    """
+    source = original_path(upload_folder, content_hash, extension)
+    generated = []
+
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'P') else 'RGB')
+
+        for size in sizes:
+            target = thumbnail_path(upload_folder, content_hash, size)
+            if os.path.exists(target):
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            thumb = img.copy()
+            thumb.thumbnail((size, size))
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.webp')
+            os.close(fd)
+            try:
+                thumb.save(tmp_path, 'WEBP', quality=quality, method=4)
+                os.replace(tmp_path, target)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+            generated.append(size)
+
+    return generated
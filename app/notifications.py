@@ -0,0 +1,26 @@
+"""
+Création des notifications utilisateur
+"""
+
+import json
+
+
+def insert_notifications(conn, notifications):
+    """Insère un lot de notifications
+
+    Chaque notification est un dict avec user_id, title, message, type et
+    éventuellement data (sérialisé en JSON).
+    """
+    conn.executemany('''
+        INSERT INTO notifications (user_id, title, message, type, data)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (
+            n['user_id'],
+            n['title'],
+            n['message'],
+            n['type'],
+            json.dumps(n['data']) if n.get('data') is not None else None
+        )
+        for n in notifications
+    ])
@@ -0,0 +1,204 @@
+"""
+Exécution des appels SQLite hors de la boucle eventlet
+
+Sous eventlet, un appel sqlite3 est un appel C bloquant : tant qu'il dure, le
+hub est figé et aucun client WebSocket du worker ne reçoit de message. Les
+appels sont donc exécutés dans des threads natifs (eventlet.tpool), au plus
+max_workers à la fois, avec un délai maximal par appel.
+
+Hors eventlet (serveur de développement, CLI, scripts), un ThreadPoolExecutor
+joue le même rôle. Le mode 'inline' exécute les appels directement.
+
+Un appel expiré ne peut pas être arrêté de l'extérieur : run_query() interrompt
+alors la requête SQLite en cours (Connection.interrupt) pour libérer le thread.
+Jusqu'à ce que le thread natif termine, l'appel garde sa place dans le pool :
+des appels expirés en série ne peuvent pas dépasser max_workers threads.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+MODES = ('auto', 'tpool', 'threads', 'inline')
+
+
+class OffloadTimeout(Exception):
+    """Appel non terminé dans le délai imparti"""
+
+
+def eventlet_patched():
+    """Vrai si eventlet a remplacé les threads (worker Gunicorn eventlet)"""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
+
+
+class Offloader:
+    """Pool borné d'exécution des appels bloquants
+
+    timeout est le délai par défaut d'un appel (attente d'une place comprise) ;
+    un délai de 0 désactive la limite. Le mode 'auto' est résolu au premier
+    appel : le monkey patching d'eventlet a lieu après l'import du module.
+    """
+
+    def __init__(self, max_workers=10, timeout=10.0, mode='auto'):
+        if mode not in MODES:
+            raise ValueError(f'Unknown offload mode: {mode}')
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._mode = mode
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'saturated': 0,
+            'in_flight': 0,
+            'max_in_flight': 0,
+            'total_time': 0.0,
+            'max_time': 0.0
+        }
+
+    @property
+    def mode(self):
+        if self._mode == 'auto':
+            self._mode = 'tpool' if eventlet_patched() else 'threads'
+        return self._mode
+
+    def snapshot(self):
+        """Métriques du pool : compteurs, saturation et latence moyenne"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['mode'] = self.mode
+        stats['max_workers'] = self.max_workers
+        stats['avg_time'] = stats['total_time'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+    def call(self, fn, *args, timeout=None, on_timeout=None):
+        """Exécute fn(*args) dans le pool et retourne son résultat
+
+        Lève OffloadTimeout après timeout secondes (self.timeout par défaut) ;
+        on_timeout(), si fourni, est alors appelé pour interrompre le travail.
+        """
+        mode = self.mode
+        if mode == 'inline':
+            return fn(*args)
+
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        self._enter()
+        failed = False
+        try:
+            if mode == 'tpool':
+                return self._call_tpool(fn, args, timeout)
+            return self._call_threads(fn, args, timeout)
+        except OffloadTimeout:
+            failed = True
+            with self._lock:
+                self.stats['timeouts'] += 1
+            if on_timeout is not None:
+                try:
+                    on_timeout()
+                except Exception:
+                    logger.exception('Offload timeout handler failed')
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._leave(time.monotonic() - started, failed)
+
+    def run_query(self, connect, fn, timeout=None):
+        """Exécute fn(conn) sur une connexion ouverte et fermée dans le pool
+
+        fn doit lire tous ses résultats (fetchall) : la connexion est fermée au
+        retour. En cas de dépassement du délai, la requête SQLite est interrompue.
+        """
+        holder = {}
+
+        def job():
+            conn = connect()
+            holder['conn'] = conn
+            try:
+                return fn(conn)
+            finally:
+                holder.pop('conn', None)
+                conn.close()
+
+        def interrupt():
+            conn = holder.get('conn')
+            if conn is not None:
+                conn.interrupt()
+
+        return self.call(job, timeout=timeout, on_timeout=interrupt)
+
+    def _enter(self):
+        with self._lock:
+            if self.stats['in_flight'] >= self.max_workers:
+                self.stats['saturated'] += 1
+            self.stats['calls'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+
+    def _leave(self, elapsed, failed):
+        with self._lock:
+            self.stats['in_flight'] -= 1
+            self.stats['total_time'] += elapsed
+            self.stats['max_time'] = max(self.stats['max_time'], elapsed)
+            if failed:
+                self.stats['failed'] += 1
+
+    def _call_tpool(self, fn, args, timeout):
+        import eventlet
+        from eventlet import Timeout, tpool
+        from eventlet.semaphore import Semaphore
+
+        if self._slots is None:
+            self._slots = Semaphore(self.max_workers)
+
+        def worker():
+            # Greenlet propre au thread natif : rend la place quand celui-ci
+            # termine, même si l'appelant est déjà parti sur OffloadTimeout
+            try:
+                return True, tpool.execute(fn, *args)
+            except Exception as e:
+                return False, e
+            finally:
+                self._slots.release()
+
+        timer = Timeout(timeout or None, OffloadTimeout(f'Call exceeded {timeout}s'))
+        try:
+            self._slots.acquire()
+            ok, value = eventlet.spawn(worker).wait()
+        finally:
+            timer.cancel()
+        if not ok:
+            raise value
+        return value
+
+    def _call_threads(self, fn, args, timeout):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix='db-offload'
+                    )
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:
+            # Interpréteur en cours d'arrêt (callbacks atexit) : exécution directe
+            return fn(*args)
+        try:
+            return future.result(timeout=timeout or None)
+        except FutureTimeout:
+            # Sans effet sur un appel commencé : son thread reste occupé jusqu'au bout
+            future.cancel()
+            raise OffloadTimeout(f'Call exceeded {timeout}s') from None
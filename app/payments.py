@@ -0,0 +1,350 @@
+"""
+Webhooks de paiement Stripe : accusé de réception immédiat, traitement différé
+
+Le endpoint vérifie la signature, inscrit l'événement brut dans
+`webhook_inbox` (clé d'idempotence : fournisseur + identifiant de
+l'événement) et répond aussitôt : Stripe réessaie les livraisons lentes et
+une même livraison peut arriver plusieurs fois. Un job traite ensuite la
+boîte par lots, chaque événement dans son propre SAVEPOINT.
+
+Les paiements sont enregistrés dans `payments` (un par PaymentIntent) ;
+exchanges.amount_paid en est recalculé, jamais incrémenté : rejouer un
+événement ou reprendre après une panne donne le même montant. Les échanges
+pouvant être dans un shard, cette mise à jour est une seconde étape, suivie
+par payments.exchange_synced.
+
+Le remboursement d'un achat de crédits retire les crédits au prorata du
+montant remboursé (payments.credits_revoked). Si le solde ne les couvre
+plus, rien n'est retiré : le compte est signalé (users.credits_flagged) et
+le reste dû noté dans payments.credits_owed.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+
+from shards import ShardError
+
+PROVIDER = 'stripe'
+
+PAYMENTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS webhook_inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT NOT NULL,
+        event_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'processed', 'ignored', 'failed'
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        next_attempt_at TIMESTAMP, -- après une erreur : pas de nouvel essai avant
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        processed_at TIMESTAMP,
+        UNIQUE (provider, event_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, id);
+
+    CREATE TABLE IF NOT EXISTS payments (
+        intent_id TEXT PRIMARY KEY,
+        purpose TEXT NOT NULL, -- 'exchange' ou 'credits'
+        exchange_id INTEGER,
+        user_id INTEGER,
+        amount INTEGER NOT NULL DEFAULT 0, -- centimes
+        refunded INTEGER NOT NULL DEFAULT 0, -- centimes
+        credits INTEGER NOT NULL DEFAULT 0,
+        credits_revoked INTEGER NOT NULL DEFAULT 0, -- crédits retirés après remboursement
+        credits_owed INTEGER NOT NULL DEFAULT 0, -- crédits à retirer que le solde ne couvrait pas
+        currency TEXT,
+        status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'succeeded'
+        exchange_synced INTEGER NOT NULL DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_payments_exchange ON payments(exchange_id);
+    CREATE INDEX IF NOT EXISTS idx_payments_unsynced ON payments(exchange_synced) WHERE exchange_synced = 0;
+'''
+
+# Délai maximal entre deux essais d'un événement : backoff * 2 ** MAX_BACKOFF_EXPONENT
+MAX_BACKOFF_EXPONENT = 10
+
+
+class SignatureError(Exception):
+    """Signature de webhook absente, invalide ou trop ancienne"""
+
+
+def sign(payload, secret, timestamp=None):
+    """En-tête Stripe-Signature pour payload (bytes) : rejeu local et tests"""
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    signed = f'{timestamp}.'.encode('utf-8') + payload
+    digest = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={digest}'
+
+
+def verify_signature(payload, header, secret, tolerance=300, now=None):
+    """Vérifie l'en-tête Stripe-Signature (HMAC-SHA256 de « t.payload »)
+
+    Plusieurs signatures v1 peuvent coexister pendant une rotation du secret.
+    tolerance borne l'âge de l'horodatage (0 : pas de limite).
+    """
+    timestamp, signatures = None, []
+    for item in (header or '').split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        raise SignatureError('Malformed signature header')
+
+    expected = sign(payload, secret, int(timestamp)).rpartition('v1=')[2]
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise SignatureError('Signature mismatch')
+    now = time.time() if now is None else now
+    if tolerance and abs(now - int(timestamp)) > tolerance:
+        raise SignatureError('Timestamp outside tolerance')
+
+
+def parse_event(payload):
+    """(identifiant, type) d'un événement, ou ValueError"""
+    event = json.loads(payload)
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        raise ValueError('Invalid event')
+    return str(event['id']), str(event['type'])
+
+
+def record_event(conn, event_id, event_type, payload):
+    """Inscrit l'événement brut (sans commit) ; False si déjà reçu"""
+    return conn.execute('''
+        INSERT OR IGNORE INTO webhook_inbox (provider, event_id, type, payload)
+        VALUES (?, ?, ?, ?)
+    ''', (PROVIDER, event_id, event_type, payload)).rowcount == 1
+
+
+def _metadata_int(metadata, key):
+    value = metadata.get(key)
+    return int(value) if value not in (None, '') else None
+
+
+def _payment_succeeded(conn, obj):
+    metadata = obj.get('metadata') or {}
+    exchange_id = _metadata_int(metadata, 'exchange_id')
+    user_id = _metadata_int(metadata, 'user_id')
+    credits = _metadata_int(metadata, 'credits') or 0
+    if exchange_id is None and not (user_id and credits > 0):
+        raise ValueError('Payment without exchange_id or user_id/credits metadata')
+
+    previous = conn.execute(
+        'SELECT status FROM payments WHERE intent_id = ?', (obj['id'],)
+    ).fetchone()
+    conn.execute('''
+        INSERT INTO payments (intent_id, purpose, exchange_id, user_id, amount, credits, currency, status, exchange_synced)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'succeeded', ?)
+        ON CONFLICT (intent_id) DO UPDATE SET
+            purpose = excluded.purpose, exchange_id = excluded.exchange_id,
+            user_id = excluded.user_id, amount = excluded.amount,
+            credits = excluded.credits, currency = excluded.currency,
+            status = 'succeeded', exchange_synced = excluded.exchange_synced,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (
+        obj['id'],
+        'exchange' if exchange_id is not None else 'credits',
+        exchange_id,
+        user_id,
+        int(obj.get('amount_received') or obj.get('amount') or 0),
+        credits,
+        obj.get('currency'),
+        0 if exchange_id is not None else 1
+    ))
+
+    # Crédits accordés une seule fois, au premier succès du paiement
+    if exchange_id is None and (previous is None or previous['status'] != 'succeeded'):
+        updated = conn.execute(
+            'UPDATE users SET time_credits = time_credits + ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (credits, user_id)
+        ).rowcount
+        if not updated:
+            raise ValueError(f'Unknown user {user_id}')
+    if exchange_id is None:
+        # Remboursement reçu avant le paiement
+        _revoke_refunded_credits(conn, obj['id'])
+
+
+def _revoke_refunded_credits(conn, intent_id):
+    """Retire les crédits d'un achat remboursé, au prorata arrondi au supérieur
+
+    Le total à retirer est recalculé depuis le montant remboursé cumulé :
+    rejouer l'événement ne retire rien de plus. Solde insuffisant : compte
+    signalé, reste dû dans credits_owed.
+    """
+    payment = conn.execute('''
+        SELECT user_id, amount, refunded, credits, credits_revoked FROM payments
+        WHERE intent_id = ? AND purpose = 'credits' AND status = 'succeeded'
+    ''', (intent_id,)).fetchone()
+    if payment is None or payment['refunded'] <= 0 or payment['amount'] <= 0:
+        return
+    credits = payment['credits']
+    target = min(credits, -(-credits * payment['refunded'] // payment['amount']))
+    due = target - payment['credits_revoked']
+    if due <= 0:
+        return
+
+    debited = conn.execute('''
+        UPDATE users SET time_credits = time_credits - ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND time_credits >= ?
+    ''', (due, payment['user_id'], due)).rowcount
+    if debited:
+        conn.execute(
+            'UPDATE payments SET credits_revoked = ?, credits_owed = 0 WHERE intent_id = ?', (target, intent_id)
+        )
+        return
+    if not conn.execute(
+        'UPDATE users SET credits_flagged = TRUE, updated_at = CURRENT_TIMESTAMP WHERE id = ?', (payment['user_id'],)
+    ).rowcount:
+        raise ValueError(f"Unknown user {payment['user_id']}")
+    conn.execute('UPDATE payments SET credits_owed = ? WHERE intent_id = ?', (due, intent_id))
+
+
+def _charge_refunded(conn, obj):
+    intent_id = obj.get('payment_intent')
+    if not intent_id:
+        raise ValueError('Refund without payment_intent')
+    # amount_refunded est cumulatif : affecté, pas additionné
+    conn.execute('''
+        INSERT INTO payments (intent_id, purpose, refunded, currency)
+        VALUES (?, 'exchange', ?, ?)
+        ON CONFLICT (intent_id) DO UPDATE SET
+            refunded = MAX(refunded, excluded.refunded),
+            exchange_synced = CASE WHEN exchange_id IS NULL THEN 1 ELSE 0 END,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (intent_id, int(obj.get('amount_refunded') or 0), obj.get('currency')))
+    _revoke_refunded_credits(conn, intent_id)
+
+
+# Événements traités ; les autres sont marqués 'ignored'
+HANDLERS = {
+    'payment_intent.succeeded': _payment_succeeded,
+    'charge.refunded': _charge_refunded
+}
+
+
+def process_batch(conn, batch_size, max_attempts, now, backoff):
+    """Traite au plus batch_size événements en attente et échus à now (sans commit)
+
+    Chaque événement a son SAVEPOINT : un événement en erreur est annulé seul,
+    repoussé de backoff * 2 ** tentatives secondes, puis marqué 'failed' après
+    max_attempts. Retourne {statut: nombre}, 'error' pour les événements repoussés.
+    """
+    events = conn.execute('''
+        SELECT id, type, payload FROM webhook_inbox
+        WHERE status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+        ORDER BY id
+        LIMIT ?
+    ''', (now, batch_size)).fetchall()
+
+    counts = {}
+    for event in events:
+        handler = HANDLERS.get(event['type'])
+        conn.execute('SAVEPOINT webhook_event')
+        try:
+            if handler is not None:
+                handler(conn, json.loads(event['payload'])['data']['object'])
+            status, error = ('processed' if handler else 'ignored'), None
+            conn.execute('RELEASE webhook_event')
+        except Exception as e:
+            conn.execute('ROLLBACK TO webhook_event')
+            conn.execute('RELEASE webhook_event')
+            status, error = 'error', f'{type(e).__name__}: {e}'
+
+        if error is None:
+            conn.execute('''
+                UPDATE webhook_inbox SET status = ?, processed_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE id = ?
+            ''', (status, event['id']))
+        else:
+            conn.execute(f'''
+                UPDATE webhook_inbox
+                SET attempts = attempts + 1, last_error = ?,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                    next_attempt_at = datetime(?, '+' || (? * (1 << MIN(attempts, {MAX_BACKOFF_EXPONENT}))) || ' seconds')
+                WHERE id = ?
+            ''', (error[:500], max_attempts, now, int(backoff), event['id']))
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def unsynced_exchanges(conn, limit):
+    """Montants payés à reporter sur les échanges : {exchange_id: centimes}"""
+    rows = conn.execute('''
+        SELECT exchange_id, SUM(CASE WHEN status = 'succeeded' THEN amount - refunded ELSE 0 END)
+        FROM payments
+        WHERE exchange_id IN (
+            SELECT DISTINCT exchange_id FROM payments WHERE exchange_synced = 0 AND exchange_id IS NOT NULL LIMIT ?
+        )
+        GROUP BY exchange_id
+    ''', (limit,)).fetchall()
+    return {exchange_id: max(total, 0) for exchange_id, total in rows}
+
+
+def set_amount_paid(conn, amounts):
+    """Affecte les montants payés (centimes) aux échanges (sans commit) ; retourne les ids trouvés"""
+    found = []
+    for exchange_id, amount in amounts.items():
+        if conn.execute(
+            'UPDATE exchanges SET amount_paid = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (amount / 100, exchange_id)
+        ).rowcount:
+            found.append(exchange_id)
+    return found
+
+
+def mark_synced(conn, amounts):
+    """Marque reportés les paiements des échanges dont le total n'a pas changé depuis"""
+    for exchange_id, amount in amounts.items():
+        conn.execute('''
+            UPDATE payments SET exchange_synced = 1
+            WHERE exchange_id = ? AND (
+                SELECT MAX(SUM(CASE WHEN status = 'succeeded' THEN amount - refunded ELSE 0 END), 0)
+                FROM payments WHERE exchange_id = ?
+            ) = ?
+        ''', (exchange_id, exchange_id, amount))
+
+
+def sync_exchange_totals(read, write, locate, batch_size):
+    """Reporte sur les échanges les montants des paiements non encore reportés
+
+    read(fn) lit la base des paiements, write(fn, shard) écrit dans la base
+    d'un échange, locate(exchange_id) donne son shard (ShardError s'il n'en a
+    aucun). Un échange introuvable est tout de même marqué reporté : il ne
+    bloque pas les suivants. Retourne (nombre d'échanges mis à jour, ids introuvables).
+    """
+    updated, missing = 0, []
+    while True:
+        amounts = read(lambda conn: unsynced_exchanges(conn, batch_size))
+        if not amounts:
+            break
+        by_shard, unknown = {}, []
+        for exchange_id, amount in amounts.items():
+            try:
+                by_shard.setdefault(locate(exchange_id), {})[exchange_id] = amount
+            except ShardError:
+                unknown.append(exchange_id)
+        found = set()
+        for shard, shard_amounts in by_shard.items():
+            found.update(write(lambda conn: set_amount_paid(conn, shard_amounts), shard))
+        write(lambda conn: mark_synced(conn, amounts), None)
+        updated += len(found)
+        missing.extend(unknown)
+        missing.extend(exchange_id for ids in by_shard.values() for exchange_id in ids if exchange_id not in found)
+        if len(amounts) < batch_size:
+            break
+    return updated, sorted(missing)
+
+
+def purge(conn, before):
+    """Supprime les événements traités ou ignorés reçus avant before (sans commit)"""
+    return conn.execute(
+        "DELETE FROM webhook_inbox WHERE status IN ('processed', 'ignored') AND received_at < ?", (before,)
+    ).rowcount
@@ -0,0 +1,41 @@
+"""
+Pools d'exécution partagés par les traitements lourds de TimeLocal
+(génération de miniatures, compression...), hors du chemin des requêtes HTTP.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+_process_pool = None
+_max_workers = None
+
+
+def configure_process_pool(max_workers):
+    """Crée le pool partagé avec la taille configurée (au démarrage de l'application)
+
+    La taille est conservée : un worker forké recrée son pool à la même taille.
+    """
+    global _process_pool, _max_workers
+    _max_workers = max_workers
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False)
+    _process_pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count() or 1)
+    return _process_pool
+
+
+def get_process_pool():
+    """Retourne le pool de processus partagé, créé à la première utilisation"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=_max_workers or os.cpu_count() or 1)
+    return _process_pool
+
+
+def _reset_after_fork():
+    """Un pool hérité du processus parent (fork Gunicorn) n'est pas utilisable"""
+    global _process_pool
+    _process_pool = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,248 @@
+"""
+Présence en ligne des utilisateurs (WebSocket)
+
+Le registre est tenu en mémoire et alimenté par les événements SocketIO :
+savoir qui est en ligne dans un échange ou une zone ne coûte aucune requête
+SQLite. Les dates de dernière activité sont accumulées puis écrites en lot
+dans `users` par flush(), au lieu d'un UPDATE par événement.
+
+Avec plusieurs workers Gunicorn, PRESENCE_STORAGE_URL=redis://... partage
+l'état de présence entre eux (module `redis` requis, serveur joignable au
+démarrage) ; sinon chaque worker ne voit que ses propres connexions.
+"""
+
+import os
+import socket
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    redis = None
+
+
+class PresenceRecord:
+    """État compact d'un utilisateur"""
+    __slots__ = ('user_id', 'sids', 'last_seen', 'login_at', 'exchanges', 'cell')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.sids = set()
+        self.last_seen = 0.0
+        self.login_at = None
+        self.exchanges = set()
+        self.cell = None
+
+
+class PresenceRegistry:
+    """Registre de présence local au processus"""
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        self._records = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _record(self, user_id):
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._records[user_id] = PresenceRecord(user_id)
+        return record
+
+    def _seen(self, record, now=None):
+        record.last_seen = now or time.time()
+        self._dirty.add(record.user_id)
+
+    # Événements
+    def connect(self, user_id, sid, cell=None):
+        with self._lock:
+            record = self._record(user_id)
+            record.sids.add(sid)
+            if cell is not None:
+                record.cell = cell
+            self._seen(record)
+        self._publish(record)
+
+    def disconnect(self, user_id, sid):
+        with self._lock:
+            record = self._records.get(user_id)
+            if record is None:
+                return
+            record.sids.discard(sid)
+            self._seen(record)
+        # Publier avant d'oublier les échanges pour les retirer de l'état partagé
+        self._publish(record)
+        if not record.sids:
+            with self._lock:
+                record.exchanges.clear()
+
+    def touch(self, user_id):
+        with self._lock:
+            record = self._records.get(user_id)
+            if record is not None:
+                self._seen(record)
+
+    def join_exchange(self, user_id, exchange_id):
+        with self._lock:
+            record = self._record(user_id)
+            record.exchanges.add(exchange_id)
+            self._seen(record)
+        self._publish(record)
+
+    def record_login(self, user_id):
+        with self._lock:
+            record = self._record(user_id)
+            record.login_at = time.time()
+            self._seen(record, record.login_at)
+
+    # Requêtes : est en ligne un utilisateur ayant au moins une connexion ouverte
+    def online_in_exchange(self, exchange_id):
+        with self._lock:
+            return sorted(
+                r.user_id for r in self._records.values()
+                if r.sids and exchange_id in r.exchanges
+            )
+
+    def online_in_cell(self, cell):
+        with self._lock:
+            return sorted(
+                r.user_id for r in self._records.values()
+                if r.sids and r.cell == cell
+            )
+
+    # Persistance
+    def _publish(self, record):
+        """Propage l'état d'un utilisateur aux autres workers (aucun en local)"""
+
+    def heartbeat(self):
+        """Rafraîchit l'état partagé des utilisateurs connectés"""
+
+    def drain(self):
+        """Retourne les activités à écrire et oublie les utilisateurs partis depuis plus de ttl
+
+        Chaque élément est (user_id, last_seen, login_at) en timestamps Unix.
+        """
+        now = time.time()
+        with self._lock:
+            pending = []
+            for user_id in self._dirty:
+                record = self._records.get(user_id)
+                if record is not None:
+                    pending.append((user_id, record.last_seen, record.login_at))
+                    record.login_at = None
+            self._dirty.clear()
+
+            for user_id in [u for u, r in self._records.items()
+                            if not r.sids and now - r.last_seen >= self.ttl]:
+                del self._records[user_id]
+
+        return pending
+
+    def restore(self, pending):
+        """Remet en attente des activités retirées par drain() dont l'écriture a échoué
+
+        Les activités arrivées entre-temps priment.
+        """
+        with self._lock:
+            for user_id, last_seen, login_at in pending:
+                record = self._record(user_id)
+                record.last_seen = max(record.last_seen, last_seen)
+                if record.login_at is None:
+                    record.login_at = login_at
+                self._dirty.add(user_id)
+
+    def flush(self, conn):
+        """Écrit les dernières activités dans users en un seul lot (sans commit)"""
+        return self.write(conn, self.drain())
+
+    @staticmethod
+    def write(conn, pending):
+        """Écrit des activités déjà retirées par drain() (sans verrou du registre)"""
+        if not pending:
+            return 0
+
+        conn.executemany('''
+            UPDATE users
+            SET last_seen = datetime(?, 'unixepoch'),
+                last_login = COALESCE(datetime(?, 'unixepoch'), last_login)
+            WHERE id = ?
+        ''', [(last_seen, login_at, user_id) for user_id, last_seen, login_at in pending])
+        return len(pending)
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """Registre partagé entre workers via des sorted sets Redis
+
+    Chaque worker inscrit ses utilisateurs sous un membre qui lui est propre
+    (user_id:worker) : la dernière déconnexion d'un utilisateur sur un worker
+    ne retire que ce membre, et l'utilisateur reste en ligne tant qu'un autre
+    worker le détient. Le score est la date de dernière activité : les
+    entrées d'un worker arrêté brutalement expirent d'elles-mêmes après ttl.
+    """
+
+    def __init__(self, url, ttl=90, prefix='timelocal:presence'):
+        super().__init__(ttl)
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    @property
+    def worker_id(self):
+        # Calculé à chaque appel : les workers forkés après le chargement de
+        # l'application partagent l'objet mais pas le pid
+        return f'{socket.gethostname()}-{os.getpid()}'
+
+    def _keys(self, record):
+        keys = [f'{self.prefix}:exchange:{e}' for e in record.exchanges]
+        if record.cell:
+            keys.append(f'{self.prefix}:cell:{record.cell}')
+        return keys
+
+    def _publish(self, record):
+        member = f'{record.user_id}:{self.worker_id}'
+        pipe = self.client.pipeline(transaction=False)
+        for key in self._keys(record):
+            if record.sids:
+                pipe.zadd(key, {member: record.last_seen})
+                pipe.expire(key, self.ttl * 2)
+            else:
+                pipe.zrem(key, member)
+        pipe.execute()
+
+    def heartbeat(self):
+        with self._lock:
+            connected = [r for r in self._records.values() if r.sids]
+        for record in connected:
+            record.last_seen = time.time()
+            self._publish(record)
+
+    def _online(self, key):
+        members = self.client.zrangebyscore(key, time.time() - self.ttl, '+inf')
+        # Un même utilisateur peut être inscrit par plusieurs workers
+        return sorted({int(m.split(b':', 1)[0]) for m in members})
+
+    def online_in_exchange(self, exchange_id):
+        return self._online(f'{self.prefix}:exchange:{exchange_id}')
+
+    def online_in_cell(self, cell):
+        return self._online(f'{self.prefix}:cell:{cell}')
+
+
+def create_registry(storage_url, ttl):
+    """Registre Redis si configuré, local sinon
+
+    Une URL redis:// inutilisable (module absent, serveur injoignable) lève
+    RuntimeError : un registre local par worker ne verrait qu'une partie des
+    utilisateurs en ligne.
+    """
+    if not (storage_url and storage_url.startswith(('redis://', 'rediss://'))):
+        return PresenceRegistry(ttl)
+
+    if redis is None:
+        raise RuntimeError(f'Présence : {storage_url} configuré mais le module redis est absent')
+    registry = RedisPresenceRegistry(storage_url, ttl)
+    try:
+        registry.client.ping()
+    except redis.RedisError as e:
+        raise RuntimeError(f'Présence : serveur Redis injoignable ({e})') from e
+    return registry
@@ -0,0 +1,112 @@
+"""
+Projections des réponses de l'API (paramètre fields=)
+
+Chaque endpoint déclare les champs qu'il expose, leur expression SQL et des
+vues par défaut. Seules les colonnes demandées sont sélectionnées : les
+réponses sont plus légères et SQLite décode moins de colonnes par ligne.
+"""
+
+
+class ProjectionError(ValueError):
+    """Champ ou vue inconnu dans la requête"""
+
+
+class Projection:
+    """Champs exposés par un endpoint et vues prédéfinies"""
+
+    def __init__(self, columns, views, default_view='default'):
+        self.columns = columns  # nom public -> expression SQL
+        self.views = views  # nom de vue -> liste de champs
+        self.default_view = default_view
+
+    def resolve(self, fields=None, view=None):
+        """Retourne la liste des champs à renvoyer
+
+        fields est la valeur brute du paramètre (« id,title,price ») ; il est
+        prioritaire sur view.
+        """
+        if fields:
+            selected = [f.strip() for f in fields.split(',') if f.strip()]
+            unknown = [f for f in selected if f not in self.columns]
+            if unknown:
+                raise ProjectionError(f"Unknown fields: {', '.join(unknown)}")
+            # Dédoublonnage en gardant l'ordre demandé
+            return list(dict.fromkeys(selected))
+
+        view = view or self.default_view
+        if view not in self.views:
+            raise ProjectionError(f'Unknown view: {view}')
+        return self.views[view]
+
+    def select_clause(self, fields):
+        """Clause SELECT correspondant aux champs choisis"""
+        return ', '.join(f'{self.columns[f]} AS {f}' for f in fields)
+
+    def uses_table(self, fields, alias):
+        """Indique si l'un des champs provient de la table aliasée"""
+        prefix = f'{alias}.'
+        return any(self.columns[f].startswith(prefix) for f in fields)
+
+
+REQUEST_PROJECTION = Projection(
+    columns={
+        'id': 'r.id',
+        'user_id': 'r.user_id',
+        'title': 'r.title',
+        'description': 'r.description',
+        'category': 'r.category',
+        'type': 'r.type',
+        'time_required': 'r.time_required',
+        'price': 'r.price',
+        'exchange_type': 'r.exchange_type',
+        'location': 'r.location',
+        'latitude': 'r.latitude',
+        'longitude': 'r.longitude',
+        'deadline': 'r.deadline',
+        'status': 'r.status',
+        'created_at': 'r.created_at',
+        'updated_at': 'r.updated_at',
+        'username': 'u.username',
+        'full_name': 'u.full_name',
+        'rating': 'u.rating',
+        'profile_picture': 'u.profile_picture'
+    },
+    views={
+        'default': [
+            'id', 'user_id', 'title', 'description', 'category', 'type',
+            'time_required', 'price', 'exchange_type', 'location',
+            'latitude', 'longitude', 'deadline', 'created_at',
+            'username', 'full_name', 'rating', 'profile_picture'
+        ],
+        # Cartes de la liste mobile
+        'compact': [
+            'id', 'title', 'category', 'type', 'time_required', 'price',
+            'exchange_type', 'latitude', 'longitude', 'created_at'
+        ]
+    }
+)
+
+PROFILE_PROJECTION = Projection(
+    # password_hash n'est jamais exposé
+    columns={
+        name: name for name in (
+            'id', 'username', 'email', 'full_name', 'phone', 'address',
+            'latitude', 'longitude', 'bio', 'skills', 'availability',
+            'time_credits', 'level', 'points', 'rating', 'rating_count',
+            'profile_picture', 'is_verified', 'is_active', 'last_login',
+            'created_at', 'updated_at'
+        )
+    },
+    views={
+        'default': [
+            'id', 'username', 'email', 'full_name', 'phone', 'address',
+            'latitude', 'longitude', 'bio', 'skills', 'availability',
+            'time_credits', 'level', 'points', 'rating', 'rating_count',
+            'profile_picture', 'is_verified', 'last_login', 'created_at'
+        ],
+        'compact': [
+            'id', 'username', 'full_name', 'profile_picture',
+            'time_credits', 'points', 'level', 'rating'
+        ]
+    }
+)
@@ -0,0 +1,105 @@
+"""
+Planificateur de tâches périodiques dans le processus de l'application
+
+Certaines tâches concernent chaque worker (flush de sa présence), d'autres ne
+doivent tourner qu'une fois pour toute l'application (expiration, archivage...).
+Ces dernières ne s'exécutent que dans le worker qui détient le verrou de
+leader, un simple flock sur un fichier : si ce worker meurt, le verrou est
+libéré par le système et un autre worker le reprend au tick suivant.
+"""
+
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """Verrou exclusif non bloquant partagé entre les processus d'une machine"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """Tente de devenir leader ; retourne True si le verrou est détenu"""
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            # Pas de flock : un seul processus supposé
+            self._fd = -1
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+
+class Job:
+    __slots__ = ('name', 'interval', 'func', 'leader_only', 'next_run')
+
+    def __init__(self, name, interval, func, leader_only):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.leader_only = leader_only
+        self.next_run = time.monotonic() + interval
+
+
+class Scheduler:
+    """Boucle de tâches périodiques
+
+    sleep doit coopérer avec le serveur (socketio.sleep sous eventlet).
+    """
+
+    def __init__(self, sleep=time.sleep, lock=None, tick=1.0):
+        self.sleep = sleep
+        self.lock = lock
+        self.tick = tick
+        self.jobs = []
+
+    def every(self, interval, func, name=None, leader_only=False):
+        """Enregistre func pour une exécution toutes les interval secondes"""
+        self.jobs.append(Job(name or func.__name__, interval, func, leader_only))
+        return func
+
+    def is_leader(self):
+        return self.lock is None or self.lock.acquire()
+
+    def run_pending(self):
+        """Exécute les tâches arrivées à échéance"""
+        now = time.monotonic()
+        for job in self.jobs:
+            if now < job.next_run:
+                continue
+            job.next_run = now + job.interval
+            if job.leader_only and not self.is_leader():
+                continue
+            try:
+                job.func()
+            except Exception:
+                logger.exception('Scheduled job %s failed', job.name)
+
+    def run(self):
+        """Boucle infinie (à lancer en tâche de fond)"""
+        while True:
+            self.run_pending()
+            self.sleep(self.tick)
@@ -0,0 +1,612 @@
+"""
+Partitionnement géographique de la base (SHARDING_ENABLED)
+
+Les demandes, échanges et messages sont répartis dans des fichiers SQLite par
+région (SHARD_DIR/<shard>.db) ; les utilisateurs et le reste du schéma restent
+dans la base annuaire (DATABASE_PATH). Chaque connexion de shard attache
+l'annuaire sous le nom `directory` : les jointures sur users et l'insertion de
+notifications fonctionnent sans changer les requêtes.
+
+Une région est une cellule de grille de SHARD_GRID_SIZE degrés (geo.grid_cell),
+'global' sans coordonnées. L'annuaire associe chaque région à un numéro et à un
+shard (shard_regions) : plusieurs régions peu actives peuvent partager un
+fichier, et move_region() déplace une région vers un autre fichier.
+
+Les identifiants portent leur région : id = numéro << REGION_ID_BITS | compteur.
+Un échange ou un message reçoit la région de sa demande ; retrouver le shard
+d'un id ne demande donc qu'une lecture de la table des régions, gardée en cache.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import caching
+from geo import grid_cell
+
+SHARDED_TABLES = ('requests', 'exchanges', 'messages')
+# Clés des données JSON de notifications qui désignent une ligne partitionnée
+NOTIFICATION_REFERENCES = {'request_id': 'requests', 'exchange_id': 'exchanges', 'message_id': 'messages'}
+DEFAULT_REGION = 'global'
+DIRECTORY_SCHEMA = 'directory'
+REGION_ID_BITS = 32
+
+# Table de l'annuaire
+REGIONS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS shard_regions (
+        idx INTEGER PRIMARY KEY AUTOINCREMENT,
+        region TEXT UNIQUE NOT NULL,
+        shard TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+# Compteurs d'identifiants par région, dans chaque shard
+SEQUENCES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS shard_sequences (
+        region_idx INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        last_id INTEGER NOT NULL,
+        PRIMARY KEY (region_idx, name)
+    );
+'''
+
+
+class ShardError(Exception):
+    """Région ou identifiant inconnu de l'annuaire"""
+
+
+def region_of(latitude, longitude, size):
+    """Région d'un point : cellule de grille, ou DEFAULT_REGION sans coordonnées"""
+    return grid_cell(latitude, longitude, size) or DEFAULT_REGION
+
+
+def default_shard(region):
+    """Nom du fichier d'une nouvelle région (un fichier par région)"""
+    return 'r' + region.replace(':', '_') if region != DEFAULT_REGION else region
+
+
+def id_range(region_idx):
+    """Bornes (exclue, incluse) des identifiants d'une région"""
+    low = region_idx << REGION_ID_BITS
+    return low, low + (1 << REGION_ID_BITS) - 1
+
+
+def region_index(record_id):
+    return int(record_id) >> REGION_ID_BITS
+
+
+def allocate_id(conn, table, region_idx):
+    """Prochain identifiant de table dans la région (dans la transaction en cours)"""
+    low, _ = id_range(region_idx)
+    conn.execute(
+        'INSERT OR IGNORE INTO main.shard_sequences (region_idx, name, last_id) VALUES (?, ?, ?)',
+        (region_idx, table, low)
+    )
+    conn.execute(
+        'UPDATE main.shard_sequences SET last_id = last_id + 1 WHERE region_idx = ? AND name = ?',
+        (region_idx, table)
+    )
+    return conn.execute(
+        'SELECT last_id FROM main.shard_sequences WHERE region_idx = ? AND name = ?',
+        (region_idx, table)
+    ).fetchone()[0]
+
+
+def _call(fn, *args):
+    return fn(*args)
+
+
+def _iter_rows(cursor, chunk_size, run):
+    while True:
+        rows = run(cursor.fetchmany, chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+
+class ShardRouter:
+    """Routage des accès aux tables partitionnées
+
+    La table des régions est relue au plus tard toutes les refresh secondes, et
+    immédiatement quand un numéro de région est inconnu : un déplacement de
+    région fait par un autre processus est pris en compte sans redémarrage.
+
+    schema_sql complète le schéma de chaque shard (triggers) ; setup(conn), si
+    fourni, est appelé ensuite pour ce qui ne s'exprime pas en SQL idempotent
+    (triggers à recréer selon les réglages).
+    """
+
+    def __init__(self, directory_path, shard_dir, grid_size, busy_timeout=5, refresh=30, schema_sql='',
+                 setup=None):
+        self.directory_path = directory_path
+        self.shard_dir = shard_dir
+        self.grid_size = grid_size
+        self.busy_timeout = busy_timeout
+        self.refresh = refresh
+        self.schema_sql = schema_sql
+        self.setup = setup
+        self._regions = {}
+        self._by_index = {}
+        self._loaded_at = 0
+        self._ready = set()
+        self._lock = threading.Lock()
+
+    # Connexions
+
+    def shard_path(self, shard):
+        return os.path.join(self.shard_dir, f'{shard}.db')
+
+    def archive_path(self, shard):
+        return os.path.join(self.shard_dir, f'{shard}.archive.db')
+
+    def _open(self, path):
+        conn = sqlite3.connect(path, timeout=self.busy_timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect_directory(self):
+        return self._open(self.directory_path)
+
+    def connect(self, shard):
+        """Connexion à un shard, annuaire attaché"""
+        self.ensure_schema(shard)
+        conn = self._open(self.shard_path(shard))
+        conn.execute(f'ATTACH DATABASE ? AS {DIRECTORY_SCHEMA}', (self.directory_path,))
+        return conn
+
+    # Table des régions
+
+    def load(self, force=False):
+        if not force and time.monotonic() - self._loaded_at < self.refresh:
+            return
+        conn = self.connect_directory()
+        try:
+            conn.executescript(REGIONS_SCHEMA)
+            rows = conn.execute('SELECT idx, region, shard FROM shard_regions').fetchall()
+        finally:
+            conn.close()
+        with self._lock:
+            self._regions = {row['region']: (row['idx'], row['shard']) for row in rows}
+            self._by_index = {row['idx']: row['shard'] for row in rows}
+            self._loaded_at = time.monotonic()
+
+    def regions(self):
+        """{région: (numéro, shard)}"""
+        self.load()
+        return dict(self._regions)
+
+    def shards(self):
+        """Shards utilisés, triés par nom"""
+        self.load()
+        return sorted(set(self._by_index.values()))
+
+    def region(self, name):
+        """(numéro, shard) d'une région, enregistrée dans l'annuaire si nouvelle"""
+        self.load()
+        if name not in self._regions:
+            conn = self.connect_directory()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT OR IGNORE INTO shard_regions (region, shard) VALUES (?, ?)',
+                        (name, default_shard(name))
+                    )
+            finally:
+                conn.close()
+            self.load(force=True)
+        return self._regions[name]
+
+    def locate(self, latitude, longitude):
+        """(numéro de région, shard) d'un point"""
+        return self.region(region_of(latitude, longitude, self.grid_size))
+
+    def shard_for_id(self, record_id):
+        """Shard contenant un enregistrement partitionné"""
+        idx = region_index(record_id)
+        self.load()
+        if idx not in self._by_index:
+            self.load(force=True)
+        if idx not in self._by_index:
+            raise ShardError(f'Unknown shard for id {record_id}')
+        return self._by_index[idx]
+
+    # Schéma
+
+    def ensure_schema(self, shard):
+        """Crée ou complète les tables d'un shard d'après celles de l'annuaire
+
+        Les tables partitionnées de l'annuaire restent vides et servent de
+        modèle : colonnes, contraintes et index sont recopiés.
+        """
+        if shard in self._ready:
+            return
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        conn = sqlite3.connect(self.shard_path(shard), timeout=self.busy_timeout)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'ATTACH DATABASE ? AS {DIRECTORY_SCHEMA}', (self.directory_path,))
+            placeholders = ','.join('?' * len(SHARDED_TABLES))
+            template = conn.execute(f'''
+                SELECT type, name, tbl_name, sql FROM {DIRECTORY_SCHEMA}.sqlite_master
+                WHERE tbl_name IN ({placeholders}) AND type IN ('table', 'index') AND sql IS NOT NULL
+                ORDER BY type DESC
+            ''', SHARDED_TABLES).fetchall()
+
+            existing = {row[0] for row in conn.execute("SELECT name FROM main.sqlite_master")}
+            with conn:
+                for kind, name, table, sql in template:
+                    if name not in existing:
+                        conn.execute(sql)
+                    elif kind == 'table':
+                        self._add_missing_columns(conn, table)
+                conn.executescript(SEQUENCES_SCHEMA + self.schema_sql)
+            if self.setup:
+                self.setup(conn)
+            conn.execute(f'DETACH DATABASE {DIRECTORY_SCHEMA}')
+        finally:
+            conn.close()
+
+        self._ready.add(shard)
+
+    @staticmethod
+    def _add_missing_columns(conn, table):
+        columns = {row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')}
+        for _, name, col_type, _, default, _ in conn.execute(f'PRAGMA {DIRECTORY_SCHEMA}.table_info({table})'):
+            if name not in columns:
+                definition = f'{name} {col_type}' + (f' DEFAULT {default}' if default is not None else '')
+                conn.execute(f'ALTER TABLE main.{table} ADD COLUMN {definition}')
+
+    # Requêtes multi-shards
+
+    def fan_out(self, sql, params, order_by, reverse=False, limit=None, chunk_size=200,
+                connect=None, run=_call, drop=()):
+        """Exécute sql sur chaque shard et fusionne les résultats ; génère des paquets de dicts
+
+        sql doit être trié selon order_by (colonnes) dans chaque shard ; il peut
+        être une fonction de la connexion (sources d'historique). connect(shard)
+        remplace la connexion par défaut ; drop liste les colonnes de tri à
+        retirer des résultats. run(fn, *args) exécute les appels SQLite.
+        """
+        connect = connect or self.connect
+        conns = []
+        try:
+            sources = []
+            for shard in self.shards():
+                conn = run(connect, shard)
+                conns.append(conn)
+                query = sql(conn) if callable(sql) else sql
+                cursor = run(conn.execute, query, params)
+                sources.append(_iter_rows(cursor, chunk_size, run))
+
+            merged = heapq.merge(
+                *sources,
+                key=lambda row: tuple(row[column] for column in order_by),
+                reverse=reverse
+            )
+            if limit is not None:
+                merged = itertools.islice(merged, limit)
+
+            while True:
+                chunk = [
+                    {key: row[key] for key in row.keys() if key not in drop}
+                    for row in itertools.islice(merged, chunk_size)
+                ]
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def data_version(self, tables):
+        """Versions des tables pour les ETags : annuaire puis chaque shard"""
+        local = tuple(t for t in tables if t not in SHARDED_TABLES)
+        sharded = tuple(t for t in tables if t in SHARDED_TABLES)
+
+        conn = self.connect_directory()
+        try:
+            versions = [caching.data_version(conn, local)] if local else []
+        finally:
+            conn.close()
+
+        for shard in self.shards() if sharded else []:
+            conn = self.connect(shard)
+            try:
+                versions.append((shard,) + caching.data_version(conn, sharded))
+            finally:
+                conn.close()
+        return tuple(versions)
+
+    # Rééquilibrage
+
+    def move_region(self, region, target, batch_size=500, settle=None, pause=None):
+        """Déplace une région vers le shard target ; retourne les lignes déplacées par table
+
+        Les lignes sont copiées, la région est réaffectée dans l'annuaire, puis
+        après settle() (attente que les autres processus relisent la table des
+        régions) une seconde passe recopie les écritures tardives et supprime
+        les lignes de l'ancien shard.
+
+        Relancé après un échec, il reprend là où il s'était arrêté : les lignes
+        déjà copiées sont mises à jour, et si la région était déjà réaffectée,
+        les lignes restées dans l'ancien shard sont recopiées puis supprimées.
+        """
+        self.load(force=True)
+        if region not in self._regions:
+            raise ShardError(f'Unknown region: {region}')
+        idx, source = self._regions[region]
+        if source == target:
+            totals = {table: 0 for table in SHARDED_TABLES}
+            for leftover in self._shards_holding(idx, exclude=target):
+                for table, count in self._copy_region(idx, leftover, target, batch_size, pause, delete=True).items():
+                    totals[table] += count
+            return totals
+
+        self.ensure_schema(target)
+        self._copy_region(idx, source, target, batch_size, pause, delete=False)
+
+        conn = self.connect_directory()
+        try:
+            with conn:
+                conn.execute('UPDATE shard_regions SET shard = ? WHERE idx = ?', (target, idx))
+        finally:
+            conn.close()
+        self.load(force=True)
+
+        if settle:
+            settle()
+        return self._copy_region(idx, source, target, batch_size, pause, delete=True)
+
+    def _shards_holding(self, idx, exclude):
+        """Fichiers de shards, hors exclude, contenant encore des lignes de la région idx"""
+        low, high = id_range(idx)
+        names = sorted(
+            name[:-len('.db')] for name in os.listdir(self.shard_dir)
+            if name.endswith('.db') and not name.endswith('.archive.db')
+        ) if os.path.isdir(self.shard_dir) else []
+
+        holding = []
+        for shard in names:
+            if shard == exclude:
+                continue
+            conn = self.connect(shard)
+            try:
+                if any(
+                    conn.execute(f'SELECT 1 FROM main.{table} WHERE id > ? AND id <= ? LIMIT 1', (low, high)).fetchone()
+                    for table in SHARDED_TABLES
+                ):
+                    holding.append(shard)
+            finally:
+                conn.close()
+        return holding
+
+    def _copy_region(self, idx, source, target, batch_size, pause, delete):
+        low, high = id_range(idx)
+        conn = self.connect(source)
+        conn.execute('ATTACH DATABASE ? AS target', (self.shard_path(target),))
+        totals = {}
+        has_change_log = conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'change_log'"
+        ).fetchone() is not None
+        try:
+            for table in SHARDED_TABLES:
+                names = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+                columns = ', '.join(names)
+                fields = ', '.join(name for name in names if name != 'id')
+                totals[table] = 0
+                last_id = low
+                while True:
+                    ids = [row[0] for row in conn.execute(
+                        f'SELECT id FROM main.{table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                        (last_id, high, batch_size)
+                    )]
+                    if not ids:
+                        break
+                    placeholders = ','.join('?' * len(ids))
+                    with conn:
+                        # Ni INSERT OR REPLACE ni upsert : le remplacement ne déclenche pas
+                        # les triggers de suppression (facettes comptées deux fois) et une
+                        # clause de conflit externe s'impose à celles des triggers. Les
+                        # lignes déjà copiées sont mises à jour, les autres insérées.
+                        conn.execute(
+                            f'UPDATE target.{table} SET ({fields}) = '
+                            f'(SELECT {fields} FROM main.{table} s WHERE s.id = target.{table}.id) '
+                            f'WHERE id IN ({placeholders})',
+                            ids
+                        )
+                        conn.execute(
+                            f'INSERT INTO target.{table} ({columns}) '
+                            f'SELECT {columns} FROM main.{table} WHERE id IN ({placeholders}) '
+                            f'AND id NOT IN (SELECT id FROM target.{table} WHERE id IN ({placeholders}))',
+                            ids + ids
+                        )
+                        if delete:
+                            conn.execute(f'DELETE FROM main.{table} WHERE id IN ({placeholders})', ids)
+                            if has_change_log:
+                                # Un déplacement n'est pas une suppression pour les clients synchronisés
+                                conn.execute(
+                                    f"DELETE FROM main.change_log WHERE name = ? AND op = 'delete' "
+                                    f"AND row_id IN ({placeholders})",
+                                    [table] + ids
+                                )
+                    totals[table] += len(ids)
+                    last_id = ids[-1]
+                    if pause:
+                        pause()
+
+            with conn:
+                conn.execute('''
+                    INSERT INTO target.shard_sequences (region_idx, name, last_id)
+                    SELECT region_idx, name, last_id FROM main.shard_sequences WHERE region_idx = ?
+                    ON CONFLICT (region_idx, name) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)
+                ''', (idx,))
+                if delete:
+                    conn.execute('DELETE FROM main.shard_sequences WHERE region_idx = ?', (idx,))
+        finally:
+            conn.close()
+        return totals
+
+    def migrate(self, batch_size=500, archive_path=None):
+        """Déplace les données d'une base non partitionnée vers les shards
+
+        Les identifiants sont réattribués dans l'espace de leur région ; les
+        références entre demandes, échanges et messages suivent, ainsi que
+        celles de l'annuaire (payments.exchange_id, ids des données JSON des
+        notifications). La table de correspondance shard_id_map est conservée
+        dans l'annuaire : une migration interrompue reprend là où elle s'était
+        arrêtée. Retourne le nombre de lignes migrées par table.
+
+        Les lignes archivées gardent leurs anciens identifiants : la migration
+        refuse de démarrer si l'archive archive_path contient des données.
+        """
+        self._check_archive(archive_path)
+        conn = self.connect_directory()
+        targets = {}
+        totals = {table: 0 for table in SHARDED_TABLES}
+        try:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS shard_id_map (
+                    name TEXT NOT NULL,
+                    old_id INTEGER NOT NULL,
+                    new_id INTEGER NOT NULL,
+                    shard TEXT NOT NULL,
+                    PRIMARY KEY (name, old_id)
+                );
+            ''')
+
+            def moved(table, old_id):
+                return conn.execute(
+                    'SELECT new_id, shard FROM shard_id_map WHERE name = ? AND old_id = ?',
+                    (table, old_id)
+                ).fetchone()
+
+            def place(row):
+                if row['__table'] == 'requests':
+                    idx, shard = self.locate(row['latitude'], row['longitude'])
+                    return idx, shard, {}
+                parent_table, parent_key = (
+                    ('requests', 'request_id') if row['__table'] == 'exchanges' else ('exchanges', 'exchange_id')
+                )
+                parent = moved(parent_table, row[parent_key])
+                if parent is None:
+                    # Parent absent (archivé) : rangé dans la région par défaut
+                    idx, shard = self.region(DEFAULT_REGION)
+                    return idx, shard, {}
+                return region_index(parent['new_id']), parent['shard'], {parent_key: parent['new_id']}
+
+            for table in SHARDED_TABLES:
+                columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+                while True:
+                    rows = conn.execute(
+                        f"SELECT *, '{table}' AS __table FROM main.{table} ORDER BY id LIMIT ?",
+                        (batch_size,)
+                    ).fetchall()
+                    if not rows:
+                        break
+
+                    for row in rows:
+                        # Déjà copiée lors d'une migration interrompue
+                        if moved(table, row['id']) is None:
+                            idx, shard, overrides = place(row)
+                            values = {column: row[column] for column in columns}
+                            values.update(overrides)
+
+                            if shard not in targets:
+                                targets[shard] = self.connect(shard)
+                            target = targets[shard]
+                            with target:
+                                values['id'] = allocate_id(target, table, idx)
+                                target.execute(
+                                    f"INSERT INTO main.{table} ({', '.join(values)}) "
+                                    f"VALUES ({', '.join('?' * len(values))})",
+                                    tuple(values.values())
+                                )
+                            with conn:
+                                conn.execute(
+                                    'INSERT INTO shard_id_map (name, old_id, new_id, shard) VALUES (?, ?, ?, ?)',
+                                    (table, row['id'], values['id'], shard)
+                                )
+                            totals[table] += 1
+
+                        with conn:
+                            conn.execute(f'DELETE FROM main.{table} WHERE id = ?', (row['id'],))
+
+            self._remap_directory(conn, batch_size)
+        finally:
+            for target in targets.values():
+                target.close()
+            conn.close()
+        return totals
+
+    @staticmethod
+    def _check_archive(archive_path):
+        if not archive_path or not os.path.exists(archive_path):
+            return
+        conn = sqlite3.connect(archive_path)
+        try:
+            archived = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for table in SHARDED_TABLES:
+                if table in archived and conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                    raise ShardError(f'Archive {archive_path} is not empty ({table}): restore it before migrating')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _remap_directory(conn, batch_size):
+        """Réécrit les identifiants migrés référencés par l'annuaire
+
+        Les nouveaux identifiants (région << REGION_ID_BITS) ne peuvent pas
+        être confondus avec les anciens : une reprise ne les remplace pas.
+        """
+        def new_id(table, old_id):
+            row = conn.execute(
+                'SELECT new_id FROM shard_id_map WHERE name = ? AND old_id = ?', (table, old_id)
+            ).fetchone()
+            return row['new_id'] if row else None
+
+        tables = {row[0] for row in conn.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")}
+        if 'payments' in tables:
+            with conn:
+                conn.execute('''
+                    UPDATE payments SET exchange_id = (
+                        SELECT m.new_id FROM shard_id_map m
+                        WHERE m.name = 'exchanges' AND m.old_id = payments.exchange_id
+                    )
+                    WHERE exchange_id IN (SELECT old_id FROM shard_id_map WHERE name = 'exchanges')
+                ''')
+
+        if 'notifications' not in tables:
+            return
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, data FROM notifications WHERE id > ? AND data IS NOT NULL ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                try:
+                    data = json.loads(row['data'])
+                except ValueError:
+                    continue
+                if not isinstance(data, dict):
+                    continue
+                changed = False
+                for key, table in NOTIFICATION_REFERENCES.items():
+                    if isinstance(data.get(key), int):
+                        mapped = new_id(table, data[key])
+                        if mapped is not None:
+                            data[key], changed = mapped, True
+                if changed:
+                    updates.append((json.dumps(data), row['id']))
+            with conn:
+                conn.executemany('UPDATE notifications SET data = ? WHERE id = ?', updates)
+            last_id = rows[-1]['id']
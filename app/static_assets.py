@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Build des fichiers statiques de public_html (sans Node)
+
+    python static_assets.py [--source ../public_html] [--dist ../public_html/dist]
+
+- copie chaque asset sous un nom empreinte (style.<hash>.css) ;
+- produit les variantes précompressées .gz et .br (si le module brotli est installé) ;
+- empreinte les images du manifeste PWA (icônes, captures) et réécrit ses références ;
+- réécrit les références dans index.html ;
+- génère asset-manifest.json et le service worker sw.js qui précache ces fichiers.
+
+Les noms empreintes ne changent qu'avec leur contenu : ils sont servis avec
+Cache-Control: immutable. index.html, sw.js et asset-manifest.json restent
+revalidés à chaque chargement.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dépendance optionnelle
+    brotli = None
+
+# Fichiers à empreinter, relatifs à public_html
+ASSETS = [
+    'static/css/style.css',
+    'static/js/app.js',
+    'static/js/app-hostinger.js'
+]
+
+# Manifeste PWA : empreinté après réécriture des images qu'il référence
+MANIFEST = 'manifest.json'
+
+# Pages dont les références sont réécrites
+PAGES = ['index.html']
+
+FINGERPRINT_LENGTH = 10
+FINGERPRINT_RE = re.compile(r'\.[0-9a-f]{%d}\.[a-z0-9]+$' % FINGERPRINT_LENGTH)
+
+# Encodage HTTP -> extension de la variante précompressée
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Formats déjà compressés : pas de variantes .gz/.br
+COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
+def is_fingerprinted(filename):
+    """Indique si le nom de fichier contient une empreinte de contenu"""
+    return bool(FINGERPRINT_RE.search(filename))
+
+
+def fingerprinted_name(relpath, content):
+    """style.css -> style.<empreinte>.css"""
+    digest = hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH]
+    root, ext = os.path.splitext(relpath)
+    return f'{root}.{digest}{ext}'
+
+
+def write_variants(path, content):
+    """Écrit le fichier et ses variantes précompressées"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return
+
+    # mtime=0 : sortie identique d'un build à l'autre
+    with open(path + ENCODING_SUFFIXES['gzip'], 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    if brotli:
+        with open(path + ENCODING_SUFFIXES['br'], 'wb') as f:
+            f.write(brotli.compress(content, quality=11))
+
+
+def rewrite_references(html, mapping):
+    """Remplace les src/href pointant vers un asset par son nom empreinte"""
+    def replace(match):
+        attr, slash, target = match.group(1), match.group(2), match.group(3)
+        return f'{attr}="{slash}{mapping.get(target, target)}"'
+
+    return re.sub(r'(src|href)="(/?)([^"#?]+)"', replace, html)
+
+
+def _manifest_entries(manifest):
+    """Entrées du manifeste PWA portant une image (icônes, captures, raccourcis)"""
+    entries = list(manifest.get('icons', [])) + list(manifest.get('screenshots', []))
+    for shortcut in manifest.get('shortcuts', []):
+        entries += shortcut.get('icons', [])
+    return [entry for entry in entries if entry.get('src')]
+
+
+def manifest_images(manifest):
+    """Chemins, relatifs à public_html, des images référencées par le manifeste"""
+    return list(dict.fromkeys(entry['src'].lstrip('/') for entry in _manifest_entries(manifest)))
+
+
+def rewrite_manifest(manifest, mapping):
+    """Remplace les images du manifeste par leur nom empreinte (en place)"""
+    for entry in _manifest_entries(manifest):
+        target = entry['src'].lstrip('/')
+        if target in mapping:
+            entry['src'] = '/' + mapping[target]
+    return manifest
+
+
+def service_worker(precache, version):
+    """Service worker : précache des assets du build, cache d'abord pour ceux-ci"""
+    return f'''// Généré par static_assets.py - ne pas modifier
+const CACHE_NAME = 'timelocal-{version}';
+const PRECACHE = {json.dumps(precache, indent=2)};
+
+self.addEventListener('install', event => {{
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => cache.addAll(PRECACHE))
+            .then(() => self.skipWaiting())
+    );
+}});
+
+self.addEventListener('activate', event => {{
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(
+                keys.filter(key => key.startsWith('timelocal-') && key !== CACHE_NAME)
+                    .map(key => caches.delete(key))
+            ))
+            .then(() => self.clients.claim())
+    );
+}});
+
+self.addEventListener('fetch', event => {{
+    const url = new URL(event.request.url);
+    if (event.request.method !== 'GET' || url.origin !== self.location.origin) {{
+        return;
+    }}
+    if (PRECACHE.includes(url.pathname)) {{
+        event.respondWith(
+            caches.match(event.request).then(cached => cached || fetch(event.request))
+        );
+    }}
+}});
+'''
+
+
+def build(source_dir, dist_dir):
+    """Construit dist_dir à partir de source_dir et retourne le manifeste des assets"""
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir)
+
+    def add(relpath, content):
+        hashed = fingerprinted_name(relpath, content)
+        write_variants(os.path.join(dist_dir, hashed), content)
+        mapping[relpath] = hashed
+
+    mapping = {}
+    for relpath in ASSETS:
+        with open(os.path.join(source_dir, relpath), 'rb') as f:
+            add(relpath, f.read())
+
+    # Images du manifeste d'abord : son empreinte dépend de leurs noms.
+    # Une image absente des sources garde sa référence d'origine.
+    with open(os.path.join(source_dir, MANIFEST), encoding='utf-8') as f:
+        manifest = json.load(f)
+    for relpath in manifest_images(manifest):
+        path = os.path.join(source_dir, relpath)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                add(relpath, f.read())
+    rewrite_manifest(manifest, mapping)
+    add(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    for page in PAGES:
+        with open(os.path.join(source_dir, page), encoding='utf-8') as f:
+            html = rewrite_references(f.read(), mapping)
+        write_variants(os.path.join(dist_dir, page), html.encode('utf-8'))
+
+    # Version du build = empreinte de l'ensemble des noms empreintes
+    version = hashlib.sha256(''.join(sorted(mapping.values())).encode()).hexdigest()[:FINGERPRINT_LENGTH]
+    precache = ['/' + name for name in sorted(mapping.values())]
+
+    write_variants(os.path.join(dist_dir, 'sw.js'), service_worker(precache, version).encode('utf-8'))
+    write_variants(
+        os.path.join(dist_dir, 'asset-manifest.json'),
+        json.dumps({'version': version, 'files': mapping}, indent=2).encode('utf-8')
+    )
+
+    return mapping
+
+
+def resolve_variant(dist_dir, relpath, accept_encodings):
+    """Choisit la variante précompressée acceptée par le client
+
+    accept_encodings est l'objet Accept de Werkzeug (request.accept_encodings).
+    Retourne (chemin, encodage) ou (None, None) si le fichier n'existe pas ;
+    encodage vaut None pour le fichier brut.
+    """
+    path = os.path.realpath(os.path.join(dist_dir, relpath))
+    if not path.startswith(os.path.realpath(dist_dir) + os.sep) or not os.path.isfile(path):
+        return None, None
+
+    available = [enc for enc, suffix in ENCODING_SUFFIXES.items() if os.path.isfile(path + suffix)]
+    encoding = accept_encodings.best_match(available) if available else None
+    if encoding:
+        return path + ENCODING_SUFFIXES[encoding], encoding
+    return path, None
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Build des assets statiques TimeLocal')
+    parser.add_argument('--source', default=os.path.join(here, '..', 'public_html'))
+    parser.add_argument('--dist', default=os.path.join(here, '..', 'public_html', 'dist'))
+    args = parser.parse_args()
+
+    files = build(os.path.abspath(args.source), os.path.abspath(args.dist))
+    for original, hashed in files.items():
+        print(f'{original} -> {hashed}')
+
+    with open(os.path.join(args.source, MANIFEST), encoding='utf-8') as f:
+        missing = [path for path in manifest_images(json.load(f)) if path not in files]
+    for path in missing:
+        print(f'Image du manifeste absente des sources (404 une fois servie) : {path}')
+    if not brotli:
+        print('Module brotli absent : variantes .br non générées')
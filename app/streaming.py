@@ -0,0 +1,77 @@
+"""
+Sérialisation JSON incrémentale des listes volumineuses
+
+Les lignes sont lues depuis le curseur SQLite par paquets (fetchmany) et
+encodées au fil de l'eau : la mémoire utilisée par requête ne dépend pas du
+nombre de lignes renvoyées.
+
+run(fn, *args), si fourni, exécute chaque appel SQLite (connexion, requête,
+paquet) hors de la boucle eventlet ; l'encodage reste dans le greenlet.
+"""
+
+import json
+
+
+def _encode(row):
+    return json.dumps(dict(row), default=str, separators=(',', ':'))
+
+
+def _call(fn, *args):
+    return fn(*args)
+
+
+def iter_chunks(cursor, chunk_size, run=_call):
+    """Parcourt un curseur par paquets de chunk_size lignes"""
+    while True:
+        rows = run(cursor.fetchmany, chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def json_array_chunks(chunks, key):
+    """Génère un document {"<key>": [...], "count": n} à partir de paquets de lignes"""
+    yield '{' + json.dumps(key) + ':['
+
+    count = 0
+    for rows in chunks:
+        body = ','.join(_encode(row) for row in rows)
+        yield (',' if count else '') + body
+        count += len(rows)
+
+    yield '],"count":' + str(count) + '}'
+
+
+def ndjson_chunks(chunks):
+    """Génère une ligne JSON par enregistrement à partir de paquets de lignes"""
+    for rows in chunks:
+        yield ''.join(_encode(row) + '\n' for row in rows)
+
+
+def json_array_stream(connect, sql, params, key, chunk_size=200, run=_call):
+    """Génère un document {"<key>": [...], "count": n} morceau par morceau
+
+    connect est appelé à l'intérieur du générateur : la connexion vit le temps
+    de l'envoi de la réponse et est fermée à la fin, même si le client coupe.
+    sql peut être une fonction sql(conn) qui construit la requête.
+    """
+    conn = run(connect)
+    try:
+        cursor = run(conn.execute, run(sql, conn) if callable(sql) else sql, params)
+        yield from json_array_chunks(iter_chunks(cursor, chunk_size, run), key)
+    finally:
+        conn.close()
+
+
+def ndjson_stream(connect, sql, params, chunk_size=200, run=_call):
+    """Génère une ligne JSON par enregistrement (format NDJSON)
+
+    Comme json_array_stream : connexion ouverte dans le générateur, sql
+    éventuellement construite par sql(conn).
+    """
+    conn = run(connect)
+    try:
+        cursor = run(conn.execute, run(sql, conn) if callable(sql) else sql, params)
+        yield from ndjson_chunks(iter_chunks(cursor, chunk_size, run))
+    finally:
+        conn.close()
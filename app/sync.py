@@ -0,0 +1,177 @@
+"""
+Synchronisation différentielle pour l'application hors ligne (PWA)
+
+Chaque écriture sur une table synchronisée inscrit la ligne dans `change_log`
+avec un numéro de séquence croissant (AUTOINCREMENT : jamais réutilisé). La
+contrainte UNIQUE (name, row_id) et INSERT OR REPLACE compactent le journal :
+une ligne n'y figure qu'une fois, avec son dernier changement. Une suppression
+laisse une pierre tombale (op = 'delete'), purgée après un délai ; le numéro le
+plus élevé purgé devient l'horizon, en deçà duquel un client doit repartir de
+zéro.
+
+Le jeton rendu au client est opaque : la position atteinte dans chaque base
+(la base principale et, en mode partitionné, chaque shard).
+
+Une ligne archivée (archive.py) quitte sa table : le trigger DELETE laisse une
+pierre tombale et le client la retire de son cache. C'est voulu : une
+synchronisation complète ne lit que les tables vivantes, et un cache tenu à
+jour par les deltas doit converger vers le même état. L'historique archivé
+reste servi par les endpoints d'historique. Un déplacement de région entre
+shards n'est pas une suppression : shards.move_region efface ses pierres tombales.
+"""
+
+import base64
+import binascii
+import json
+
+SYNC_TABLES = ('requests', 'exchanges', 'messages', 'notifications')
+
+# Lignes visibles par l'utilisateur :user_id (alias t)
+VISIBILITY = {
+    'requests': "t.status = 'active' OR t.user_id = :user_id",
+    'exchanges': 't.requester_id = :user_id OR t.provider_id = :user_id',
+    'messages': '''EXISTS (
+        SELECT 1 FROM exchanges e
+        WHERE e.id = t.exchange_id AND (e.requester_id = :user_id OR e.provider_id = :user_id)
+    )''',
+    'notifications': 't.user_id = :user_id'
+}
+
+# Une demande qui sort du flux (close, expirée) est retirée du cache du client
+HIDDEN_AS_DELETED = ('requests',)
+
+CHANGE_LOG_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL, -- 'upsert' ou 'delete'
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (name, row_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS sync_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+'''
+
+
+class SyncTokenError(Exception):
+    """Jeton de synchronisation illisible"""
+
+
+def schema_sql(tables=SYNC_TABLES):
+    """Journal des changements et triggers des tables synchronisées"""
+    statements = [CHANGE_LOG_SCHEMA]
+    for table in tables:
+        for event, ref, op in (('INSERT', 'NEW', 'upsert'), ('UPDATE', 'NEW', 'upsert'), ('DELETE', 'OLD', 'delete')):
+            statements.append(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR REPLACE INTO change_log (name, row_id, op) VALUES ('{table}', {ref}.id, '{op}');
+                END;
+            ''')
+    return '\n'.join(statements)
+
+
+def install(conn, tables=SYNC_TABLES):
+    """Crée le journal ; à sa création, y inscrit les lignes existantes"""
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_log'"
+    ).fetchone() is None
+    conn.executescript(schema_sql(tables))
+    if created:
+        for table in tables:
+            conn.execute(
+                f"INSERT OR IGNORE INTO change_log (name, row_id, op) SELECT '{table}', id, 'upsert' FROM {table}"
+            )
+
+
+def encode_token(positions):
+    raw = json.dumps(positions, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """Positions {base: séquence} d'un jeton ; un jeton vide part de zéro"""
+    if not token:
+        return {}
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        positions = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise SyncTokenError('Invalid sync token')
+    if not isinstance(positions, dict) or not all(
+        isinstance(k, str) and isinstance(v, int) and v >= 0 for k, v in positions.items()
+    ):
+        raise SyncTokenError('Invalid sync token')
+    return positions
+
+
+def horizon(conn):
+    row = conn.execute("SELECT value FROM sync_state WHERE name = 'horizon'").fetchone()
+    return row[0] if row else 0
+
+
+def read_changes(conn, since, user_id, limit):
+    """Changements d'une base après la séquence since, au plus limit entrées du journal
+
+    Retourne un dict : changes {table: [lignes]}, deleted {table: [ids]},
+    seq (nouvelle position), has_more, et reset si since est antérieur à
+    l'horizon des pierres tombales purgées.
+    """
+    if 0 < since < horizon(conn):
+        return {'reset': True}
+
+    entries = conn.execute(
+        'SELECT seq, name, row_id, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?',
+        (since, limit + 1)
+    ).fetchall()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    upserts, deleted = {}, {}
+    for entry in entries:
+        target = upserts if entry['op'] == 'upsert' else deleted
+        target.setdefault(entry['name'], []).append(entry['row_id'])
+
+    changes = {}
+    for table, ids in upserts.items():
+        id_list = ','.join(str(int(row_id)) for row_id in ids)
+        rows = conn.execute(
+            f'SELECT t.* FROM {table} t WHERE t.id IN ({id_list}) AND ({VISIBILITY[table]})',
+            {'user_id': user_id}
+        ).fetchall()
+        if rows:
+            changes[table] = [dict(row) for row in rows]
+        if table in HIDDEN_AS_DELETED:
+            visible = {row['id'] for row in rows}
+            hidden = [row_id for row_id in ids if row_id not in visible]
+            if hidden:
+                deleted.setdefault(table, []).extend(hidden)
+
+    return {
+        'changes': changes,
+        'deleted': deleted,
+        'seq': entries[-1]['seq'] if entries else since,
+        'has_more': has_more,
+        'reset': False
+    }
+
+
+def prune(conn, before):
+    """Purge les pierres tombales antérieures à before et avance l'horizon (sans commit)"""
+    last = conn.execute(
+        "SELECT MAX(seq) FROM change_log WHERE op = 'delete' AND changed_at < ?", (before,)
+    ).fetchone()[0]
+    if last is None:
+        return 0
+
+    conn.execute('''
+        INSERT INTO sync_state (name, value) VALUES ('horizon', ?)
+        ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)
+    ''', (last,))
+    return conn.execute(
+        "DELETE FROM change_log WHERE op = 'delete' AND seq <= ?", (last,)
+    ).rowcount
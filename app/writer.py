@@ -0,0 +1,243 @@
+"""
+Écrivain unique pour SQLite
+
+SQLite n'accepte qu'une transaction d'écriture à la fois : quand beaucoup de
+requêtes concurrentes écrivent, elles se disputent le verrou et finissent en
+« database is locked ». En mode file d'attente, toutes les écritures du
+processus sont confiées à un seul thread qui les enchaîne, en regroupant
+plusieurs jobs dans une même transaction lorsque la file en contient.
+
+Chaque job est une fonction fn(conn) exécutée dans un SAVEPOINT : l'échec
+d'un job n'annule pas les autres jobs du lot. Le job reçoit une JobConnection,
+qui refuse commit() et rollback() : seul l'écrivain termine la transaction.
+Le résultat (ou l'exception) est transmis par un Future.
+
+Un appelant lassé d'attendre (write(..., timeout)) et l'écrivain se disputent
+l'issue du job : si l'appelant abandonne avant la fin de fn, le job est ignoré
+ou son SAVEPOINT annulé ; si fn a déjà abouti, l'appelant attend la validation
+du lot. Un job n'est donc jamais validé après que son appelant a reçu
+WriteTimeout.
+
+Sous eventlet, le thread écrivain est un greenlet : l'exécution SQL du lot est
+confiée à offload (thread natif) et les Futures sont résolus depuis le greenlet.
+"""
+
+import collections
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class WriterBusy(Exception):
+    """File d'écriture pleine ou quota du client atteint : réessayer plus tard"""
+
+
+class WriteTimeout(WriterBusy):
+    """Job non terminé dans le délai : abandonné, ses écritures ne sont pas validées"""
+
+
+class JobConnection:
+    """Connexion confiée à un job : la transaction appartient à l'écrivain
+
+    Délègue tout à la connexion sqlite3, sauf ce qui terminerait la transaction
+    du lot : commit(), rollback(), executescript() (COMMIT implicite) et
+    « with conn: ».
+    """
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _forbidden(self, *args, **kwargs):
+        raise sqlite3.ProgrammingError('Write jobs must not end the transaction: the writer commits it')
+
+    commit = rollback = executescript = __enter__ = __exit__ = _forbidden
+
+
+class WriteJob:
+    __slots__ = ('fn', 'key', 'future', '_outcome')
+
+    def __init__(self, fn, key):
+        self.fn = fn
+        self.key = key
+        self.future = Future()
+        # Issue du job : 'writer' (fn a abouti) ou 'caller' (abandon). dict.setdefault
+        # est atomique : pas de verrou partagé entre le greenlet appelant et le
+        # thread natif qui exécute le lot.
+        self._outcome = {}
+
+    def settle(self, by):
+        """Attribue l'issue du job à by ; retourne True si by l'emporte"""
+        return self._outcome.setdefault('by', by) == by
+
+    @property
+    def abandoned(self):
+        return self._outcome.get('by') == 'caller'
+
+
+class DatabaseWriter:
+    """Thread écrivain alimenté par une file bornée
+
+    max_queue borne la profondeur totale de la file ; max_per_key borne les
+    jobs en attente d'un même client (utilisateur) pour qu'un client bavard
+    ne monopolise pas l'écrivain ; max_batch borne le nombre de jobs par
+    transaction. offload(fn, *args), si fourni, exécute les lots hors de la
+    boucle eventlet (la connexion doit accepter check_same_thread=False).
+    """
+
+    def __init__(self, connect, max_queue=1000, max_per_key=20, max_batch=50, offload=None):
+        self.connect = connect
+        self.offload = offload
+        self.max_per_key = max_per_key
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {'jobs': 0, 'batches': 0, 'failed': 0, 'rejected': 0, 'abandoned': 0}
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, fn, key=None):
+        """Met un job en file et retourne son Future ; lève WriterBusy si saturé"""
+        return self._enqueue(fn, key).future
+
+    def write(self, fn, key=None, timeout=None):
+        """Exécute fn(conn) par l'écrivain et attend son résultat au plus timeout secondes
+
+        Au-delà, lève WriteTimeout et abandonne le job : l'écrivain l'ignore ou
+        annule son SAVEPOINT. Si fn a déjà abouti, le lot est en cours de
+        validation : attend son issue plutôt que d'annoncer un échec trompeur.
+        """
+        job = self._enqueue(fn, key)
+        try:
+            return job.future.result(timeout=timeout)
+        except FutureTimeout:
+            if job.settle('caller'):
+                raise WriteTimeout('Write did not complete in time')
+            return job.future.result()
+
+    def _enqueue(self, fn, key):
+        self.start()
+        job = WriteJob(fn, key)
+
+        with self._lock:
+            if key is not None and self._pending[key] >= self.max_per_key:
+                self.stats['rejected'] += 1
+                raise WriterBusy('Too many pending writes for this client')
+            self._pending[key] += 1
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._release(job)
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise WriterBusy('Write queue is full')
+
+        return job
+
+    def _release(self, job):
+        with self._lock:
+            self._pending[job.key] -= 1
+            if self._pending[job.key] <= 0:
+                del self._pending[job.key]
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = self.connect()
+        # Transactions gérées explicitement (BEGIN IMMEDIATE / COMMIT)
+        conn.isolation_level = None
+
+        while True:
+            batch = self._next_batch()
+            try:
+                if self.offload is not None:
+                    outcomes = self.offload(self._execute, conn, batch)
+                else:
+                    outcomes = self._execute(conn, batch)
+                self._resolve(outcomes)
+            except Exception as e:
+                # Échec hors job (BEGIN impossible...) : tout le lot échoue
+                logger.exception('Write batch failed')
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            finally:
+                for job in batch:
+                    self._release(job)
+
+    def _execute(self, conn, batch):
+        """Exécute un lot ; retourne [(job, résultat, exception)] sans toucher aux Futures"""
+        outcomes = []
+        job_conn = JobConnection(conn)
+        conn.execute('BEGIN IMMEDIATE')
+
+        for job in batch:
+            if job.abandoned:
+                outcomes.append((job, None, WriteTimeout('Write abandoned by its caller')))
+                continue
+            conn.execute('SAVEPOINT job')
+            try:
+                result = job.fn(job_conn)
+            except Exception as e:
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                outcomes.append((job, None, e))
+                continue
+
+            if job.settle('writer'):
+                conn.execute('RELEASE job')
+                outcomes.append((job, result, None))
+            else:
+                # Appelant parti pendant fn : ses écritures ne sont pas validées
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                outcomes.append((job, None, WriteTimeout('Write abandoned by its caller')))
+
+        try:
+            conn.execute('COMMIT')
+        except Exception as e:
+            conn.execute('ROLLBACK')
+            outcomes = [(job, None, e) for job, _, _ in outcomes]
+
+        return outcomes
+
+    def _resolve(self, outcomes):
+        self.stats['batches'] += 1
+        for job, result, error in outcomes:
+            if isinstance(error, WriteTimeout):
+                self.stats['abandoned'] += 1
+                job.future.set_exception(error)
+                continue
+            self.stats['jobs'] += 1
+            if error is not None:
+                self.stats['failed'] += 1
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Serveur SMTP local de capture pour MAIL_TEST_MODE (tests locaux)
+
+Accepte les emails sur localhost:1025 sans TLS ni authentification, les
+affiche et, avec --dir, les enregistre en fichiers .eml :
+
+    python scripts/mail_sink.py
+    python scripts/mail_sink.py --dir /tmp/mails --refuse bad@exemple.com --defer lent@exemple.com
+
+--refuse répond 550 (refus définitif) et --defer 450 (échec temporaire) aux
+destinataires indiqués, pour observer les tentatives et les délais de la file.
+"""
+
+import argparse
+import asyncio
+import email
+import email.policy
+import os
+import time
+
+
+class Sink:
+    def __init__(self, directory=None, refuse=(), defer=()):
+        self.directory = directory
+        self.refuse = {address.lower() for address in refuse}
+        self.defer = {address.lower() for address in defer}
+        self.received = 0
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+
+        async def reply(line):
+            writer.write(f'{line}\r\n'.encode('utf-8'))
+            await writer.drain()
+
+        await reply('220 timelocal-sink ESMTP')
+        recipients, data = [], None
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+
+                if data is not None:
+                    if line == '.':
+                        self.store(recipients, '\r\n'.join(data))
+                        recipients, data = [], None
+                        await reply('250 OK: message accepted')
+                    else:
+                        data.append(line[1:] if line.startswith('..') else line)
+                    continue
+
+                command = line[:4].upper()
+                if command in ('EHLO', 'HELO'):
+                    await reply('250-timelocal-sink' if command == 'EHLO' else '250 timelocal-sink')
+                    if command == 'EHLO':
+                        await reply('250-8BITMIME')
+                        await reply('250 SMTPUTF8')
+                elif command == 'MAIL':
+                    recipients = []
+                    await reply('250 OK')
+                elif command == 'RCPT':
+                    address = line.partition(':')[2].strip().strip('<>').lower()
+                    if address in self.refuse:
+                        await reply('550 5.1.1 Mailbox unavailable')
+                    elif address in self.defer:
+                        await reply('450 4.2.1 Mailbox busy, try again later')
+                    else:
+                        recipients.append(address)
+                        await reply('250 OK')
+                elif command == 'DATA':
+                    if not recipients:
+                        await reply('503 No valid recipients')
+                    else:
+                        data = []
+                        await reply('354 End data with <CR><LF>.<CR><LF>')
+                elif command == 'QUIT':
+                    await reply('221 Bye')
+                    break
+                elif command in ('RSET', 'NOOP'):
+                    recipients = [] if command == 'RSET' else recipients
+                    await reply('250 OK')
+                else:
+                    await reply('502 Command not implemented')
+        finally:
+            writer.close()
+            print(f'-- connexion {peer} fermée')
+
+    def store(self, recipients, content):
+        self.received += 1
+        message = email.message_from_string(content, policy=email.policy.default)
+        print(f"#{self.received} {', '.join(recipients)} : {message['Subject']}")
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{time.time_ns()}-{self.received}.eml')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+
+async def serve(host, port, sink):
+    server = await asyncio.start_server(sink.handle, host, port)
+    print(f'Serveur SMTP de capture sur {host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1025, help='MAIL_SINK_PORT du serveur')
+    parser.add_argument('--dir', help='Répertoire où enregistrer les emails (.eml)')
+    parser.add_argument('--refuse', action='append', default=[], help='Destinataire refusé (550)')
+    parser.add_argument('--defer', action='append', default=[], help='Destinataire différé (450)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, Sink(args.dir, args.refuse, args.defer)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
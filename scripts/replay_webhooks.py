@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Rejoue des événements Stripe signés vers le endpoint de webhook (tests locaux)
+
+Les événements viennent d'un fichier NDJSON (un événement JSON par ligne,
+par exemple exporté depuis le tableau de bord Stripe) ou sont générés :
+
+    python scripts/replay_webhooks.py --secret whsec_test events.ndjson
+    python scripts/replay_webhooks.py --secret whsec_test --payment 12 2500
+    python scripts/replay_webhooks.py --secret whsec_test --credits 3 50 1000 --repeat 3
+
+--repeat renvoie chaque événement plusieurs fois, comme Stripe après un
+délai dépassé : seule la première livraison doit être inscrite.
+La signature est calculée ici, indépendamment du code de l'application.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+def sign(payload, secret, timestamp):
+    digest = hmac.new(secret.encode('utf-8'), f'{timestamp}.'.encode('utf-8') + payload, hashlib.sha256)
+    return f't={timestamp},v1={digest.hexdigest()}'
+
+
+def event(event_type, obj):
+    return {
+        'id': f'evt_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'livemode': False,
+        'data': {'object': obj}
+    }
+
+
+def payment_event(metadata, amount):
+    return event('payment_intent.succeeded', {
+        'id': f'pi_{uuid.uuid4().hex[:24]}',
+        'object': 'payment_intent',
+        'amount': amount,
+        'amount_received': amount,
+        'currency': 'eur',
+        'status': 'succeeded',
+        'metadata': {key: str(value) for key, value in metadata.items()}
+    })
+
+
+def post(url, payload, secret, bad_signature=False):
+    signature = sign(payload, 'wrong-secret' if bad_signature else secret, int(time.time()))
+    req = urllib.request.Request(url, data=payload, method='POST', headers={
+        'Content-Type': 'application/json',
+        'Stripe-Signature': signature
+    })
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    return status, body.decode('utf-8', 'replace'), (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('events', nargs='?', help='Fichier NDJSON d\'événements')
+    parser.add_argument('--url', default='http://localhost:5000/webhooks/stripe')
+    parser.add_argument('--secret', required=True, help='STRIPE_WEBHOOK_SECRET du serveur')
+    parser.add_argument('--payment', nargs=2, type=int, metavar=('EXCHANGE_ID', 'CENTIMES'),
+                        help='Génère un paiement d\'échange')
+    parser.add_argument('--credits', nargs=3, type=int, metavar=('USER_ID', 'CREDITS', 'CENTIMES'),
+                        help='Génère un achat de crédits temps')
+    parser.add_argument('--repeat', type=int, default=1, help='Livraisons de chaque événement')
+    parser.add_argument('--bad-signature', action='store_true', help='Signe avec un mauvais secret')
+    args = parser.parse_args()
+
+    events = []
+    if args.events:
+        with open(args.events, encoding='utf-8') as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    if args.payment:
+        events.append(payment_event({'exchange_id': args.payment[0]}, args.payment[1]))
+    if args.credits:
+        user_id, credits, amount = args.credits
+        events.append(payment_event({'user_id': user_id, 'credits': credits}, amount))
+    if not events:
+        parser.error('aucun événement : fichier, --payment ou --credits')
+
+    failures = 0
+    for evt in events:
+        payload = json.dumps(evt, separators=(',', ':')).encode('utf-8')
+        for attempt in range(1, args.repeat + 1):
+            status, body, elapsed = post(args.url, payload, args.secret, args.bad_signature)
+            print(f"{evt['id']} {evt['type']} #{attempt}: {status} en {elapsed:.1f} ms {' '.join(body.split())}")
+            failures += status != 200
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
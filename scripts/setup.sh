@@ -103,6 +103,20 @@ install_dependencies() {
     log_info "Dépendances installées ✓"
 }
 
+# Build des assets statiques (empreintes + variantes précompressées)
+build_assets() {
+    log_info "Build des assets statiques..."
+    
+    python3 static_assets.py
+    
+    if [ $? -ne 0 ]; then
+        log_error "Échec du build des assets"
+        exit 1
+    fi
+    
+    log_info "Assets construits dans public_html/dist ✓"
+}
+
 # Génération de la clé secrète
 generate_secret_key() {
     log_info "Génération de la clé secrète..."
@@ -253,11 +267,16 @@ source venv/bin/activate
 # Variables d'environnement
 export FLASK_CONFIG=production
 export PYTHONPATH=$PWD:$PYTHONPATH
+# Écritures confiées à l'écrivain unique du processus
+export WRITE_MODE=${WRITE_MODE:-queue}
 
 # Démarrage avec Gunicorn
+# Un seul worker : l'écrivain SQLite unique (WRITE_MODE=queue) est propre au
+# processus ; plusieurs workers se disputeraient à nouveau le verrou d'écriture.
+# La concurrence vient des greenlets eventlet (--worker-connections).
 exec gunicorn \
     --bind 127.0.0.1:5000 \
-    --workers 4 \
+    --workers 1 \
     --worker-class eventlet \
     --worker-connections 1000 \
     --timeout 120 \
@@ -318,34 +337,37 @@ create_backup_script() {
 #!/bin/bash
 
 # Script de backup TimeLocal
+# La base est sauvegardée à chaud par l'API backup de SQLite (pas d'arrêt,
+# copie cohérente), puis la sauvegarde est vérifiée par PRAGMA integrity_check.
 cd "$(dirname "$0")"
 
+source venv/bin/activate
+
 DATE=$(date +%Y%m%d_%H%M%S)
 BACKUP_DIR="backups"
-BACKUP_FILE="timelocal_backup_$DATE.tar.gz"
-
-echo "Création du backup: $BACKUP_FILE"
+CODE_BACKUP_FILE="timelocal_code_$DATE.tar.gz"
 
-# Arrêter l'application
-./stop_timelocal.sh
+echo "Sauvegarde de la base de données..."
+flask --app app backup || exit 1
+flask --app app backup-verify || exit 1
 
-# Créer l'archive
-tar -czf "$BACKUP_DIR/$BACKUP_FILE" \
+# Code et configuration, sans les bases (sauvegardées ci-dessus)
+tar -czf "$BACKUP_DIR/$CODE_BACKUP_FILE" \
     --exclude='venv' \
     --exclude='logs' \
     --exclude='backups' \
     --exclude='__pycache__' \
     --exclude='*.pyc' \
+    --exclude='*.db' \
+    --exclude='*.db-wal' \
+    --exclude='*.db-shm' \
     .
 
-# Redémarrer l'application
-./start_timelocal.sh
-
-echo "Backup créé: $BACKUP_DIR/$BACKUP_FILE"
+echo "Backup créé: $BACKUP_DIR/$CODE_BACKUP_FILE"
 
-# Nettoyer les anciens backups (garder les 7 derniers)
+# Nettoyer les anciennes archives de code (garder les 7 dernières)
 cd "$BACKUP_DIR"
-ls -t timelocal_backup_*.tar.gz | tail -n +8 | xargs -r rm --
+ls -t timelocal_code_*.tar.gz | tail -n +8 | xargs -r rm --
 
 echo "Backup terminé ✓"
 EOL
@@ -385,7 +407,7 @@ show_final_instructions() {
     echo ""
     echo "6. 🌐 Configuration web serveur :"
     echo "   - Configurer Apache/Nginx pour rediriger vers localhost:5000"
-    echo "   - Copier les fichiers public_html sur votre serveur web"
+    echo "   - Copier le contenu de public_html/dist sur votre serveur web"
     echo ""
     log_warn "⚠️  N'oubliez pas de configurer vos clés API avant de démarrer !"
     echo ""
@@ -401,6 +423,7 @@ main() {
     setup_venv
     activate_venv
     install_dependencies
+    build_assets
     generate_secret_key
     create_env_file
     init_database
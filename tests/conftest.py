@@ -0,0 +1,76 @@
+"""
+Les modules de l'application s'importent depuis app/ (comme sous Gunicorn)
+
+L'application lit sa configuration à l'import : bases, dossiers et réglages
+de test sont donc fixés ici, avant le premier import de `app`.
+"""
+
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+_tmp = tempfile.mkdtemp(prefix='timelocal-tests-')
+os.environ.update({
+    'DATABASE_PATH': os.path.join(_tmp, 'timelocal.db'),
+    'ARCHIVE_DATABASE_PATH': os.path.join(_tmp, 'timelocal_archive.db'),
+    'UPLOAD_FOLDER': os.path.join(_tmp, 'uploads'),
+    'BACKUP_DIR': os.path.join(_tmp, 'backups'),
+    'SHARD_DIR': os.path.join(_tmp, 'shards'),
+    'SCHEDULER_LOCK_PATH': os.path.join(_tmp, 'scheduler.lock'),
+    'PUBLIC_HTML_DIST': os.path.join(_tmp, 'dist'),
+    'SCHEDULER_ENABLED': 'False',
+    'ADMIN_TOKEN': 'test-admin-token',
+    'DB_OFFLOAD_MODE': 'threads'
+})
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+_users = iter(range(1, 10 ** 6))
+
+
+@pytest.fixture
+def user_client(app_module):
+    """Client connecté sous un nouvel utilisateur ; client.user_id"""
+    client = app_module.app.test_client()
+    n = next(_users)
+    credentials = {'email': f'user{n}@exemple.com', 'password': 'secret-pw'}
+    response = client.post('/auth/register', json=dict(
+        credentials, username=f'user{n}', full_name=f'Utilisateur {n}'
+    ))
+    assert response.status_code == 201, response.get_data()
+    client.user_id = response.get_json()['user_id']
+    assert client.post('/auth/login', json=credentials).status_code == 200
+    return client
+
+
+def png_bytes(color=(200, 30, 30), size=(64, 48)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def new_request(client, **fields):
+    """Crée une demande active par l'API ; retourne son identifiant"""
+    data = {'title': 'Tondre la pelouse', 'description': 'Jardin de 200 m²',
+            'category': 'Jardinage', 'type': 'request'}
+    data.update(fields)
+    response = client.post('/requests', json=data)
+    assert response.status_code == 201, response.get_data()
+    return response.get_json()['request_id']
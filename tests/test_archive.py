@@ -0,0 +1,59 @@
+"""
+Archivage des données froides par le chemin d'écriture ordinaire
+"""
+
+import sqlite3
+
+import pytest
+
+from conftest import new_request
+
+
+def _close_long_ago(app_module, request_id):
+    conn = sqlite3.connect(app_module.app.config['DATABASE_PATH'])
+    with conn:
+        conn.execute(
+            "UPDATE requests SET status = 'cancelled', updated_at = '2000-01-01 00:00:00' WHERE id = ?",
+            (request_id,)
+        )
+    conn.close()
+
+
+def _where(app_module, request_id):
+    with app_module.app.app_context():
+        conn = app_module.get_history_db()
+        try:
+            return [
+                schema for schema in ('main', 'archive')
+                if conn.execute(f'SELECT 1 FROM {schema}.requests WHERE id = ?', (request_id,)).fetchone()
+            ]
+        finally:
+            conn.close()
+
+
+@pytest.mark.parametrize('write_mode', ['direct', 'queue'])
+def test_cold_requests_move_to_archive(app_module, user_client, monkeypatch, write_mode):
+    monkeypatch.setitem(app_module.app.config, 'WRITE_MODE', write_mode)
+    request_id = new_request(user_client)
+    _close_long_ago(app_module, request_id)
+    jobs_before = app_module.db_writer.stats['jobs']
+
+    moved = app_module.archive_cold_data()
+    assert moved['requests'] >= 1
+    assert _where(app_module, request_id) == ['archive']
+    if write_mode == 'queue':
+        # Un job par lot et par table, exécutés par l'écrivain unique
+        assert app_module.db_writer.stats['jobs'] - jobs_before >= 3
+
+
+def test_archival_batch_does_not_commit(app_module):
+    """Un lot s'exécute dans la transaction de l'écrivain : aucun commit intermédiaire"""
+    import archive
+
+    conn = sqlite3.connect(app_module.app.config['DATABASE_PATH'], isolation_level=None)
+    archive.attach(conn, app_module.app.config['ARCHIVE_DATABASE_PATH'])
+    conn.execute('BEGIN IMMEDIATE')
+    archive.archive_requests(conn, '2100-01-01 00:00:00', 10)
+    assert conn.in_transaction
+    conn.execute('ROLLBACK')
+    conn.close()
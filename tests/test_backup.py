@@ -0,0 +1,150 @@
+"""
+Sauvegardes complètes et incrémentales : chaînes, restauration, altérations
+"""
+
+import gzip
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import backup
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        yield pool
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'live.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, label TEXT)')
+        conn.executemany('INSERT INTO items (label) VALUES (?)', [(f'item {i}' * 20,) for i in range(500)])
+    conn.close()
+    return path
+
+
+def _write(db_path, sql, params=()):
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute(sql, params)
+    conn.close()
+
+
+def _labels(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT id, label FROM items ORDER BY id').fetchall()
+    finally:
+        conn.close()
+
+
+def _chain(db_path, backup_dir, executor, steps=2):
+    """Complète puis `steps` incrémentales, une écriture avant chacune"""
+    results = [backup.run_backup(db_path, backup_dir, executor)]
+    for step in range(steps):
+        _write(db_path, 'UPDATE items SET label = ? WHERE id = ?', (f'changed {step}', step + 1))
+        results.append(backup.run_backup(db_path, backup_dir, executor))
+    return results
+
+
+def test_full_backup_restores_the_database(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    result = backup.run_backup(db_path, backup_dir, executor)
+
+    assert result['type'] == 'full' and result['name'].endswith('.full.db.gz')
+    assert os.path.exists(os.path.join(backup_dir, backup.LAST_SNAPSHOT))
+
+    target = str(tmp_path / 'restored.db')
+    assert backup.restore(backup_dir, target) == result['name']
+    assert _labels(target) == _labels(db_path)
+
+
+def test_incremental_backup_holds_only_changed_pages(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    full, inc = _chain(db_path, backup_dir, executor, steps=1)
+
+    assert inc['type'] == 'inc' and inc['name'].endswith('.inc.delta.gz')
+    total_pages = os.path.getsize(db_path) // backup.page_size(db_path)
+    assert 0 < inc['changed_pages'] < total_pages
+    assert inc['size'] < full['size']
+
+
+def test_restore_replays_the_chain(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    results = _chain(db_path, backup_dir, executor, steps=3)
+    assert [r['type'] for r in results] == ['full', 'inc', 'inc', 'inc']
+    assert backup.chains(backup_dir) == [[r['name'] for r in results]]
+
+    target = str(tmp_path / 'restored.db')
+    backup.restore(backup_dir, target)
+    assert _labels(target) == _labels(db_path)
+
+    # Restauration à une date intermédiaire : deux premières modifications seulement
+    backup.restore(backup_dir, target, results[2]['name'])
+    labels = dict(_labels(target))
+    assert (labels[1], labels[2], labels[3]) == ('changed 0', 'changed 1', 'item 2' * 20)
+
+    assert backup.verify(backup_dir) == (results[-1]['name'], 'ok')
+
+
+def test_missing_delta_fails_the_restore(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    results = _chain(db_path, backup_dir, executor, steps=2)
+    os.unlink(os.path.join(backup_dir, results[1]['name']))
+
+    with pytest.raises(backup.BackupError, match='missing or altered') as excinfo:
+        backup.restore(backup_dir, str(tmp_path / 'restored.db'))
+    assert results[2]['name'] in str(excinfo.value)
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'flip'])
+def test_corrupted_delta_fails_the_restore(db_path, tmp_path, executor, damage):
+    backup_dir = str(tmp_path / 'backups')
+    results = _chain(db_path, backup_dir, executor, steps=1)
+    path = os.path.join(backup_dir, results[1]['name'])
+
+    with open(path, 'r+b') as f:
+        if damage == 'truncate':
+            f.truncate(os.path.getsize(path) // 2)
+        else:
+            f.seek(os.path.getsize(path) // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+    with pytest.raises(backup.BackupError, match=results[1]['name']):
+        backup.restore(backup_dir, str(tmp_path / 'restored.db'))
+
+
+def test_truncated_delta_content_is_detected(db_path, tmp_path, executor):
+    """Delta gzip valide mais incomplète (écriture interrompue avant compression)"""
+    backup_dir = str(tmp_path / 'backups')
+    results = _chain(db_path, backup_dir, executor, steps=1)
+    path = os.path.join(backup_dir, results[1]['name'])
+    with gzip.open(path, 'rb') as f:
+        content = f.read()
+    with gzip.open(path, 'wb') as f:
+        f.write(content[:-100])
+
+    with pytest.raises(backup.BackupError, match='Truncated'):
+        backup.restore(backup_dir, str(tmp_path / 'restored.db'))
+
+
+def test_unknown_backup_name(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    backup.run_backup(db_path, backup_dir, executor)
+    with pytest.raises(backup.BackupError, match='not found'):
+        backup.restore(backup_dir, str(tmp_path / 'restored.db'), 'timelocal-nope.full.db.gz')
+
+
+def test_rotation_keeps_recent_chains(db_path, tmp_path, executor):
+    backup_dir = str(tmp_path / 'backups')
+    for _ in range(3):
+        backup.run_backup(db_path, backup_dir, executor, incremental=False, retention=2)
+    assert len(backup.chains(backup_dir)) == 2
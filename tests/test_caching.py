@@ -0,0 +1,80 @@
+"""
+ETag / 304 et compression négociée des réponses JSON
+"""
+
+import gzip
+import json
+
+import pytest
+
+import compression
+from conftest import new_request
+
+
+@pytest.fixture
+def feed(user_client):
+    # Corps assez gros pour être compressé (COMPRESS_MIN_SIZE)
+    for i in range(12):
+        new_request(user_client, title=f'Cours de guitare {i}', description='Débutants bienvenus. ' * 10)
+    return user_client
+
+
+def test_gzip_variant_carries_its_own_etag(feed):
+    plain = feed.get('/requests')
+    zipped = feed.get('/requests', headers={'Accept-Encoding': 'gzip'})
+
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(zipped.get_data())) == plain.get_json()
+    assert zipped.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert 'Accept-Encoding' in zipped.headers['Vary'] and 'Accept-Encoding' in plain.headers['Vary']
+
+
+@pytest.mark.parametrize('encoding', [None, 'gzip'])
+def test_304_echoes_the_matched_variant_and_vary(feed, encoding):
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    first = feed.get('/requests', headers=headers)
+    etag = first.headers['ETag']
+
+    again = feed.get('/requests', headers=dict(headers, **{'If-None-Match': etag}))
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+    assert again.headers['Vary'] == 'Accept-Encoding'
+    assert again.get_data() == b''
+
+
+def test_304_for_any_variant_listed_by_the_client(feed):
+    etag = feed.get('/requests').headers['ETag']
+    variant = etag[:-1] + '-gzip"'
+    response = feed.get('/requests', headers={'If-None-Match': f'"other", {variant}'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == variant
+
+
+def test_write_changes_the_etag(feed):
+    etag = feed.get('/requests').headers['ETag']
+    new_request(feed, title='Nouvelle demande')
+    response = feed.get('/requests', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_query_string_is_part_of_the_etag(feed):
+    assert feed.get('/requests?limit=3').headers['ETag'] != feed.get('/requests?limit=4').headers['ETag']
+
+
+def test_health_has_no_validator(client):
+    response = client.get('/health')
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert client.get('/health', headers={'If-None-Match': '*'}).status_code == 200
+
+
+def test_small_bodies_are_not_compressed(client):
+    response = client.get('/health', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_gzip_stream_decompresses_to_the_same_body(app_module):
+    chunks = ['{"a":[', '1,', '2', ']}']
+    compressed = b''.join(compression.compress_stream(chunks, 'gzip', app_module.app.config))
+    assert gzip.decompress(compressed) == b'{"a":[1,2]}'
@@ -0,0 +1,96 @@
+"""
+Expiration des demandes : lots, dates limites héritées et verrou de leader
+"""
+
+import sqlite3
+
+import pytest
+
+import expiry
+import scheduler
+
+from conftest import new_request
+
+
+def _requests(app_module, ids):
+    with app_module.app.app_context():
+        placeholders = ','.join('?' * len(ids))
+        return {row['id']: row for row in app_module.get_db().execute(
+            f'SELECT id, status, deadline FROM requests WHERE id IN ({placeholders})', ids
+        )}
+
+
+@pytest.mark.parametrize('value, stored', [
+    ('2024-05-01T18:00:00', '2024-05-01 18:00:00'),
+    ('2024-05-01T18:00:00Z', '2024-05-01 18:00:00'),
+    ('2024-05-01T20:00:00+02:00', '2024-05-01 18:00:00'),
+    ('2024-05-01', '2024-05-01 00:00:00'),
+    ('', None),
+])
+def test_normalize_deadline(value, stored):
+    assert expiry.normalize_deadline(value) == stored
+
+
+def test_expiry_runs_in_batches_and_notifies(app_module, user_client):
+    ids = [new_request(user_client, deadline='2020-01-01T10:00:00Z') for _ in range(5)]
+    future = new_request(user_client, deadline='2999-01-01T10:00:00Z')
+
+    calls = []
+
+    def run_write(fn):
+        calls.append(fn)
+        return app_module.run_write(fn)
+
+    expired = expiry.expire_overdue_requests(run_write, batch_size=2)
+    assert sorted(row['id'] for row in expired) == sorted(ids)
+    # 2 + 2 + 1 : le dernier lot incomplet arrête la boucle
+    assert len(calls) == 3
+
+    rows = _requests(app_module, ids + [future])
+    assert {rows[i]['status'] for i in ids} == {'expired'}
+    assert rows[future]['status'] == 'active'
+
+    with app_module.app.app_context():
+        notified = app_module.get_db().execute(
+            "SELECT COUNT(*) FROM notifications WHERE user_id = ? AND type = 'request_expired'",
+            (user_client.user_id,)
+        ).fetchone()[0]
+    assert notified == 5
+
+
+def test_legacy_iso_deadlines_are_normalized(app_module, user_client):
+    request_id = new_request(user_client)
+    # Format antérieur à la normalisation, avec fuseau
+    conn = sqlite3.connect(app_module.app.config['DATABASE_PATH'])
+    with conn:
+        conn.execute("UPDATE requests SET deadline = '2020-01-01T10:00:00+02:00' WHERE id = ?", (request_id,))
+        conn.executescript(expiry.NORMALIZE_DEADLINES_SQL)
+    conn.close()
+
+    assert _requests(app_module, [request_id])[request_id]['deadline'] == '2020-01-01 08:00:00'
+    app_module.expire_requests()
+    assert _requests(app_module, [request_id])[request_id]['status'] == 'expired'
+
+
+def test_only_one_process_is_leader(tmp_path):
+    path = str(tmp_path / 'scheduler.lock')
+    first, second = scheduler.LeaderLock(path), scheduler.LeaderLock(path)
+
+    assert first.acquire() and first.held
+    assert not second.acquire() and not second.held
+    # Verrou rendu par le système à la mort du leader
+    scheduler.os.close(first._fd)
+    assert second.acquire()
+
+
+def test_leader_only_jobs_skip_followers(tmp_path):
+    path = str(tmp_path / 'scheduler.lock')
+    leader = scheduler.LeaderLock(path)
+    assert leader.acquire()
+
+    runs = []
+    follower = scheduler.Scheduler(lock=scheduler.LeaderLock(path))
+    follower.every(0, lambda: runs.append('leader'), name='expire', leader_only=True)
+    follower.every(0, lambda: runs.append('local'), name='presence')
+    follower.run_pending()
+    assert runs == ['local']
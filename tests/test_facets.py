@@ -0,0 +1,107 @@
+"""
+Compteurs de facettes : triggers comparés au recalcul complet
+"""
+
+import random
+import sqlite3
+
+import pytest
+
+import facets
+
+SCHEMA = '''
+    CREATE TABLE requests (
+        id INTEGER PRIMARY KEY, status TEXT, category TEXT, type TEXT,
+        exchange_type TEXT, latitude REAL, longitude REAL
+    )
+'''
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'facets.db'))
+    conn.execute(SCHEMA)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _counts(conn):
+    return {
+        (facet, value, cell): count
+        for facet, value, cell, count in conn.execute('SELECT facet, value, cell, count FROM facet_counts')
+        if count
+    }
+
+
+def _triggers(conn, schema='main'):
+    return dict(conn.execute(f"SELECT name, sql FROM {schema}.sqlite_master WHERE type = 'trigger'"))
+
+
+def _churn(conn, rng, operations=300):
+    statuses = ['active', 'active', 'completed', 'expired']
+    categories = ['Jardinage', 'Bricolage', None]
+    for _ in range(operations):
+        action = rng.random()
+        ids = [row[0] for row in conn.execute('SELECT id FROM requests')]
+        point = rng.choice([(None, None), (48.85, 2.35), (45.76, 4.84), (48.1, 2.9)])
+        if action < 0.5 or not ids:
+            conn.execute(
+                'INSERT INTO requests (status, category, type, exchange_type, latitude, longitude) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (rng.choice(statuses), rng.choice(categories), rng.choice(['request', 'offer']),
+                 rng.choice(['time', 'money']), *point)
+            )
+        elif action < 0.85:
+            conn.execute(
+                'UPDATE requests SET status = ?, category = ?, latitude = ?, longitude = ? WHERE id = ?',
+                (rng.choice(statuses), rng.choice(categories), *point, rng.choice(ids))
+            )
+        else:
+            conn.execute('DELETE FROM requests WHERE id = ?', (rng.choice(ids),))
+    conn.commit()
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_triggers_match_reconcile(conn, seed):
+    facets.install(conn, 1.0)
+    _churn(conn, random.Random(seed))
+
+    expected = {key: n for key, n in facets._expected(conn, 1.0).items() if n}
+    assert _counts(conn) == expected
+    assert facets.reconcile(conn, 1.0) == 0
+
+
+def test_install_keeps_unchanged_triggers(conn):
+    assert facets.install(conn, 1.0) == list(facets.TRIGGERS)
+    before = _triggers(conn)
+    assert facets.install(conn, 1.0) == []
+    assert _triggers(conn) == before
+    # schema_sql ne remplace rien non plus
+    conn.executescript(facets.schema_sql(1.0))
+    assert _triggers(conn) == before
+
+
+def test_cell_size_change_recreates_triggers_and_counts(conn):
+    facets.install(conn, 1.0)
+    _churn(conn, random.Random(4), operations=100)
+
+    assert facets.install(conn, 0.5) == list(facets.TRIGGERS)
+    assert not conn.in_transaction
+    assert _counts(conn) == {key: n for key, n in facets._expected(conn, 0.5).items() if n}
+
+    _churn(conn, random.Random(5), operations=100)
+    assert facets.reconcile(conn, 0.5) == 0
+
+
+def test_install_leaves_attached_databases_alone(conn, tmp_path):
+    other = sqlite3.connect(str(tmp_path / 'directory.db'))
+    other.execute(SCHEMA)
+    facets.install(other, 1.0)
+    other.close()
+
+    facets.install(conn, 1.0)
+    conn.execute("ATTACH DATABASE ? AS directory", (str(tmp_path / 'directory.db'),))
+    directory_triggers = _triggers(conn, 'directory')
+    assert facets.install(conn, 0.5) == list(facets.TRIGGERS)
+    assert _triggers(conn, 'directory') == directory_triggers
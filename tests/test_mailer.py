@@ -0,0 +1,238 @@
+"""
+File des emails : digests par utilisateur, nouvelles tentatives et SMTP réutilisé
+"""
+
+import smtplib
+import sqlite3
+
+import pytest
+
+import mailer
+
+NOW = '2030-01-01 12:00:00'
+LATER = '2030-01-02 00:00:00'
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, is_active BOOLEAN DEFAULT TRUE);
+        CREATE TABLE notifications (
+            id INTEGER PRIMARY KEY, user_id INTEGER, title TEXT, message TEXT
+        );
+        INSERT INTO users (id, email) VALUES (1, 'alice@exemple.com'), (2, 'bob@exemple.com');
+        INSERT INTO users (id, email, is_active) VALUES (3, 'eve@exemple.com', FALSE);
+        INSERT INTO users (id, email) VALUES (4, NULL);
+    ''')
+    conn.executescript(mailer.schema_sql(digest_window=300))
+    yield conn
+    conn.close()
+
+
+def _notify(conn, user_id, title):
+    conn.execute('INSERT INTO notifications (user_id, title, message) VALUES (?, ?, ?)',
+                 (user_id, title, f'Détail : {title}'))
+
+
+def _queue(conn):
+    return [dict(row) for row in conn.execute('SELECT * FROM mail_queue ORDER BY id')]
+
+
+def test_notifications_of_a_user_share_one_deadline(conn):
+    _notify(conn, 1, 'Nouveau message')
+    conn.execute("UPDATE mail_queue SET send_after = '2030-01-01 11:00:00'")
+    _notify(conn, 1, 'Échange accepté')
+    _notify(conn, 2, 'Demande expirée')
+
+    rows = _queue(conn)
+    assert [row['kind'] for row in rows] == ['digest'] * 3
+    assert rows[0]['send_after'] == rows[1]['send_after'] == '2030-01-01 11:00:00'
+    # Fenêtre propre à chaque utilisateur
+    assert rows[2]['send_after'] != rows[0]['send_after']
+
+
+def test_inactive_users_and_missing_emails_are_skipped(conn):
+    _notify(conn, 3, 'Compte désactivé')
+    _notify(conn, 4, 'Sans email')
+    assert _queue(conn) == []
+
+
+def test_due_digests_are_merged_per_recipient(conn):
+    for title in ('Nouveau message', 'Échange accepté', 'Demande expirée'):
+        _notify(conn, 1, title)
+    _notify(conn, 2, 'Seul')
+    mailer.enqueue(conn, 'alice@exemple.com', 'Reçu', 'Paiement reçu', user_id=1)
+
+    # Fenêtre de regroupement en cours : rien d'échu
+    assert mailer.due_messages(conn, NOW.replace('2030', '2000'), 50, 'TimeLocal') == []
+
+    messages = {(recipient, subject): (ids, body)
+                for ids, recipient, subject, body in mailer.due_messages(conn, LATER, 50, 'TimeLocal')}
+    ids, body = messages[('alice@exemple.com', 'TimeLocal : 3 nouvelles notifications')]
+    assert ids == [1, 2, 3]
+    assert body.index('Nouveau message') < body.index('Échange accepté') < body.index('Demande expirée')
+    # Un digest d'une seule notification garde son sujet ; un email 'single' part seul
+    assert messages[('bob@exemple.com', 'Seul')] == ([4], 'Détail : Seul')
+    assert messages[('alice@exemple.com', 'Reçu')] == ([5], 'Paiement reçu')
+
+
+def test_retried_digest_does_not_hold_new_notifications(conn):
+    _notify(conn, 1, 'Premier')
+    mailer.record_results(conn, NOW, [], [([1], 'SMTPRecipientsRefused: 450', False)], 600, 5)
+    _notify(conn, 1, 'Second')
+
+    first, second = _queue(conn)
+    assert first['attempts'] == 1
+    # Le nouveau digest ouvre sa propre fenêtre au lieu d'attendre la tentative reportée
+    assert second['send_after'] != first['send_after']
+
+
+def test_temporary_failures_back_off_exponentially(conn):
+    mail_id = mailer.enqueue(conn, 'alice@exemple.com', 'Sujet', 'Corps')
+    delays = []
+    for attempt in range(1, 4):
+        mailer.record_results(conn, NOW, [], [([mail_id], 'SMTPDataError: 451', False)], 60, 5)
+        row = _queue(conn)[0]
+        assert (row['status'], row['attempts']) == ('pending', attempt)
+        delays.append(conn.execute(
+            "SELECT CAST((julianday(send_after) - julianday(?)) * 86400 + 0.5 AS INTEGER) FROM mail_queue",
+            (NOW,)
+        ).fetchone()[0])
+    assert delays == [60, 120, 240]
+
+    mailer.record_results(conn, NOW, [], [([mail_id], 'SMTPDataError: 451', False)], 60, 5)
+    mailer.record_results(conn, NOW, [], [([mail_id], 'SMTPDataError: 451', False)], 60, 5)
+    row = _queue(conn)[0]
+    assert (row['status'], row['attempts']) == ('failed', 5)
+
+
+def test_permanent_failure_and_success(conn):
+    refused = mailer.enqueue(conn, 'nobody@exemple.com', 'Sujet', 'Corps')
+    ok = mailer.enqueue(conn, 'alice@exemple.com', 'Sujet', 'Corps')
+    mailer.record_results(conn, NOW, [ok], [([refused], 'SMTPRecipientsRefused: 550', True)], 60, 5)
+
+    rows = {row['id']: row for row in _queue(conn)}
+    assert (rows[refused]['status'], rows[refused]['attempts']) == ('failed', 1)
+    assert (rows[ok]['status'], rows[ok]['sent_at']) == ('sent', NOW)
+    assert mailer.purge(conn, LATER) == 1
+
+
+class FakePool:
+    """Pool SMTP dont chaque envoi lève l'erreur prévue pour le destinataire"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    def send(self, message):
+        error = self.errors.get(message['To'])
+        if error:
+            raise error
+        self.sent.append(message['To'])
+
+
+def _messages(*recipients):
+    return [([i], recipient, 'Sujet', 'Corps') for i, recipient in enumerate(recipients, 1)]
+
+
+def test_deliver_counts_message_refusals_and_continues():
+    pool = FakePool({
+        'refused@exemple.com': smtplib.SMTPRecipientsRefused({'refused@exemple.com': (550, b'No such user')}),
+        'full@exemple.com': smtplib.SMTPRecipientsRefused({'full@exemple.com': (452, b'Mailbox full')}),
+    })
+    sent, failed, server_error = mailer.deliver(
+        _messages('refused@exemple.com', 'full@exemple.com', 'alice@exemple.com'), pool, 'noreply@exemple.com'
+    )
+    assert sent == [3] and server_error is None
+    assert [(ids, permanent) for ids, _, permanent in failed] == [([1], True), ([2], False)]
+
+
+@pytest.mark.parametrize('error', [
+    smtplib.SMTPServerDisconnected('Connection unexpectedly closed'),
+    smtplib.SMTPAuthenticationError(535, b'Bad credentials'),
+    ConnectionRefusedError(111, 'Connection refused'),
+])
+def test_deliver_stops_on_server_errors_without_counting_attempts(error):
+    pool = FakePool({'bob@exemple.com': error})
+    sent, failed, server_error = mailer.deliver(
+        _messages('alice@exemple.com', 'bob@exemple.com', 'carol@exemple.com'), pool, 'noreply@exemple.com'
+    )
+    assert sent == [1] and failed == []
+    assert type(error).__name__ in server_error
+    assert pool.sent == ['alice@exemple.com']
+
+
+class FakeSMTP:
+    """Serveur SMTP simulé : connexions ouvertes et messages reçus"""
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.messages = []
+        self.disconnect_next = False
+        FakeSMTP.instances.append(self)
+
+    def ehlo(self):
+        return 250, b'ok'
+
+    def starttls(self):
+        return 220, b'ok'
+
+    def login(self, username, password):
+        return 235, b'ok'
+
+    def noop(self):
+        return 250, b'ok'
+
+    def rset(self):
+        return 250, b'ok'
+
+    def send_message(self, message):
+        if self.disconnect_next:
+            self.disconnect_next = False
+            raise smtplib.SMTPServerDisconnected('Server closed the connection')
+        if message['To'].startswith('refused'):
+            raise smtplib.SMTPRecipientsRefused({message['To']: (550, b'No such user')})
+        self.messages.append(message['To'])
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    FakeSMTP.instances = []
+    monkeypatch.setattr(mailer.smtplib, 'SMTP', FakeSMTP)
+    return FakeSMTP.instances
+
+
+def _send(pool, *recipients):
+    for recipient in recipients:
+        pool.send(mailer.build_message('noreply@exemple.com', recipient, 'Sujet', 'Corps'))
+
+
+def test_pool_reuses_connections_up_to_max_messages(smtp):
+    pool = mailer.SMTPPool('localhost', 1025, username='user', password='pw', max_messages=2)
+    _send(pool, 'a@exemple.com', 'b@exemple.com', 'c@exemple.com')
+    assert [conn.messages for conn in smtp] == [['a@exemple.com', 'b@exemple.com'], ['c@exemple.com']]
+    assert pool.stats == {'connections': 2, 'sent': 3, 'errors': 0}
+
+
+def test_pool_reconnects_once_after_server_disconnect(smtp):
+    pool = mailer.SMTPPool('localhost', 1025)
+    _send(pool, 'a@exemple.com')
+    smtp[0].disconnect_next = True
+    _send(pool, 'b@exemple.com')
+    assert [conn.messages for conn in smtp] == [['a@exemple.com'], ['b@exemple.com']]
+
+
+def test_pool_keeps_connection_after_message_refusal(smtp):
+    pool = mailer.SMTPPool('localhost', 1025)
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        _send(pool, 'refused@exemple.com')
+    _send(pool, 'a@exemple.com')
+    assert len(smtp) == 1 and pool.stats['errors'] == 1
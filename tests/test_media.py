@@ -0,0 +1,99 @@
+"""
+Images envoyées : stockage par empreinte et miniatures
+"""
+
+import io
+import logging
+import os
+from concurrent.futures import Future
+
+import pytest
+
+import media
+from conftest import png_bytes
+
+
+def test_same_content_is_stored_once(tmp_path):
+    data = png_bytes()
+    first = media.store_upload(io.BytesIO(data), str(tmp_path), chunk_size=100)
+    second = media.store_upload(io.BytesIO(data), str(tmp_path), chunk_size=7)
+
+    assert first[:2] == second[:2]
+    assert (first[2], second[2]) == (True, False)
+    content_hash, extension, _ = first
+    with open(media.original_path(str(tmp_path), content_hash, extension), 'rb') as f:
+        assert f.read() == data
+    # Aucun fichier temporaire laissé par le doublon
+    assert os.listdir(tmp_path / 'tmp') == []
+
+
+def test_different_content_gets_its_own_hash(tmp_path):
+    red = media.store_upload(io.BytesIO(png_bytes((255, 0, 0))), str(tmp_path))
+    blue = media.store_upload(io.BytesIO(png_bytes((0, 0, 255))), str(tmp_path))
+    assert red[0] != blue[0]
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'', 'Empty file'),
+    (b'not an image at all', 'not a valid image'),
+])
+def test_rejected_upload_leaves_nothing(tmp_path, data, message):
+    with pytest.raises(media.UploadError, match=message):
+        media.store_upload(io.BytesIO(data), str(tmp_path))
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert not (tmp_path / 'originals').exists()
+
+
+def test_too_large_upload_is_rejected(tmp_path):
+    with pytest.raises(media.UploadError, match='too large'):
+        media.store_upload(io.BytesIO(png_bytes()), str(tmp_path), chunk_size=16, max_size=32)
+    assert os.listdir(tmp_path / 'tmp') == []
+
+
+def test_thumbnails_are_generated_once(tmp_path):
+    content_hash, extension, _ = media.store_upload(io.BytesIO(png_bytes(size=(400, 200))), str(tmp_path))
+    assert media.make_thumbnails(str(tmp_path), content_hash, extension, [64, 128]) == [64, 128]
+    assert media.make_thumbnails(str(tmp_path), content_hash, extension, [64, 128, 256]) == [256]
+    from PIL import Image
+    with Image.open(media.thumbnail_path(str(tmp_path), content_hash, 128)) as thumb:
+        assert thumb.format == 'WEBP' and thumb.size == (128, 64)
+
+
+def test_thumbnail_failure_leaves_no_partial_file(tmp_path):
+    content_hash, extension, _ = media.store_upload(io.BytesIO(png_bytes()), str(tmp_path))
+    # Original tronqué après coup : l'en-tête ne suffit plus au décodage
+    path = media.original_path(str(tmp_path), content_hash, extension)
+    with open(path, 'r+b') as f:
+        f.truncate(40)
+
+    with pytest.raises(OSError):
+        media.make_thumbnails(str(tmp_path), content_hash, extension, [64])
+    thumbs = tmp_path / 'thumbs'
+    assert not thumbs.exists() or not any(files for _, _, files in os.walk(thumbs))
+
+
+def test_thumbnail_failure_is_logged(app_module, caplog):
+    future = Future()
+    future.set_exception(OSError('broken image'))
+    with caplog.at_level(logging.ERROR, logger=app_module.app.logger.name):
+        app_module._log_thumbnail_failure(future, 'abc123')
+    assert 'abc123' in caplog.text and 'broken image' in caplog.text
+
+    ok = Future()
+    ok.set_result([64])
+    caplog.clear()
+    app_module._log_thumbnail_failure(ok, 'abc123')
+    assert caplog.text == ''
+
+
+def test_upload_endpoint_deduplicates(user_client):
+    data = png_bytes((10, 200, 10))
+    responses = [
+        user_client.post('/uploads', data={'file': (io.BytesIO(data), 'photo.png')},
+                         content_type='multipart/form-data')
+        for _ in range(2)
+    ]
+    first, second = (r.get_json() for r in responses)
+    assert [r.status_code for r in responses] == [201, 200]
+    assert first['hash'] == second['hash']
+    assert (first['created'], second['created']) == (True, False)
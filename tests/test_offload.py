@@ -0,0 +1,76 @@
+"""
+Pool d'exécution des appels SQLite : délais, interruption et places du pool
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from offload import Offloader, OffloadTimeout
+
+ENDLESS_QUERY = '''
+    WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+    SELECT COUNT(*) FROM c
+'''
+
+
+def test_timeout_calls_the_handler():
+    offloader = Offloader(max_workers=2, mode='threads')
+    release, handled = threading.Event(), []
+
+    with pytest.raises(OffloadTimeout):
+        offloader.call(release.wait, 5, timeout=0.05, on_timeout=lambda: handled.append(True))
+    release.set()
+
+    assert handled == [True]
+    stats = offloader.snapshot()
+    assert (stats['timeouts'], stats['failed'], stats['in_flight']) == (1, 1, 0)
+
+
+def test_errors_propagate():
+    offloader = Offloader(mode='threads')
+    with pytest.raises(ZeroDivisionError):
+        offloader.call(lambda: 1 / 0)
+    assert offloader.call(sum, [1, 2, 3]) == 6
+
+
+def test_run_query_interrupts_an_expired_query(tmp_path):
+    offloader = Offloader(max_workers=1, mode='threads')
+    path = str(tmp_path / 'slow.db')
+
+    started = time.monotonic()
+    with pytest.raises(OffloadTimeout):
+        offloader.run_query(lambda: sqlite3.connect(path, check_same_thread=False),
+                            lambda conn: conn.execute(ENDLESS_QUERY).fetchall(), timeout=0.1)
+
+    # Requête interrompue : l'unique thread du pool est aussitôt disponible
+    assert offloader.run_query(lambda: sqlite3.connect(path, check_same_thread=False),
+                               lambda conn: conn.execute('SELECT 1').fetchone()[0], timeout=2) == 1
+    assert time.monotonic() - started < 2
+
+
+def test_tpool_slot_is_held_until_the_native_call_ends():
+    pytest.importorskip('eventlet')
+    offloader = Offloader(max_workers=1, mode='tpool')
+    release = threading.Event()
+
+    with pytest.raises(OffloadTimeout):
+        offloader.call(release.wait, 5, timeout=0.05)
+    # L'appelant est parti, le thread natif tourne encore
+    assert offloader._slots.balance == 0
+    with pytest.raises(OffloadTimeout):
+        offloader.call(lambda: 'queued', timeout=0.05)
+
+    release.set()
+    assert offloader.call(lambda: 'next', timeout=2) == 'next'
+    assert offloader._slots.balance == 1
+
+
+def test_tpool_errors_propagate():
+    pytest.importorskip('eventlet')
+    offloader = Offloader(max_workers=1, mode='tpool')
+    with pytest.raises(ZeroDivisionError):
+        offloader.call(lambda: 1 / 0)
+    assert offloader._slots.balance == 1
@@ -0,0 +1,257 @@
+"""
+Webhooks de paiement : signature, reprise des événements en erreur, report
+des montants sur les échanges partitionnés
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+import payments
+from shards import ShardError
+
+SECRET = 'whsec_test'
+NOW = '2026-01-01 12:00:00'
+
+
+def connect():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript(payments.PAYMENTS_SCHEMA)
+    conn.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY, time_credits INTEGER DEFAULT 0,
+            credits_flagged BOOLEAN DEFAULT FALSE, updated_at TIMESTAMP
+        );
+        CREATE TABLE exchanges (id INTEGER PRIMARY KEY, amount_paid REAL DEFAULT 0, updated_at TIMESTAMP);
+    ''')
+    return conn
+
+
+def payment_event(event_id, metadata, amount=1000, intent_id=None):
+    return json.dumps({
+        'id': event_id,
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': intent_id or f'pi_{event_id}',
+            'amount_received': amount,
+            'currency': 'eur',
+            'metadata': metadata
+        }}
+    })
+
+
+def record(conn, payload):
+    event_id, event_type = payments.parse_event(payload)
+    return payments.record_event(conn, event_id, event_type, payload)
+
+
+# Signature
+
+def test_signature_roundtrip():
+    payload = b'{"id": "evt_1"}'
+    header = payments.sign(payload, SECRET, timestamp=1000)
+    payments.verify_signature(payload, header, SECRET, now=1010)
+
+
+def test_signature_rejects_other_secret_and_altered_payload():
+    payload = b'{"id": "evt_1"}'
+    header = payments.sign(payload, SECRET, timestamp=1000)
+    with pytest.raises(payments.SignatureError, match='mismatch'):
+        payments.verify_signature(payload, header, 'whsec_other', now=1000)
+    with pytest.raises(payments.SignatureError, match='mismatch'):
+        payments.verify_signature(payload + b' ', header, SECRET, now=1000)
+
+
+def test_signature_accepts_any_secret_during_rotation():
+    payload = b'{"id": "evt_1"}'
+    old = payments.sign(payload, 'whsec_old', timestamp=1000).rpartition(',')[2]
+    header = payments.sign(payload, SECRET, timestamp=1000) + ',' + old
+    payments.verify_signature(payload, header, 'whsec_old', now=1000)
+    payments.verify_signature(payload, header, SECRET, now=1000)
+
+
+@pytest.mark.parametrize('header', [None, '', 'v1=abc', 't=abc,v1=abc', 't=1000'])
+def test_signature_rejects_malformed_header(header):
+    with pytest.raises(payments.SignatureError, match='Malformed'):
+        payments.verify_signature(b'{}', header, SECRET, now=1000)
+
+
+def test_signature_rejects_stale_timestamp():
+    payload = b'{}'
+    header = payments.sign(payload, SECRET, timestamp=1000)
+    with pytest.raises(payments.SignatureError, match='tolerance'):
+        payments.verify_signature(payload, header, SECRET, tolerance=300, now=1301)
+    payments.verify_signature(payload, header, SECRET, tolerance=0, now=10 ** 9)
+
+
+# Traitement différé
+
+def test_duplicate_delivery_is_recorded_once():
+    conn = connect()
+    payload = payment_event('evt_1', {'exchange_id': '1'})
+    assert record(conn, payload)
+    assert not record(conn, payload)
+    assert conn.execute('SELECT COUNT(*) FROM webhook_inbox').fetchone()[0] == 1
+
+
+def test_failed_event_is_backed_off_then_marked_failed():
+    conn = connect()
+    # Utilisateur inconnu : le crédit échoue à chaque essai
+    record(conn, payment_event('evt_1', {'user_id': '42', 'credits': '3'}))
+
+    assert payments.process_batch(conn, 10, 3, NOW, 60) == {'error': 1}
+    row = conn.execute('SELECT status, attempts, next_attempt_at, last_error FROM webhook_inbox').fetchone()
+    assert (row['status'], row['attempts'], row['next_attempt_at']) == ('pending', 1, '2026-01-01 12:01:00')
+    assert 'Unknown user 42' in row['last_error']
+    # Annulé avec son SAVEPOINT : aucun paiement enregistré
+    assert conn.execute('SELECT COUNT(*) FROM payments').fetchone()[0] == 0
+
+    # Pas de nouvel essai avant l'échéance, puis un délai doublé
+    assert payments.process_batch(conn, 10, 3, '2026-01-01 12:00:59', 60) == {}
+    assert payments.process_batch(conn, 10, 3, '2026-01-01 12:01:00', 60) == {'error': 1}
+    row = conn.execute('SELECT status, attempts, next_attempt_at FROM webhook_inbox').fetchone()
+    assert (row['status'], row['attempts'], row['next_attempt_at']) == ('pending', 2, '2026-01-01 12:03:00')
+
+    assert payments.process_batch(conn, 10, 3, '2026-01-01 12:03:00', 60) == {'error': 1}
+    assert tuple(conn.execute('SELECT status, attempts FROM webhook_inbox').fetchone()) == ('failed', 3)
+    assert payments.process_batch(conn, 10, 3, '2027-01-01 00:00:00', 60) == {}
+
+
+def test_backed_off_event_succeeds_once_fixed():
+    conn = connect()
+    record(conn, payment_event('evt_1', {'user_id': '42', 'credits': '3'}))
+    payments.process_batch(conn, 10, 3, NOW, 60)
+
+    conn.execute('INSERT INTO users (id) VALUES (42)')
+    assert payments.process_batch(conn, 10, 3, '2026-01-01 12:01:00', 60) == {'processed': 1}
+    assert conn.execute('SELECT time_credits FROM users WHERE id = 42').fetchone()[0] == 3
+    row = conn.execute('SELECT status, last_error FROM webhook_inbox').fetchone()
+    assert (row['status'], row['last_error']) == ('processed', None)
+
+
+def test_error_does_not_block_other_events():
+    conn = connect()
+    conn.execute('INSERT INTO users (id) VALUES (1)')
+    record(conn, payment_event('evt_1', {'user_id': '42', 'credits': '3'}))
+    record(conn, payment_event('evt_2', {'user_id': '1', 'credits': '2'}))
+    record(conn, json.dumps({'id': 'evt_3', 'type': 'customer.created', 'data': {'object': {}}}))
+
+    assert payments.process_batch(conn, 10, 3, NOW, 60) == {'error': 1, 'processed': 1, 'ignored': 1}
+    assert conn.execute('SELECT time_credits FROM users WHERE id = 1').fetchone()[0] == 2
+
+
+# Report sur les échanges, base des paiements et shards séparés
+
+def test_sync_exchange_totals_across_shards():
+    directory = connect()
+    shard_conns = {'east': connect(), 'west': connect()}
+    shard_conns['east'].execute('INSERT INTO exchanges (id) VALUES (1)')
+    shard_conns['west'].execute('INSERT INTO exchanges (id) VALUES (2)')
+    located = {1: 'east', 2: 'west', 3: 'east'}
+
+    def locate(exchange_id):
+        if exchange_id not in located:
+            raise ShardError(f'Unknown region for id {exchange_id}')
+        return located[exchange_id]
+
+    def read(fn):
+        return fn(directory)
+
+    def write(fn, shard):
+        conn = directory if shard is None else shard_conns[shard]
+        with conn:
+            return fn(conn)
+
+    for event_id, exchange_id, amount in [('a', 1, 1000), ('b', 1, 500), ('c', 2, 700), ('d', 3, 100), ('e', 99, 200)]:
+        record(directory, payment_event(event_id, {'exchange_id': str(exchange_id)}, amount))
+    assert payments.process_batch(directory, 10, 3, NOW, 60) == {'processed': 5}
+
+    # 3 : shard connu mais échange absent ; 99 : aucune région (ShardError)
+    assert payments.sync_exchange_totals(read, write, locate, batch_size=2) == (2, [3, 99])
+    assert shard_conns['east'].execute('SELECT amount_paid FROM exchanges WHERE id = 1').fetchone()[0] == 15.0
+    assert shard_conns['west'].execute('SELECT amount_paid FROM exchanges WHERE id = 2').fetchone()[0] == 7.0
+
+    # Les introuvables sont marqués reportés : le passage suivant n'a plus rien à faire
+    assert directory.execute('SELECT COUNT(*) FROM payments WHERE exchange_synced = 0').fetchone()[0] == 0
+    assert payments.sync_exchange_totals(read, write, locate, batch_size=2) == (0, [])
+
+
+def test_refund_resyncs_exchange_total():
+    directory = connect()
+    directory.execute('INSERT INTO exchanges (id) VALUES (1)')
+
+    def write(fn, shard):
+        with directory:
+            return fn(directory)
+
+    record(directory, payment_event('a', {'exchange_id': '1'}, 1000, intent_id='pi_1'))
+    record(directory, json.dumps({'id': 'r', 'type': 'charge.refunded', 'data': {'object': {
+        'payment_intent': 'pi_1', 'amount_refunded': 400, 'currency': 'eur'
+    }}}))
+    assert payments.process_batch(directory, 10, 3, NOW, 60) == {'processed': 2}
+    assert payments.sync_exchange_totals(lambda fn: fn(directory), write, lambda _: None, 10) == (1, [])
+    assert directory.execute('SELECT amount_paid FROM exchanges WHERE id = 1').fetchone()[0] == 6.0
+
+
+# Remboursement d'un achat de crédits
+
+def refund_event(event_id, intent_id, amount_refunded):
+    return json.dumps({'id': event_id, 'type': 'charge.refunded', 'data': {'object': {
+        'payment_intent': intent_id, 'amount_refunded': amount_refunded, 'currency': 'eur'
+    }}})
+
+
+def credits_state(conn, user_id=42, intent_id='pi_1'):
+    user = conn.execute('SELECT time_credits, credits_flagged FROM users WHERE id = ?', (user_id,)).fetchone()
+    payment = conn.execute(
+        'SELECT credits_revoked, credits_owed FROM payments WHERE intent_id = ?', (intent_id,)
+    ).fetchone()
+    return user['time_credits'], bool(user['credits_flagged']), payment['credits_revoked'], payment['credits_owed']
+
+
+def test_refund_debits_purchased_credits_once():
+    conn = connect()
+    conn.execute('INSERT INTO users (id) VALUES (42)')
+    record(conn, payment_event('a', {'user_id': '42', 'credits': '10'}, 1000, intent_id='pi_1'))
+    # Remboursement partiel (arrondi au supérieur), rejoué, puis total
+    record(conn, refund_event('r1', 'pi_1', 250))
+    record(conn, refund_event('r1-bis', 'pi_1', 250))
+    assert payments.process_batch(conn, 10, 3, NOW, 60) == {'processed': 3}
+    assert credits_state(conn) == (7, False, 3, 0)
+
+    record(conn, refund_event('r2', 'pi_1', 1000))
+    payments.process_batch(conn, 10, 3, NOW, 60)
+    assert credits_state(conn) == (0, False, 10, 0)
+
+
+def test_refund_received_before_payment_still_debits():
+    conn = connect()
+    conn.execute('INSERT INTO users (id, time_credits) VALUES (42, 5)')
+    record(conn, refund_event('r', 'pi_1', 1000))
+    record(conn, payment_event('a', {'user_id': '42', 'credits': '10'}, 1000, intent_id='pi_1'))
+    assert payments.process_batch(conn, 10, 3, NOW, 60) == {'processed': 2}
+    assert credits_state(conn) == (5, False, 10, 0)
+
+
+def test_refund_of_spent_credits_flags_account():
+    conn = connect()
+    conn.execute('INSERT INTO users (id) VALUES (42)')
+    record(conn, payment_event('a', {'user_id': '42', 'credits': '10'}, 1000, intent_id='pi_1'))
+    payments.process_batch(conn, 10, 3, NOW, 60)
+    conn.execute('UPDATE users SET time_credits = 4 WHERE id = 42')
+
+    record(conn, refund_event('r', 'pi_1', 1000))
+    assert payments.process_batch(conn, 10, 3, NOW, 60) == {'processed': 1}
+    # Rien de retiré : solde intact, compte signalé, reste dû noté
+    assert credits_state(conn) == (4, True, 0, 10)
+
+
+def test_exchange_refund_leaves_credits_alone():
+    conn = connect()
+    conn.execute('INSERT INTO users (id, time_credits) VALUES (42, 5)')
+    record(conn, payment_event('a', {'exchange_id': '1', 'user_id': '42'}, 1000, intent_id='pi_1'))
+    record(conn, refund_event('r', 'pi_1', 1000))
+    payments.process_batch(conn, 10, 3, NOW, 60)
+    assert credits_state(conn) == (5, False, 0, 0)
@@ -0,0 +1,82 @@
+"""
+Registre de présence : écriture par lots et configuration Redis
+"""
+
+import sqlite3
+
+import pytest
+
+import presence
+
+
+def test_failed_write_keeps_activity_for_next_flush(app_module, user_client, monkeypatch):
+    registry = app_module.presence_registry
+    registry.drain()
+    registry.record_login(user_client.user_id)
+
+    def failing_write(fn, key=None, shard=None):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(app_module, 'run_write', failing_write)
+    with pytest.raises(sqlite3.OperationalError):
+        app_module.flush_presence()
+    monkeypatch.undo()
+
+    assert app_module.flush_presence() == 1
+    with app_module.app.app_context():
+        row = app_module.get_db().execute(
+            'SELECT last_seen, last_login FROM users WHERE id = ?', (user_client.user_id,)
+        ).fetchone()
+    assert row['last_seen'] is not None and row['last_login'] is not None
+
+
+def test_restore_keeps_newer_activity():
+    registry = presence.PresenceRegistry(ttl=90)
+    registry.connect(1, 'sid-1')
+    pending = registry.drain()
+    registry.touch(1)
+    newer = registry._records[1].last_seen
+
+    registry.restore([(user_id, 0.0, 123.0) for user_id, _, _ in pending])
+    assert registry.drain() == [(1, newer, 123.0)]
+
+
+def test_restore_brings_back_forgotten_users():
+    registry = presence.PresenceRegistry(ttl=0)
+    registry.connect(7, 'sid')
+    registry.disconnect(7, 'sid')
+    pending = registry.drain()
+    assert 7 not in registry._records
+
+    registry.restore(pending)
+    assert [user_id for user_id, _, _ in registry.drain()] == [7]
+
+
+def test_memory_url_uses_local_registry():
+    assert type(presence.create_registry('memory://', 90)) is presence.PresenceRegistry
+
+
+def test_redis_url_without_module_raises(monkeypatch):
+    monkeypatch.setattr(presence, 'redis', None)
+    with pytest.raises(RuntimeError, match='module redis'):
+        presence.create_registry('redis://localhost:6379/0', 90)
+
+
+def test_unreachable_redis_raises(monkeypatch):
+    class RedisError(Exception):
+        pass
+
+    class Client:
+        def ping(self):
+            raise RedisError('Connection refused')
+
+    class FakeRedis:
+        class Redis:
+            @staticmethod
+            def from_url(url):
+                return Client()
+
+    FakeRedis.RedisError = RedisError
+    monkeypatch.setattr(presence, 'redis', FakeRedis)
+    with pytest.raises(RuntimeError, match='injoignable'):
+        presence.create_registry('redis://localhost:6379/0', 90)
@@ -0,0 +1,69 @@
+"""
+Projections fields= / view= : seules les colonnes déclarées sont exposées
+"""
+
+import pytest
+
+from conftest import new_request
+from projections import PROFILE_PROJECTION, REQUEST_PROJECTION, Projection, ProjectionError
+
+SECRET_FIELDS = ('password_hash', 'u.password_hash', 'password_hash AS id', 'id FROM users --')
+
+
+def test_no_projection_declares_a_secret_column():
+    for projection in (PROFILE_PROJECTION, REQUEST_PROJECTION):
+        assert not any('password' in name or 'password' in sql for name, sql in projection.columns.items())
+        for view in projection.views.values():
+            assert set(view) <= set(projection.columns)
+
+
+@pytest.mark.parametrize('projection', [PROFILE_PROJECTION, REQUEST_PROJECTION])
+@pytest.mark.parametrize('fields', SECRET_FIELDS)
+def test_unknown_or_injected_fields_are_rejected(projection, fields):
+    with pytest.raises(ProjectionError):
+        projection.resolve(f'id,{fields}')
+
+
+def test_resolve_keeps_requested_order_without_duplicates():
+    projection = Projection({'a': 't.a', 'b': 't.b'}, {'default': ['a']})
+    assert projection.resolve(' b, a ,b,') == ['b', 'a']
+    assert projection.resolve(None, 'default') == ['a']
+    with pytest.raises(ProjectionError, match='Unknown view'):
+        projection.resolve(None, 'full')
+
+
+@pytest.mark.parametrize('query', [
+    '', 'view=compact', 'view=default', 'fields=id,email', 'fields=password_hash',
+    'fields=id,password_hash', 'view=compact&fields=password_hash'
+])
+def test_profile_never_returns_password_hash(user_client, query):
+    response = user_client.get(f'/users/profile?{query}')
+    # Empreintes de werkzeug (scrypt ou pbkdf2) : jamais dans une réponse
+    assert b'scrypt:' not in response.get_data() and b'pbkdf2:' not in response.get_data()
+    if 'password_hash' in query:
+        assert response.status_code == 400
+        assert 'user' not in response.get_json()
+    else:
+        assert 'password_hash' not in response.get_json()['user']
+        assert response.status_code == 200
+        assert response.get_json()['user']['id'] == user_client.user_id
+
+
+def test_profile_compact_view_selects_only_its_fields(user_client):
+    user = user_client.get('/users/profile?view=compact').get_json()['user']
+    assert set(user) == set(PROFILE_PROJECTION.views['compact'])
+
+
+@pytest.mark.parametrize('query', ['', 'view=compact', 'fields=id,username,full_name', 'stream=1'])
+def test_feed_never_returns_password_hash(user_client, query):
+    new_request(user_client)
+    response = user_client.get(f'/requests?{query}')
+    assert response.status_code == 200
+    assert b'password' not in response.get_data() and b'scrypt:' not in response.get_data()
+
+
+def test_feed_rejects_user_columns_outside_the_projection(user_client):
+    for fields in ('password_hash', 'email', 'u.email'):
+        response = user_client.get(f'/requests?fields=id,{fields}')
+        assert response.status_code == 400
+        assert b'Unknown fields' in response.get_data()
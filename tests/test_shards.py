@@ -0,0 +1,213 @@
+"""
+Partitionnement : migration d'une base unique et déplacement de régions
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+import caching
+import facets
+import shards
+import sync
+
+# Deux régions distinctes avec une grille de 1 degré
+PARIS = (48.85, 2.35)
+LYON = (45.76, 4.84)
+
+
+@pytest.fixture
+def directory(app_module, tmp_path):
+    """Base unique (schéma de l'application) avec deux utilisateurs"""
+    path = str(tmp_path / 'directory.db')
+    app_module.init_db(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)',
+            [(1, 'alice', 'alice@exemple.com', 'x'), (2, 'bob', 'bob@exemple.com', 'x')]
+        )
+    conn.close()
+    return path
+
+
+def _router(directory, tmp_path):
+    return shards.ShardRouter(
+        directory, str(tmp_path / 'shards'), 1.0, refresh=0,
+        schema_sql=caching.schema_sql(shards.SHARDED_TABLES) + sync.schema_sql(shards.SHARDED_TABLES),
+        setup=lambda conn: facets.install(conn, 1.0)
+    )
+
+
+def _populate(path):
+    """Une demande par ville, un échange et un message chacune ; paiement et notifications"""
+    conn = sqlite3.connect(path)
+    with conn:
+        for request_id, (lat, lon) in ((10, PARIS), (20, LYON)):
+            conn.execute(
+                'INSERT INTO requests (id, user_id, title, description, category, type, latitude, longitude) '
+                "VALUES (?, 1, 'titre', 'description', 'Jardinage', 'request', ?, ?)",
+                (request_id, lat, lon)
+            )
+            conn.execute(
+                'INSERT INTO exchanges (id, request_id, requester_id, provider_id) VALUES (?, ?, 1, 2)',
+                (request_id + 1, request_id)
+            )
+            conn.execute(
+                "INSERT INTO messages (id, exchange_id, sender_id, content) VALUES (?, ?, 2, 'bonjour')",
+                (request_id + 2, request_id + 1)
+            )
+        conn.execute(
+            "INSERT INTO payments (intent_id, purpose, exchange_id, amount) VALUES ('pi_1', 'exchange', 11, 500)"
+        )
+        conn.execute(
+            "INSERT INTO notifications (user_id, title, message, type, data) VALUES (1, 't', 'm', 'new_message', ?)",
+            (json.dumps({'exchange_id': 11, 'message_id': 12, 'other': 11}),)
+        )
+        conn.execute(
+            "INSERT INTO notifications (user_id, title, message, type, data) VALUES (1, 't', 'm', 'info', 'not json')"
+        )
+    conn.close()
+
+
+def _rows(router, table):
+    """Lignes d'une table sur tous les fichiers de shards : {id: (shard, row)}"""
+    found = {}
+    for shard in router.shards():
+        conn = router.connect(shard)
+        try:
+            for row in conn.execute(f'SELECT * FROM main.{table}'):
+                assert row['id'] not in found, f'{table} {row["id"]} in two shards'
+                found[row['id']] = (shard, dict(row))
+        finally:
+            conn.close()
+    return found
+
+
+def _directory_rows(path, sql):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_migrate_remaps_ids_and_references(directory, tmp_path):
+    _populate(directory)
+    router = _router(directory, tmp_path)
+
+    assert router.migrate(batch_size=1) == {'requests': 2, 'exchanges': 2, 'messages': 2}
+
+    requests = _rows(router, 'requests')
+    exchanges = _rows(router, 'exchanges')
+    messages = _rows(router, 'messages')
+    paris = router.locate(*PARIS)
+
+    (paris_request,) = [i for i, (shard, _) in requests.items() if shard == paris[1]]
+    assert shards.region_index(paris_request) == paris[0]
+    (paris_exchange,) = [i for i, (_, row) in exchanges.items() if row['request_id'] == paris_request]
+    (paris_message,) = [i for i, (_, row) in messages.items() if row['exchange_id'] == paris_exchange]
+    # Échange et message rangés dans la région de leur demande
+    assert {shards.region_index(paris_exchange), shards.region_index(paris_message)} == {paris[0]}
+
+    assert _directory_rows(directory, 'SELECT exchange_id FROM payments') == [(paris_exchange,)]
+    data = [row[0] for row in _directory_rows(directory, 'SELECT data FROM notifications ORDER BY id')]
+    assert json.loads(data[0]) == {'exchange_id': paris_exchange, 'message_id': paris_message, 'other': 11}
+    assert data[1] == 'not json'
+    for table in shards.SHARDED_TABLES:
+        assert _directory_rows(directory, f'SELECT COUNT(*) FROM {table}') == [(0,)]
+
+
+def test_interrupted_migration_resumes(directory, tmp_path, monkeypatch):
+    _populate(directory)
+    router = _router(directory, tmp_path)
+    allocate = shards.allocate_id
+    calls = []
+
+    def failing_allocate(conn, table, region_idx):
+        calls.append(table)
+        if len(calls) == 4:
+            raise sqlite3.OperationalError('disk I/O error')
+        return allocate(conn, table, region_idx)
+
+    monkeypatch.setattr(shards, 'allocate_id', failing_allocate)
+    with pytest.raises(sqlite3.OperationalError):
+        router.migrate(batch_size=1)
+    monkeypatch.setattr(shards, 'allocate_id', allocate)
+
+    # Seules les lignes restantes sont copiées à la reprise
+    assert router.migrate(batch_size=1) == {'requests': 0, 'exchanges': 1, 'messages': 2}
+    assert [len(_rows(router, table)) for table in shards.SHARDED_TABLES] == [2, 2, 2]
+    exchange_ids = {row['request_id'] for _, row in _rows(router, 'exchanges').values()}
+    assert exchange_ids == set(_rows(router, 'requests'))
+    (payment,) = _directory_rows(directory, 'SELECT exchange_id FROM payments')
+    assert payment[0] in _rows(router, 'exchanges')
+
+
+def test_migrate_refuses_a_populated_archive(directory, tmp_path):
+    _populate(directory)
+    archive_path = str(tmp_path / 'archive.db')
+    conn = sqlite3.connect(archive_path)
+    with conn:
+        conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, exchange_id INTEGER)')
+        conn.execute('INSERT INTO messages VALUES (1, 1)')
+    conn.close()
+
+    router = _router(directory, tmp_path)
+    with pytest.raises(shards.ShardError, match='not empty'):
+        router.migrate(archive_path=archive_path)
+    assert _directory_rows(directory, 'SELECT COUNT(*) FROM requests') == [(2,)]
+    assert router.shards() == []
+
+    # Archive vide : la migration démarre
+    conn = sqlite3.connect(archive_path)
+    with conn:
+        conn.execute('DELETE FROM messages')
+    conn.close()
+    assert router.migrate(archive_path=archive_path)['requests'] == 2
+
+
+def test_move_region_moves_every_row(directory, tmp_path):
+    _populate(directory)
+    router = _router(directory, tmp_path)
+    router.migrate()
+    region = shards.region_of(*PARIS, 1.0)
+    idx, _ = router.region(region)
+    before = {table: _rows(router, table) for table in shards.SHARDED_TABLES}
+
+    assert router.move_region(region, 'merged', batch_size=1) == {'requests': 1, 'exchanges': 1, 'messages': 1}
+    assert router.shard_for_id(idx << shards.REGION_ID_BITS | 1) == 'merged'
+    for table in shards.SHARDED_TABLES:
+        after = _rows(router, table)
+        assert set(after) == set(before[table])
+        assert {shard for i, (shard, _) in after.items() if shards.region_index(i) == idx} == {'merged'}
+
+
+@pytest.mark.parametrize('failing_step', ['copy', 'settle'])
+def test_interrupted_move_resumes(directory, tmp_path, failing_step):
+    _populate(directory)
+    router = _router(directory, tmp_path)
+    router.migrate()
+    region = shards.region_of(*PARIS, 1.0)
+    idx, source = router.region(region)
+
+    def fail():
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        if failing_step == 'copy':
+            router.move_region(region, 'merged', batch_size=1, pause=fail)
+        else:
+            router.move_region(region, 'merged', settle=fail)
+
+    router.move_region(region, 'merged', batch_size=1)
+    conn = router.connect(source)
+    try:
+        low, high = shards.id_range(idx)
+        for table in shards.SHARDED_TABLES:
+            assert conn.execute(f'SELECT COUNT(*) FROM {table} WHERE id > ? AND id <= ?', (low, high)).fetchone()[0] == 0
+    finally:
+        conn.close()
+    for table in shards.SHARDED_TABLES:
+        assert [shard for i, (shard, _) in _rows(router, table).items() if shards.region_index(i) == idx] == ['merged']
@@ -0,0 +1,61 @@
+"""
+Build des assets statiques : empreintes, variantes et manifeste PWA
+"""
+
+import json
+import os
+import shutil
+
+import static_assets
+
+from conftest import png_bytes
+
+SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public_html')
+
+
+def _source_with_icon(tmp_path):
+    source = tmp_path / 'public_html'
+    shutil.copytree(SOURCE, source, ignore=shutil.ignore_patterns('dist'))
+    images = source / 'static' / 'images'
+    images.mkdir(parents=True, exist_ok=True)
+    (images / 'icon-192.png').write_bytes(png_bytes(size=(192, 192)))
+    return source
+
+
+def test_manifest_icons_are_fingerprinted_and_copied(tmp_path):
+    source, dist = _source_with_icon(tmp_path), tmp_path / 'dist'
+    mapping = static_assets.build(str(source), str(dist))
+
+    hashed_icon = mapping['static/images/icon-192.png']
+    assert static_assets.is_fingerprinted(hashed_icon)
+    assert (dist / hashed_icon).read_bytes() == (source / 'static/images/icon-192.png').read_bytes()
+    # PNG déjà compressé : pas de variante
+    assert not (dist / (hashed_icon + '.gz')).exists()
+
+    manifest = json.loads((dist / mapping['manifest.json']).read_text(encoding='utf-8'))
+    icons = {icon['sizes']: icon['src'] for icon in manifest['icons']}
+    assert icons['192x192'] == '/' + hashed_icon
+    # Image absente des sources : référence inchangée
+    assert icons['72x72'] == '/static/images/icon-72.png'
+
+    sw = (dist / 'sw.js').read_text(encoding='utf-8')
+    assert f'"/{hashed_icon}"' in sw
+
+
+def test_manifest_fingerprint_follows_its_icons(tmp_path):
+    source = _source_with_icon(tmp_path)
+    before = static_assets.build(str(source), str(tmp_path / 'dist'))['manifest.json']
+    (source / 'static/images/icon-192.png').write_bytes(png_bytes((0, 0, 255), size=(192, 192)))
+    after = static_assets.build(str(source), str(tmp_path / 'dist'))['manifest.json']
+    assert before != after
+
+
+def test_built_icon_is_served_immutable(app_module, client, tmp_path):
+    dist = app_module.app.config['PUBLIC_HTML_DIST']
+    mapping = static_assets.build(str(_source_with_icon(tmp_path)), dist)
+
+    response = client.get('/' + mapping['static/images/icon-192.png'], headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'Content-Encoding' not in response.headers
+    assert 'immutable' in response.headers['Cache-Control']
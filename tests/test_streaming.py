@@ -0,0 +1,109 @@
+"""
+Envoi incrémental : mêmes données, et même forme, qu'une réponse complète
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+import streaming
+from conftest import new_request
+
+
+def connect():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT, price REAL, created_at TIMESTAMP)')
+    conn.executemany('INSERT INTO items (name, price, created_at) VALUES (?, ?, ?)', [
+        (f'objet "{i}" é\n', i / 3, f'2026-01-0{i % 9 + 1} 10:00:00') for i in range(23)
+    ])
+    return conn
+
+
+SQL = 'SELECT * FROM items WHERE id > ? ORDER BY id'
+
+
+class Tracked:
+    """Connexion dont on vérifie la fermeture"""
+
+    def __init__(self):
+        self.conn = connect()
+        self.closed = False
+
+    def __call__(self):
+        return self
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+
+def expected_rows(min_id=0):
+    return [dict(row) for row in connect().execute(SQL, (min_id,)).fetchall()]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 23, 1000])
+@pytest.mark.parametrize('min_id', [0, 20, 100])
+def test_json_array_stream_matches_full_document(chunk_size, min_id):
+    source = Tracked()
+    body = ''.join(streaming.json_array_stream(source, SQL, (min_id,), 'items', chunk_size))
+    rows = expected_rows(min_id)
+    assert json.loads(body) == {'items': rows, 'count': len(rows)}
+    assert source.closed
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_ndjson_stream_has_one_line_per_row(chunk_size):
+    source = Tracked()
+    body = ''.join(streaming.ndjson_stream(source, SQL, (0,), chunk_size))
+    assert body.endswith('\n')
+    assert [json.loads(line) for line in body.splitlines()] == expected_rows()
+    assert source.closed
+
+
+def test_stream_accepts_sql_built_from_the_connection():
+    source = Tracked()
+    body = ''.join(streaming.ndjson_stream(source, lambda conn: SQL, (20,)))
+    assert [json.loads(line) for line in body.splitlines()] == expected_rows(20)
+
+
+def test_connection_is_opened_lazily_and_closed_on_disconnect():
+    source = Tracked()
+    opened = []
+
+    def connect_once():
+        opened.append(True)
+        return source
+
+    body = streaming.ndjson_stream(connect_once, SQL, (0,), 2)
+    assert opened == []  # rien n'est ouvert tant que la réponse n'est pas envoyée
+    next(body)
+    body.close()  # client parti en cours d'envoi
+    assert opened == [True] and source.closed
+
+
+def test_streamed_feed_matches_buffered_feed(user_client):
+    for i in range(7):
+        new_request(user_client, title=f'Demande {i}')
+
+    for query in ('limit=5', 'limit=5&view=compact', 'limit=5&fields=id,title,username'):
+        buffered = user_client.get(f'/requests?{query}')
+        streamed = user_client.get(f'/requests?{query}&stream=1')
+        assert buffered.status_code == streamed.status_code == 200
+        assert json.loads(streamed.get_data()) == buffered.get_json()
+        assert set(buffered.get_json()) == {'requests', 'count'}
+        assert buffered.get_json()['count'] == 5
+
+
+def test_ndjson_export_lists_the_user_requests(user_client):
+    ids = [new_request(user_client, title=f'Export {i}') for i in range(3)]
+    response = user_client.get('/export/requests.ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == ids
+    assert all(row['user_id'] == user_client.user_id for row in rows)
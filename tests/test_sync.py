@@ -0,0 +1,164 @@
+"""
+Synchronisation différentielle : journal compacté, horizon, visibilité, jeton
+"""
+
+import sqlite3
+
+import pytest
+
+import sync
+
+from conftest import new_request
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE requests (id INTEGER PRIMARY KEY, user_id INTEGER, status TEXT);
+        CREATE TABLE exchanges (id INTEGER PRIMARY KEY, requester_id INTEGER, provider_id INTEGER);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY, exchange_id INTEGER);
+        CREATE TABLE notifications (id INTEGER PRIMARY KEY, user_id INTEGER);
+    ''')
+    sync.install(conn)
+    yield conn
+    conn.close()
+
+
+def _log(conn):
+    return [tuple(row) for row in conn.execute('SELECT name, row_id, op FROM change_log ORDER BY seq')]
+
+
+def test_change_log_keeps_the_last_change_per_row(conn):
+    conn.execute("INSERT INTO requests VALUES (1, 1, 'active')")
+    conn.execute("INSERT INTO requests VALUES (2, 1, 'active')")
+    first_seq = conn.execute("SELECT seq FROM change_log WHERE row_id = 1").fetchone()[0]
+    for status in ('completed', 'active'):
+        conn.execute('UPDATE requests SET status = ? WHERE id = 1', (status,))
+
+    assert _log(conn) == [('requests', 2, 'upsert'), ('requests', 1, 'upsert')]
+    assert conn.execute("SELECT seq FROM change_log WHERE row_id = 1").fetchone()[0] > first_seq
+
+    conn.execute('DELETE FROM requests WHERE id = 1')
+    assert _log(conn) == [('requests', 2, 'upsert'), ('requests', 1, 'delete')]
+
+
+def test_install_logs_existing_rows_once(conn):
+    conn.execute("INSERT INTO notifications VALUES (5, 1)")
+    sync.install(conn)
+    assert _log(conn) == [('notifications', 5, 'upsert')]
+
+
+def test_read_changes_pages_through_the_log(conn):
+    conn.executemany("INSERT INTO notifications VALUES (?, 1)", [(i,) for i in range(1, 6)])
+
+    first = sync.read_changes(conn, 0, 1, limit=3)
+    assert [row['id'] for row in first['changes']['notifications']] == [1, 2, 3]
+    assert first['has_more']
+    second = sync.read_changes(conn, first['seq'], 1, limit=3)
+    assert [row['id'] for row in second['changes']['notifications']] == [4, 5]
+    assert not second['has_more']
+    assert sync.read_changes(conn, second['seq'], 1, limit=3)['changes'] == {}
+
+
+def test_pruned_tombstones_force_a_reset(conn):
+    conn.execute("INSERT INTO notifications VALUES (1, 1)")
+    since = sync.read_changes(conn, 0, 1, limit=10)['seq']
+    conn.execute("INSERT INTO notifications VALUES (2, 1)")
+    conn.execute('DELETE FROM notifications WHERE id = 1')
+    conn.execute("UPDATE change_log SET changed_at = '2000-01-01 00:00:00' WHERE op = 'delete'")
+
+    assert sync.prune(conn, '2001-01-01 00:00:00') == 1
+    tombstone_seq = sync.horizon(conn)
+    assert tombstone_seq > since
+
+    # Client antérieur à la pierre tombale purgée : il aurait manqué la suppression
+    assert sync.read_changes(conn, since, 1, limit=10) == {'reset': True}
+    # Premier appel ou client à jour : pas de reset
+    assert not sync.read_changes(conn, 0, 1, limit=10)['reset']
+    assert not sync.read_changes(conn, tombstone_seq, 1, limit=10)['reset']
+    # L'horizon ne recule jamais
+    assert sync.prune(conn, '2001-01-01 00:00:00') == 0
+    assert sync.horizon(conn) == tombstone_seq
+
+
+def test_visibility_filters(conn):
+    conn.executescript('''
+        INSERT INTO requests VALUES (1, 2, 'active');     -- flux public
+        INSERT INTO requests VALUES (2, 2, 'completed');  -- close, d'un autre
+        INSERT INTO requests VALUES (3, 1, 'completed');  -- close, la sienne
+        INSERT INTO exchanges VALUES (10, 1, 2);
+        INSERT INTO exchanges VALUES (11, 2, 3);
+        INSERT INTO messages VALUES (20, 10);
+        INSERT INTO messages VALUES (21, 11);
+        INSERT INTO notifications VALUES (30, 1);
+        INSERT INTO notifications VALUES (31, 2);
+    ''')
+    result = sync.read_changes(conn, 0, 1, limit=100)
+
+    visible = {table: [row['id'] for row in rows] for table, rows in result['changes'].items()}
+    assert visible == {'requests': [1, 3], 'exchanges': [10], 'messages': [20], 'notifications': [30]}
+    # Seules les demandes sorties du flux sont annoncées comme supprimées
+    assert result['deleted'] == {'requests': [2]}
+
+
+@pytest.mark.parametrize('positions', [{}, {'main': 12}, {'main': 3, 'r48_2': 7, 'global': 0}])
+def test_token_round_trip(positions):
+    token = sync.encode_token(positions)
+    assert '=' not in token
+    assert sync.decode_token(token) == positions
+
+
+@pytest.mark.parametrize('token', [
+    'not base64!',
+    sync.encode_token({'main': -1}),
+    sync.encode_token({'main': '3'}),
+    sync.encode_token({'main': 1.5}),
+    'WzEsMl0',  # [1,2]
+])
+def test_invalid_tokens(token):
+    with pytest.raises(sync.SyncTokenError):
+        sync.decode_token(token)
+
+
+def _sync_all(client, token=''):
+    """Rappelle /sync jusqu'à épuisement ; retourne (changes, deleted, token)"""
+    changes, deleted = {}, {}
+    while True:
+        response = client.get('/sync', query_string={'since': token, 'limit': 500})
+        assert response.status_code == 200, response.get_data()
+        body = response.get_json()
+        assert not body['reset']
+        for table, rows in body['changes'].items():
+            changes.setdefault(table, []).extend(row['id'] for row in rows)
+        for table, ids in body['deleted'].items():
+            deleted.setdefault(table, []).extend(ids)
+        token = body['token']
+        if not body['has_more']:
+            return changes, deleted, token
+
+
+def test_archived_rows_reach_clients_as_deletes(app_module, user_client):
+    request_id = new_request(user_client)
+    changes, _, token = _sync_all(user_client)
+    assert request_id in changes['requests']
+    assert 'main' in sync.decode_token(token)
+
+    conn = sqlite3.connect(app_module.app.config['DATABASE_PATH'])
+    with conn:
+        conn.execute(
+            "UPDATE requests SET status = 'cancelled', updated_at = '2000-01-01 00:00:00' WHERE id = ?",
+            (request_id,)
+        )
+    conn.close()
+    app_module.archive_cold_data()
+
+    changes, deleted, _ = _sync_all(user_client, token)
+    assert request_id in deleted['requests']
+    assert request_id not in changes.get('requests', [])
+
+
+def test_endpoint_rejects_invalid_token(user_client):
+    response = user_client.get('/sync', query_string={'since': 'not base64!'})
+    assert response.status_code == 400
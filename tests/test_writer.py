@@ -0,0 +1,155 @@
+"""
+Écrivain unique : lots en SAVEPOINT, concurrence et abandon par l'appelant
+"""
+
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from writer import DatabaseWriter, WriterBusy, WriteTimeout
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'writer.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, label TEXT UNIQUE)')
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def writer(db_path):
+    return DatabaseWriter(lambda: sqlite3.connect(db_path, check_same_thread=False), max_per_key=1000)
+
+
+def _labels(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {row[0] for row in conn.execute('SELECT label FROM items')}
+    finally:
+        conn.close()
+
+
+def _insert(label):
+    def fn(conn):
+        return conn.execute('INSERT INTO items (label) VALUES (?)', (label,)).lastrowid
+    return fn
+
+
+def _blocker(writer):
+    """Occupe l'écrivain jusqu'à release.set() : les jobs suivants forment un même lot"""
+    started, release = threading.Event(), threading.Event()
+
+    def fn(conn):
+        started.set()
+        release.wait(5)
+
+    future = writer.submit(fn)
+    assert started.wait(5)
+    return release, future
+
+
+def test_concurrent_writes_are_batched(writer, db_path):
+    labels = [f'item-{i}' for i in range(200)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        ids = list(pool.map(lambda label: writer.write(_insert(label), key=label, timeout=10), labels))
+
+    assert len(set(ids)) == len(labels)
+    assert _labels(db_path) == set(labels)
+    assert writer.stats['jobs'] == len(labels)
+    # Plusieurs jobs par transaction sous concurrence
+    assert writer.stats['batches'] < len(labels)
+
+
+def test_failed_job_does_not_undo_its_batch(writer, db_path):
+    release, blocker = _blocker(writer)
+    futures = [writer.submit(_insert(label)) for label in ('a', 'dup', 'dup', 'b')]
+    release.set()
+
+    assert blocker.result(5) is None
+    assert isinstance(futures[2].exception(5), sqlite3.IntegrityError)
+    assert all(f.exception(5) is None for f in futures[:2] + futures[3:])
+    assert _labels(db_path) == {'a', 'dup', 'b'}
+    assert writer.stats['failed'] == 1
+
+
+def test_job_abandoned_before_it_starts_is_skipped(writer, db_path):
+    release, _ = _blocker(writer)
+    with pytest.raises(WriteTimeout):
+        writer.write(_insert('late'), timeout=0.05)
+    release.set()
+
+    assert writer.write(_insert('next'), timeout=5)
+    assert _labels(db_path) == {'next'}
+    assert writer.stats['abandoned'] == 1
+
+
+def test_job_abandoned_while_running_is_rolled_back(writer, db_path):
+    inside, release = threading.Event(), threading.Event()
+
+    def slow(conn):
+        conn.execute("INSERT INTO items (label) VALUES ('slow')")
+        inside.set()
+        release.wait(5)
+        return 'done'
+
+    threading.Timer(0.2, release.set).start()
+    with pytest.raises(WriteTimeout):
+        writer.write(slow, timeout=0.05)
+    assert inside.is_set()
+
+    # Le job suivant passe après le lot du job abandonné
+    assert writer.write(_insert('after'), timeout=5)
+    assert _labels(db_path) == {'after'}
+    assert writer.stats['abandoned'] == 1
+
+
+def test_caller_waits_for_a_finished_job_to_commit(writer, db_path):
+    release, _ = _blocker(writer)
+    results = []
+    fast = threading.Thread(target=lambda: results.append(writer.write(_insert('fast'), timeout=0.3)))
+
+    def slow_neighbour(conn):
+        time.sleep(1)
+        return _insert('neighbour')(conn)
+
+    fast.start()
+    time.sleep(0.05)
+    neighbour = writer.submit(slow_neighbour)
+    release.set()
+
+    # fast a abouti avant son délai mais son lot est validé après : résultat, pas WriteTimeout
+    fast.join(5)
+    assert neighbour.result(5)
+    assert len(results) == 1 and results[0]
+    assert _labels(db_path) == {'fast', 'neighbour'}
+
+
+@pytest.mark.parametrize('misuse', [
+    lambda conn: conn.commit(),
+    lambda conn: conn.rollback(),
+    lambda conn: conn.executescript('SELECT 1'),
+    lambda conn: conn.__enter__(),
+])
+def test_jobs_cannot_end_the_transaction(writer, db_path, misuse):
+    def fn(conn):
+        conn.execute("INSERT INTO items (label) VALUES ('x')")
+        misuse(conn)
+
+    with pytest.raises(sqlite3.ProgrammingError, match='must not end the transaction'):
+        writer.write(fn, timeout=5)
+    assert _labels(db_path) == set()
+
+
+def test_per_client_quota(db_path):
+    writer = DatabaseWriter(lambda: sqlite3.connect(db_path, check_same_thread=False), max_per_key=1)
+    release, _ = _blocker(writer)
+    writer.submit(_insert('first'), key='client')
+    with pytest.raises(WriterBusy):
+        writer.submit(_insert('second'), key='client')
+    release.set()